@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+
+import argparse
+import sys
+
+from lib.benchmark import BENCHMARK_SCALES, BENCHMARK_QUERIES, REGRESSION_THRESHOLD, run_benchmark, compare_benchmarks
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark build, load and search on a synthetic corpus")
+    subparsers = parser.add_subparsers(dest="command", help="Available commands")
+    run_parser = subparsers.add_parser("run", help="Time every stage at one or more corpus sizes")
+    run_parser.add_argument("--docs", type=int, nargs='+', default=list(BENCHMARK_SCALES),
+                            help="Corpus sizes to generate")
+    run_parser.add_argument("--queries", type=int, default=BENCHMARK_QUERIES, help="Timed queries per search")
+    run_parser.add_argument("--seed", type=int, default=0, help="Seed of the corpus and query generator")
+    run_parser.add_argument("--embedder", choices=["stub", "model"], default="stub",
+                            help="stub hashes words offline and deterministically; model loads the sentence transformer")
+    run_parser.add_argument("--workers", type=int, default=1, help="Processes for the index build")
+    run_parser.add_argument("--output", "-o", help="Write the results as JSON to this file")
+
+    compare_parser = subparsers.add_parser("compare", help="Compare two JSON results and report regressions")
+    compare_parser.add_argument("baseline", help="JSON results of the baseline commit")
+    compare_parser.add_argument("current", help="JSON results to check")
+    compare_parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD,
+                                help="Allowed slowdown before a stage counts as regressed (0.1 = 10%%)")
+    args = parser.parse_args()
+
+    match args.command:
+        case "run":
+            run_benchmark(args.docs, args.queries, args.seed, args.embedder, args.workers, args.output)
+        case "compare":
+            if compare_benchmarks(args.baseline, args.current, args.threshold):
+                sys.exit(1)
+        case _:
+            parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
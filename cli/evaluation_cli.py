@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+
+import argparse
+
+from lib.evaluation import EVAL_METHODS, EVAL_OBJECTIVES, EVAL_LATENCIES, sweep, sweep_configs
+from lib import tracing
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Search quality against latency over a grid of parameters")
+    subparsers = parser.add_subparsers(dest="command", help="Available commands")
+    sweep_parser = subparsers.add_parser("sweep", help="Evaluate every parameter combination on a golden file")
+    sweep_parser.add_argument("golden", help='JSON or JSONL cases: a "query" with "relevant_ids" or "relevant_docs" titles')
+    sweep_parser.add_argument("--methods", nargs='+', choices=EVAL_METHODS, default=['rrf'], help="Search methods")
+    sweep_parser.add_argument("--limit", type=int, nargs='+', default=[5], help="Results kept, the k of P@k and R@k")
+    sweep_parser.add_argument("--k", type=int, nargs='+', default=[60], help="RRF k values")
+    sweep_parser.add_argument("--alpha", type=float, nargs='+', default=[0.5], help="Weighted search bm25 weights")
+    sweep_parser.add_argument("--depth", type=int, nargs='+', default=[None],
+                              help="Candidates per result asked of each retriever (default 500)")
+    sweep_parser.add_argument("--k1", type=float, nargs='+', default=[None], help="BM25 k1 values")
+    sweep_parser.add_argument("--b", type=float, nargs='+', default=[None], help="BM25 b values")
+    sweep_parser.add_argument("--nprobe", type=int, nargs='+', default=[0],
+                              help="Lists probed in the approximate chunk index, 0 for exact search")
+    sweep_parser.add_argument("--rerank", nargs='+', choices=["none", "individual", "batch", "cross-encoder"],
+                              default=["none"], help="Rerank methods")
+    sweep_parser.add_argument("--rerank-top", type=int, nargs='+', default=[None],
+                              help="Fused results the cross-encoder reranks")
+    sweep_parser.add_argument("--objective", choices=EVAL_OBJECTIVES, default='mrr', help="Quality axis of the frontier")
+    sweep_parser.add_argument("--latency", choices=EVAL_LATENCIES, default='p50_ms', help="Latency axis of the frontier")
+    sweep_parser.add_argument("--output", "-o", help="Write every result and the frontier as JSON to this file")
+    parser.add_argument("--profile", action="store_true", help="Print time spent per search stage to stderr on exit")
+    args = parser.parse_args()
+    if args.profile:
+        tracing.profile()
+
+    match args.command:
+        case "sweep":
+            configs = sweep_configs(args.methods, args.limit, args.k, args.alpha, args.depth, args.k1, args.b,
+                                    args.nprobe, [None if rerank == 'none' else rerank for rerank in args.rerank],
+                                    args.rerank_top)
+            sweep(args.golden, configs, args.objective, args.latency, args.output)
+        case _:
+            parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,10 @@
 import argparse
 
-from lib.hybrid_search import normalize_scores, weighted_search, rrf_search
+from lib.hybrid_search import normalize_scores, weighted_search, rrf_search, print_rrf_results, \
+    print_weighted_results, RERANK_LABELS, batch_command, rrf_limit
+from lib.batch_search import QUERY_BATCH_SIZE
+from lib.search_server import SERVER_ADDRESS, SearchClient
+from lib import tracing
 
 
 def main() -> None:
@@ -12,6 +16,13 @@ def main() -> None:
     ws_parser.add_argument('query', type=str, help="Score to normalize")
     ws_parser.add_argument('alpha', type=float, default=0.5, help="if weight for bm25")
     ws_parser.add_argument('limit', type=int, default=5, help="# of results to return")
+    ws_parser.add_argument("--nprobe", type=int, help="Use the approximate chunk index, probing this many lists")
+    ws_parser.add_argument("--sharded", action="store_true",
+                           help="Search the shards built by sharded_search_cli.py, one worker process per shard")
+    ws_parser.add_argument("--disk-cache", action="store_true",
+                           help="Reuse results of earlier runs from a cache under cache/, dropped on rebuilds")
+    ws_parser.add_argument("--server", nargs='?', const=SERVER_ADDRESS,
+                           help=f"Send the query to a running search server (default {SERVER_ADDRESS})")
 
     rrf_parser = subparsers.add_parser(name="rrf_search", help="Available commands")
     rrf_parser.add_argument('query', type=str, help="Score to normalize")
@@ -22,13 +33,63 @@ def main() -> None:
                             help="Query enhancement method", )
     rrf_parser.add_argument("--rerank-method", type=str, choices=["individual", "batch", "cross-encoder"],
                             help="rerank method")
+    rrf_parser.add_argument("--rerank-top", type=int,
+                            help="Only rerank the best this many fused results with the cross-encoder")
+    rrf_parser.add_argument("--nprobe", type=int, help="Use the approximate chunk index, probing this many lists")
+    rrf_parser.add_argument("--sharded", action="store_true",
+                            help="Search the shards built by sharded_search_cli.py, one worker process per shard")
+    rrf_parser.add_argument("--disk-cache", action="store_true",
+                            help="Reuse results of earlier runs from a cache under cache/, dropped on rebuilds")
+    rrf_parser.add_argument("--server", nargs='?', const=SERVER_ADDRESS,
+                            help=f"Send the query to a running search server (default {SERVER_ADDRESS})")
+    batch_parser = subparsers.add_parser(name="batch", help="Run many hybrid queries and write ranked results as JSONL")
+    batch_parser.add_argument('input', nargs='?', default='-',
+                              help='JSONL queries, a string or an object with a "query" field per line (default stdin)')
+    batch_parser.add_argument('--output', '-o', default='-', help="Where to write the JSONL results (default stdout)")
+    batch_parser.add_argument('--method', choices=['rrf', 'weighted'], default='rrf', help="Fusion method")
+    batch_parser.add_argument('--limit', type=int, default=5, help="# of results to return per query")
+    batch_parser.add_argument('--k', type=int, default=60, help="RRF k")
+    batch_parser.add_argument('--alpha', type=float, default=0.5, help="Weight of bm25 for weighted fusion")
+    batch_parser.add_argument('--batch-size', type=int, default=QUERY_BATCH_SIZE,
+                              help="Queries embedded and scored together")
+    batch_parser.add_argument("--nprobe", type=int, help="Use the approximate chunk index, probing this many lists")
+    batch_parser.add_argument("--sharded", action="store_true",
+                              help="Search the shards built by sharded_search_cli.py, one worker process per shard")
+    parser.add_argument("--profile", action="store_true", help="Print time spent per search stage to stderr on exit")
     args = parser.parse_args()
+    if args.profile:
+        tracing.profile()
 
     match args.command:
+        case 'batch':
+            batch_command(args.input, args.output, args.method, args.limit, args.k, args.alpha, args.nprobe,
+                          args.batch_size, args.sharded)
         case 'rrf_search':
-            rrf_search(args.query, limit=args.limit, enhance=args.enhance, rerank_method=args.rerank_method)
+            if args.server:
+                if args.nprobe is not None or args.sharded or args.disk_cache:
+                    # the server searches with the options it was started with
+                    rrf_parser.error("--nprobe, --sharded and --disk-cache are set when the server starts, not with --server")
+                response = SearchClient(args.server).search('rrf', args.query, k=args.k, limit=args.limit,
+                                                            enhance=args.enhance, rerank_method=args.rerank_method,
+                                                            rerank_top=args.rerank_top)
+                if args.enhance:
+                    print(f"original query {args.query}->enhanced query: {response['query']}")
+                if args.rerank_method:
+                    print(f"reranking top{args.limit} using {RERANK_LABELS[args.rerank_method]}")
+                print_rrf_results(response['results'], rrf_limit(args.limit, args.rerank_method), args.rerank_method)
+            else:
+                rrf_search(args.query, k=args.k, limit=args.limit, enhance=args.enhance, rerank_method=args.rerank_method,
+                           nprobe=args.nprobe, rerank_top=args.rerank_top, sharded=args.sharded,
+                           disk_cache=args.disk_cache)
         case 'weighted_search':
-            weighted_search(args.query, alpha=args.alpha, limit=args.limit)
+            if args.server:
+                if args.nprobe is not None or args.sharded or args.disk_cache:
+                    ws_parser.error("--nprobe, --sharded and --disk-cache are set when the server starts, not with --server")
+                response = SearchClient(args.server).search('weighted', args.query, alpha=args.alpha, limit=args.limit)
+                print_weighted_results(response['results'], args.limit)
+            else:
+                weighted_search(args.query, alpha=args.alpha, limit=args.limit, nprobe=args.nprobe,
+                                sharded=args.sharded, disk_cache=args.disk_cache)
         case 'normalized':
             norm_scores = normalize_scores(args.scores)
             for norm_score in norm_scores:
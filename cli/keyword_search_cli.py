@@ -3,16 +3,32 @@
 import argparse
 
 from lib.keyword_search import search_movies, build_command, tf_command, idf_command, tfidf_command, bm25_idf_command, \
-    bm25_tf_command, bm25_command
+    bm25_tf_command, bm25_command, convert_command, update_command, batch_command
+from lib.batch_search import QUERY_BATCH_SIZE
+from lib.boolean_query import QUERY_OPERATORS
 from lib.search_utils import BM25_B
+from lib.spelling import spell_command
+from lib.search_server import SERVER_ADDRESS, SearchClient
+from lib import tracing
 
 
 def main() -> None:
     parser = argparse.ArgumentParser(description='Keyword Search CLI')
     subparsers = parser.add_subparsers(dest='command', help='Available commands')
     search_parser = subparsers.add_parser('search', help='Search movies')
-    search_parser.add_argument('query', type=str, help='Search Query')
+    search_parser.add_argument('query', type=str,
+                               help='Search Query, terms and "phrases" combined with AND, OR, NOT and parentheses')
+    search_parser.add_argument('--limit', type=int, default=5, help='Stop after this many matching movies')
+    search_parser.add_argument('--operator', choices=QUERY_OPERATORS, default='or',
+                               help='How terms without an operator between them are combined')
     build_parser = subparsers.add_parser('build', help='Just build it')
+    build_parser.add_argument('--workers', type=int, default=1, help='Analyze the corpus in this many processes')
+    build_parser.add_argument('--positional', action='store_true',
+                              help='Also index where terms occur, for "phrase" queries and the proximity score')
+    spell_parser = subparsers.add_parser('spell', help='Correct misspelled words against the index vocabulary, offline')
+    spell_parser.add_argument('query', type=str, help='Query to correct')
+    update_parser = subparsers.add_parser('update', help='Re-index only the movies that were added, changed or removed')
+    convert_parser = subparsers.add_parser('convert', help='Convert the old pickled index to the columnar format')
 
     tf_parser = subparsers.add_parser('tf', help='Calculate term frequency')
     tf_parser.add_argument('id', type=int, help='DOC ID')
@@ -34,21 +50,47 @@ def main() -> None:
 
     bm25search_parser = subparsers.add_parser("bm25search", help="Search movies using full BM25 scoring")
     bm25search_parser.add_argument("query", type=str, help="Search query")
+    bm25search_parser.add_argument("--server", nargs='?', const=SERVER_ADDRESS,
+                                   help=f"Send the query to a running search server (default {SERVER_ADDRESS})")
+    batch_parser = subparsers.add_parser('batch', help='Run many BM25 queries and write ranked results as JSONL')
+    batch_parser.add_argument('input', nargs='?', default='-',
+                              help='JSONL queries, a string or an object with a "query" field per line (default stdin)')
+    batch_parser.add_argument('--output', '-o', default='-', help='Where to write the JSONL results (default stdout)')
+    batch_parser.add_argument('--limit', type=int, default=5, help='Results per query')
+    batch_parser.add_argument('--batch-size', type=int, default=QUERY_BATCH_SIZE, help='Queries searched together')
+    parser.add_argument("--profile", action="store_true", help="Print time spent per search stage to stderr on exit")
     args = parser.parse_args()
+    if args.profile:
+        tracing.profile()
     match args.command:
+        case 'batch':
+            batch_command(args.input, args.output, args.limit, args.batch_size)
         case 'bm25search':
-            bm25_results = bm25_command(args.query)
+            if args.server:
+                bm25_results = SearchClient(args.server).search('keyword', args.query)['results']
+            else:
+                bm25_results = bm25_command(args.query)
             for idx, result in enumerate(bm25_results):
                 print(f'{idx + 1}.) ({result['doc_id']}) {result['title']} - Score = {result['score']:.2f}')
 
         case 'search':
 
             print(f"Searching for: {args.query}")
-            results = search_movies(args.query, 5)
+            try:
+                results = search_movies(args.query, args.limit, args.operator)
+            except ValueError as e:
+                print(f"Invalid query: {e}")
+                return
             for i, result in enumerate(results):
                 print(f"{i + 1}, {result['title']}")
         case 'build':
-            build_command()
+            build_command(args.workers, args.positional)
+        case 'spell':
+            spell_command(args.query)
+        case 'update':
+            update_command()
+        case 'convert':
+            convert_command()
         case 'tf':
             tf_command(args.id, args.term)
         case 'bm25tf':
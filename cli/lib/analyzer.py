@@ -0,0 +1,99 @@
+import os
+import pickle
+import string
+
+from lib import components
+from lib.search_utils import load_stopwords, CACHE_PATH
+
+STEM_CACHE_SIZE = 200_000
+
+
+class Analyzer:
+    def __init__(self, stopwords=None, stem_cache_size=STEM_CACHE_SIZE):
+        if stopwords is None:
+            stopwords = load_stopwords()
+        self.stopwords = frozenset(stopwords)
+        self.stem_cache_size = stem_cache_size
+        self.stem_cache_path = CACHE_PATH / 'stem_cache.pkl'
+        self._punctuation_table = str.maketrans('', '', string.punctuation)
+        # nltk is slow to import, so the stemmer is only created on the first stem cache miss
+        self._stemmer = None
+        # raw token -> stem, insertion ordered so the oldest entries are evicted first; the saved cache
+        # is only read on the first miss, or when the cache is merged or saved
+        self._stem_cache = {}
+        self._stem_cache_loaded = False
+
+    def clean(self, text):
+        return text.lower().translate(self._punctuation_table)
+
+    def stem(self, token):
+        stem = self._stem_cache.get(token)
+        if stem is None and not self._stem_cache_loaded:
+            self.load_stem_cache()
+            stem = self._stem_cache.get(token)
+        if stem is None:
+            if self._stemmer is None:
+                from nltk.stem import PorterStemmer
+                self._stemmer = PorterStemmer()
+            stem = self._stemmer.stem(token)
+            if len(self._stem_cache) >= self.stem_cache_size:
+                del self._stem_cache[next(iter(self._stem_cache))]
+            self._stem_cache[token] = stem
+        return stem
+
+    def analyze(self, text):
+        stopwords = self.stopwords
+        stem = self.stem
+        return [stem(token) for token in self.clean(text).split() if token not in stopwords]
+
+    def analyze_many(self, texts):
+        return self.analyze_many_with_stems(texts)[0]
+
+    def analyze_many_with_stems(self, texts):
+        # stem each distinct surface form once for the whole batch, then map every text through it;
+        # the surface form -> stem table is returned too so other processes can merge it
+        stopwords = self.stopwords
+        split_texts = [self.clean(text).split() for text in texts]
+        stems = {}
+        for tokens in split_texts:
+            for token in tokens:
+                if token not in stems and token not in stopwords:
+                    stems[token] = self.stem(token)
+        return [[stems[token] for token in tokens if token not in stopwords] for tokens in split_texts], stems
+
+    def stem_table(self):
+        # surface form -> stem of every cached token
+        if not self._stem_cache_loaded:
+            self.load_stem_cache()
+        return dict(self._stem_cache)
+
+    def update_stem_cache(self, stems):
+        if not self._stem_cache_loaded:
+            self.load_stem_cache()
+        for token, stem in stems.items():
+            if len(self._stem_cache) >= self.stem_cache_size:
+                break
+            self._stem_cache.setdefault(token, stem)
+
+    def save_stem_cache(self, path=None):
+        if not self._stem_cache_loaded:
+            self.load_stem_cache()
+        path = path or self.stem_cache_path
+        os.makedirs(path.parent, exist_ok=True)
+        with open(path, mode='wb') as f:
+            pickle.dump(self._stem_cache, f)
+
+    def load_stem_cache(self, path=None):
+        self._stem_cache_loaded = True
+        path = path or self.stem_cache_path
+        if not path.exists():
+            return
+        with open(path, mode='rb') as f:
+            self.update_stem_cache(pickle.load(f))
+
+
+components.register('analyzer', Analyzer)
+
+
+def get_analyzer():
+    return components.get('analyzer')
@@ -0,0 +1,83 @@
+import math
+
+import numpy as np
+
+KMEANS_ITERATIONS = 10
+KMEANS_SAMPLE_PER_LIST = 256
+ASSIGN_BATCH_SIZE = 65536
+
+
+def default_nlist(n_vectors):
+    return max(1, min(n_vectors, int(4 * math.sqrt(n_vectors))))
+
+
+def _assign(vectors, centroids):
+    # nearest centroid by inner product, in batches to bound the n x nlist score matrix
+    labels = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), ASSIGN_BATCH_SIZE):
+        batch = vectors[start:start + ASSIGN_BATCH_SIZE]
+        labels[start:start + len(batch)] = np.argmax(batch @ centroids.T, axis=1)
+    return labels
+
+
+def spherical_kmeans(vectors, nlist, iterations=KMEANS_ITERATIONS, seed=0):
+    # k-means on the unit sphere: centroids are renormalized means, similarity is the inner product
+    rng = np.random.default_rng(seed)
+    sample_size = min(len(vectors), nlist * KMEANS_SAMPLE_PER_LIST)
+    sample = vectors[np.sort(rng.choice(len(vectors), sample_size, replace=False))]
+    centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+    for _ in range(iterations):
+        labels = _assign(sample, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, sample)
+        counts = np.bincount(labels, minlength=nlist)
+        empty = counts == 0
+        # empty lists are reseeded from random sample points
+        sums[empty] = sample[rng.choice(len(sample), int(empty.sum()))]
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        centroids = (sums / norms).astype(np.float32)
+    return centroids
+
+
+class IVFIndex:
+    # inverted-file index over L2-normalized vectors: k-means centroids plus one id list per
+    # centroid; a query only scans the nprobe lists whose centroids are closest
+    def __init__(self, centroids, list_offsets, list_ids):
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.list_ids = list_ids
+
+    @property
+    def nlist(self):
+        return len(self.centroids)
+
+    @property
+    def size(self):
+        return len(self.list_ids)
+
+    @classmethod
+    def build(cls, vectors, nlist=None, seed=0):
+        # at most one list per vector, k-means seeds every list with a distinct one
+        nlist = min(nlist, len(vectors)) if nlist else default_nlist(len(vectors))
+        centroids = spherical_kmeans(vectors, nlist, seed=seed)
+        labels = _assign(vectors, centroids)
+        list_ids = np.argsort(labels, kind='stable')
+        list_offsets = np.zeros(nlist + 1, dtype=np.int64)
+        np.cumsum(np.bincount(labels, minlength=nlist), out=list_offsets[1:])
+        return cls(centroids, list_offsets, list_ids)
+
+    def save(self, path):
+        np.savez(path, centroids=self.centroids, list_offsets=self.list_offsets, list_ids=self.list_ids)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        return cls(data['centroids'], data['list_offsets'], data['list_ids'])
+
+    def candidates(self, query, nprobe):
+        # ids of every vector in the nprobe lists nearest to the (normalized) query
+        nprobe = min(nprobe, self.nlist)
+        centroid_scores = self.centroids @ query
+        probes = np.argpartition(-centroid_scores, nprobe - 1)[:nprobe]
+        return np.concatenate([self.list_ids[self.list_offsets[p]:self.list_offsets[p + 1]] for p in probes])
@@ -0,0 +1,47 @@
+import itertools
+import json
+import sys
+import time
+
+from lib.search_utils import json_default
+
+# queries embedded and scored together; a batch holds a queries x chunks score matrix
+QUERY_BATCH_SIZE = 128
+
+
+def read_queries(source='-'):
+    # one query per line of source ('-' reads stdin): a JSON string, or an object with a "query"
+    # string whose other fields are copied to the output line
+    f = sys.stdin if source == '-' else open(source, mode='r')
+    try:
+        for line_number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if isinstance(record, str):
+                record = {'query': record}
+            if not isinstance(record, dict) or not isinstance(record.get('query'), str) or not record['query'].strip():
+                raise ValueError(f"{source}:{line_number}: expected a query string or an object with a 'query' string")
+            yield record
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def run_batch(search_many, source='-', output='-', batch_size=QUERY_BATCH_SIZE):
+    # search_many maps a list of queries to their result lists; writes one JSON line per query to
+    # output ('-' is stdout) and reports throughput on stderr
+    out = sys.stdout if output == '-' else open(output, mode='w')
+    count = 0
+    started = time.perf_counter()
+    try:
+        for batch in itertools.batched(read_queries(source), batch_size):
+            for record, results in zip(batch, search_many([record['query'] for record in batch])):
+                out.write(json.dumps({**record, 'results': results}, default=json_default) + '\n')
+            count += len(batch)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    seconds = time.perf_counter() - started
+    print(f"{count} queries in {seconds:.2f}s ({count / seconds if seconds else 0.:.1f} queries/sec)", file=sys.stderr)
+    return count, seconds
@@ -0,0 +1,274 @@
+import json
+import os
+import platform
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import numpy as np
+
+BENCHMARK_SCALES = (10_000, 100_000, 1_000_000)
+BENCHMARK_QUERIES = 200
+BENCHMARK_LOADS = 5
+BENCHMARK_LIMIT = 10
+# synthetic corpus: words are drawn with p(rank) ~ 1 / rank ** ZIPF_EXPONENT from a vocabulary whose
+# head is real stopwords; descriptions have a few sentences of movie synopsis length
+VOCABULARY_SIZE = 50_000
+ZIPF_EXPONENT = 1.07
+SENTENCES_MEAN = 4
+SENTENCE_WORDS = (6, 20)
+CORPUS_BLOCK = 10_000
+STUB_DIMENSIONS = 384
+# a p50 or p95 this much slower than the baseline is reported as a regression
+REGRESSION_THRESHOLD = 0.1
+
+_STOPWORDS = ('the', 'of', 'and', 'a', 'to', 'in', 'his', 'is', 'her', 'with', 'he', 'for', 'by', 'as', 'on', 'who',
+              'an', 'their', 'from', 'she', 'they', 'at', 'but', 'when', 'that', 'after', 'be', 'into', 'him', 'it')
+_ONSETS = ('b', 'br', 'c', 'ch', 'd', 'dr', 'f', 'g', 'gr', 'h', 'j', 'k', 'l', 'm', 'n', 'p', 'pr', 'r', 's', 'sh',
+           'st', 't', 'tr', 'v', 'w', 'z')
+_NUCLEI = ('a', 'e', 'i', 'o', 'u', 'ai', 'ea', 'ou')
+_CODAS = ('', 'n', 'r', 's', 'l', 'nd', 'rk', 'st', 'x', 'm')
+
+
+def synthetic_vocabulary(size=VOCABULARY_SIZE, seed=0):
+    # size distinct words, most frequent first: the stopwords, then pronounceable made-up words
+    rng = np.random.default_rng(seed)
+    words = list(_STOPWORDS[:size])
+    seen = set(words)
+    while len(words) < size:
+        word = ''.join(_ONSETS[rng.integers(len(_ONSETS))] + _NUCLEI[rng.integers(len(_NUCLEI))] +
+                       _CODAS[rng.integers(len(_CODAS))] for _ in range(rng.integers(1, 4)))
+        if word not in seen:
+            seen.add(word)
+            words.append(word)
+    return words
+
+
+def _zipf_probabilities(size):
+    weights = 1 / np.arange(1, size + 1) ** ZIPF_EXPONENT
+    return weights / weights.sum()
+
+
+def synthetic_movies(n, seed=0, vocabulary=None):
+    # n movie dicts shaped like data/movies.json, generated a block at a time so any n streams
+    vocabulary = np.asarray(vocabulary or synthetic_vocabulary(seed=seed), dtype=object)
+    probabilities = _zipf_probabilities(len(vocabulary))
+    rng = np.random.default_rng(seed)
+    for start in range(0, n, CORPUS_BLOCK):
+        count = min(CORPUS_BLOCK, n - start)
+        sentences = 1 + rng.poisson(SENTENCES_MEAN - 1, count)
+        lengths = rng.integers(SENTENCE_WORDS[0], SENTENCE_WORDS[1] + 1, sentences.sum())
+        words = vocabulary[rng.choice(len(vocabulary), lengths.sum(), p=probabilities)]
+        title_lengths = rng.integers(1, 5, count)
+        titles = vocabulary[rng.choice(len(vocabulary), title_lengths.sum(), p=probabilities)]
+        word_pos = sentence_pos = title_pos = 0
+        for i in range(count):
+            parts = []
+            for length in lengths[sentence_pos:sentence_pos + sentences[i]]:
+                sentence = ' '.join(words[word_pos:word_pos + length])
+                parts.append(sentence[0].upper() + sentence[1:] + '.')
+                word_pos += length
+            sentence_pos += sentences[i]
+            title = ' '.join(titles[title_pos:title_pos + title_lengths[i]]).title()
+            title_pos += title_lengths[i]
+            yield {'id': start + i + 1, 'title': title, 'description': ' '.join(parts)}
+
+
+def synthetic_queries(n, seed=0, vocabulary=None):
+    # 1-4 word queries over the vocabulary below the stopwords, Zipf weighted like the corpus
+    vocabulary = vocabulary or synthetic_vocabulary(seed=seed)
+    content = vocabulary[len(_STOPWORDS):]
+    probabilities = _zipf_probabilities(len(content))
+    rng = np.random.default_rng(seed + 1)
+    return [' '.join(content[j] for j in rng.choice(len(content), rng.integers(1, 5), p=probabilities))
+            for _ in range(n)]
+
+
+class StubEmbedder:
+    # deterministic offline stand-in for the sentence transformer: signed feature hashing of the
+    # lowercased words into a dense vector of the model's size
+    def __init__(self, dimensions=STUB_DIMENSIONS):
+        self.dimensions = dimensions
+        self._features = {}
+
+    def _feature(self, word):
+        feature = self._features.get(word)
+        if feature is None:
+            digest = zlib.crc32(word.encode())
+            feature = self._features[word] = (digest % self.dimensions, 1. if digest & 1 << 31 else -1.)
+        return feature
+
+    def encode(self, texts, **kwargs):
+        vectors = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for word in re.findall(r'\w+', text.lower()):
+                column, sign = self._feature(word)
+                vectors[row, column] += sign
+        return vectors
+
+
+def peak_rss_mb():
+    import resource
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+def latency_stats(seconds):
+    latencies = np.asarray(seconds) * 1000
+    return {
+        'count': len(latencies),
+        'mean_ms': float(latencies.mean()),
+        'p50_ms': float(np.percentile(latencies, 50)),
+        'p95_ms': float(np.percentile(latencies, 95)),
+        'p99_ms': float(np.percentile(latencies, 99)),
+        'throughput_qps': len(latencies) / (latencies.sum() / 1000) if latencies.sum() else 0.,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def _time_queries(search, queries):
+    latencies = []
+    for query in queries:
+        started = time.perf_counter()
+        search(query)
+        latencies.append(time.perf_counter() - started)
+    return latency_stats(latencies)
+
+
+def _time_build(build, docs):
+    started = time.perf_counter()
+    build()
+    seconds = time.perf_counter() - started
+    return {'seconds': seconds, 'docs_per_sec': docs / seconds if seconds else 0., 'peak_rss_mb': peak_rss_mb()}
+
+
+def _run_scale(docs, queries, seed, embedder, workers):
+    # runs in a fresh process whose SEARCH_CACHE_PATH is a scratch directory, so nothing is shared
+    # with the real cache or another scale and peak RSS is this scale's own
+    from lib import components
+    from lib.hybrid_search import HybridSearch
+    from lib.keyword_search import InvertedIndex
+    from lib.semantic_search import ChunkedSemanticSearch
+
+    if embedder == 'stub':
+        components.provide('embedding_model', StubEmbedder())
+    vocabulary = synthetic_vocabulary(seed=seed)
+    query_texts = synthetic_queries(queries, seed, vocabulary)
+    phases = {}
+
+    idx = InvertedIndex()
+
+    def build_index():
+        idx.build(workers=workers, movies=synthetic_movies(docs, seed, vocabulary))
+        idx.save()
+
+    phases['build_index'] = _time_build(build_index, docs)
+    css = ChunkedSemanticSearch()
+    phases['build_embeddings'] = _time_build(
+        lambda: css.build_chunk_embeddings(synthetic_movies(docs, seed, vocabulary)), docs)
+    del idx, css
+
+    def load():
+        idx = InvertedIndex()
+        idx.load()
+        ChunkedSemanticSearch().load_chunk_embeddings(idx.docmap)
+
+    phases['load'] = _time_queries(lambda _: load(), range(BENCHMARK_LOADS))
+    hs = HybridSearch()
+    # one untimed query of each kind so lazy state (avg length, normalized matrices) is not timed
+    hs.idx.bm25_search(query_texts[0], BENCHMARK_LIMIT)
+    hs.rrf_search(query_texts[0], 60, BENCHMARK_LIMIT)
+    phases['bm25_search'] = _time_queries(lambda q: hs.idx.bm25_search(q, BENCHMARK_LIMIT), query_texts)
+    phases['search_chunks'] = _time_queries(lambda q: hs.semantic_search.search_chunks(q, BENCHMARK_LIMIT),
+                                            query_texts)
+    phases['weighted_search'] = _time_queries(lambda q: hs.weighted_search(q, 0.5, BENCHMARK_LIMIT), query_texts)
+    phases['rrf_search'] = _time_queries(lambda q: hs.rrf_search(q, 60, BENCHMARK_LIMIT), query_texts)
+    return {'docs': docs, 'chunks': len(hs.semantic_search.chunk_embeddings), 'phases': phases}
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(__file__)).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(scales=BENCHMARK_SCALES, queries=BENCHMARK_QUERIES, seed=0, embedder='stub', workers=1,
+                  output=None):
+    # every scale runs in its own spawned process with a scratch cache directory
+    results = {
+        'meta': {
+            'git_commit': _git_commit(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'queries': queries,
+            'seed': seed,
+            'embedder': embedder,
+            'workers': workers,
+        },
+        'scales': [],
+    }
+    for docs in scales:
+        scratch = tempfile.mkdtemp(prefix=f'bench-{docs}-')
+        previous = os.environ.get('SEARCH_CACHE_PATH')
+        os.environ['SEARCH_CACHE_PATH'] = scratch
+        try:
+            with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as pool:
+                scale = pool.submit(_run_scale, docs, queries, seed, embedder, workers).result()
+        finally:
+            if previous is None:
+                del os.environ['SEARCH_CACHE_PATH']
+            else:
+                os.environ['SEARCH_CACHE_PATH'] = previous
+            shutil.rmtree(scratch, ignore_errors=True)
+        results['scales'].append(scale)
+        print_scale(scale)
+        if output:
+            with open(output, mode='w') as f:
+                json.dump(results, f, indent=2)
+    return results
+
+
+def print_scale(scale):
+    print(f"{scale['docs']} docs, {scale['chunks']} chunks")
+    for name, phase in scale['phases'].items():
+        if 'seconds' in phase:
+            print(f"  {name:<18} {phase['seconds']:9.2f}s  {phase['docs_per_sec']:10.0f} docs/s  "
+                  f"peak {phase['peak_rss_mb']:.0f} MB")
+        else:
+            print(f"  {name:<18} p50 {phase['p50_ms']:8.2f}ms  p95 {phase['p95_ms']:8.2f}ms  "
+                  f"p99 {phase['p99_ms']:8.2f}ms  {phase['throughput_qps']:8.1f} q/s  peak {phase['peak_rss_mb']:.0f} MB")
+
+
+def compare_benchmarks(baseline_path, current_path, threshold=REGRESSION_THRESHOLD):
+    # ratios current / baseline per scale and phase; returns the regressions beyond threshold
+    with open(baseline_path) as f:
+        baseline = {scale['docs']: scale['phases'] for scale in json.load(f)['scales']}
+    with open(current_path) as f:
+        current = {scale['docs']: scale['phases'] for scale in json.load(f)['scales']}
+    regressions = []
+    for docs in sorted(baseline.keys() & current.keys()):
+        print(f"{docs} docs")
+        for name in [name for name in baseline[docs] if name in current[docs]]:
+            old, new = baseline[docs][name], current[docs][name]
+            metrics = ('seconds',) if 'seconds' in old else ('p50_ms', 'p95_ms')
+            for metric in metrics:
+                ratio = new[metric] / old[metric] if old[metric] else float('inf')
+                regressed = ratio > 1 + threshold
+                if regressed:
+                    regressions.append((docs, name, metric, ratio))
+                print(f"  {'REGRESSED' if regressed else 'ok':<9} {name:<18} {metric:<8} "
+                      f"{old[metric]:10.3f} -> {new[metric]:10.3f}  ({ratio:.2f}x)")
+    return regressions
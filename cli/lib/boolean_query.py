@@ -0,0 +1,206 @@
+import re
+
+import numpy as np
+
+from lib.postings import bitset_contains, bitset_range
+
+QUERY_OPERATORS = ('or', 'and')
+# doc positions in the first evaluation window, at least; windows then double until enough docs match
+MIN_WINDOW = 1024
+
+_QUERY_TOKENS = re.compile(r'"[^"]*"|\(|\)|[^\s()"]+')
+
+
+def parse_query(query, analyze, default_operator='or'):
+    # AND, OR, NOT (upper case), parentheses and "quoted phrases", NOT binding tightest, then AND, then
+    # OR; words next to each other are joined by default_operator, except that a NOT after an operand is
+    # always AND NOT ('a NOT b' never matches everything without b). Returns a tree of
+    # ('or'|'and', [children]), ('not', child), ('phrase', (tokens...)) and ('term', token) tuples, or
+    # None when only stopwords are left
+    if default_operator not in QUERY_OPERATORS:
+        raise ValueError(f"default operator must be one of {', '.join(QUERY_OPERATORS)}")
+    if query.count('"') % 2:
+        raise ValueError("unbalanced quotes in query")
+    tokens = _QUERY_TOKENS.findall(query)
+    pos = 0
+
+    def peek():
+        return tokens[pos] if pos < len(tokens) else None
+
+    def take():
+        nonlocal pos
+        pos += 1
+        return tokens[pos - 1]
+
+    def starts_operand():
+        return peek() is not None and peek() not in (')', 'AND', 'OR')
+
+    def parse_or():
+        children = [parse_and()]
+        while peek() == 'OR' or (default_operator == 'or' and starts_operand() and peek() != 'NOT'):
+            if peek() == 'OR':
+                take()
+            children.append(parse_and())
+        return _combine('or', children)
+
+    def parse_and():
+        children = [parse_not()]
+        while peek() in ('AND', 'NOT') or (default_operator == 'and' and starts_operand()):
+            if peek() == 'AND':
+                take()
+            children.append(parse_not())
+        return _combine('and', children)
+
+    def parse_not():
+        if peek() == 'NOT':
+            take()
+            child = parse_not()
+            return None if child is None else ('not', child)
+        return parse_primary()
+
+    def parse_primary():
+        token = peek()
+        if token is None or token in (')', 'AND', 'OR'):
+            raise ValueError(f"expected a term at {' '.join(tokens[pos:]) or 'the end of the query'!r}")
+        take()
+        if token == '(':
+            node = parse_or()
+            if peek() != ')':
+                raise ValueError("unbalanced parentheses in query")
+            take()
+            return node
+        if token.startswith('"'):
+            terms = analyze(token[1:-1])
+            if len(terms) > 1:
+                return 'phrase', tuple(terms)
+        else:
+            terms = analyze(token)
+        return _combine('and', [('term', term) for term in terms])
+
+    if not tokens:
+        return None
+    tree = parse_or()
+    if pos < len(tokens):
+        raise ValueError(f"unexpected {tokens[pos]!r} in query")
+    return tree
+
+
+def _combine(op, children):
+    # stopword-only operands drop out; a single operand needs no operator
+    children = [child for child in children if child is not None]
+    if not children:
+        return None
+    return children[0] if len(children) == 1 else (op, children)
+
+
+class _Term:
+    # a posting list as sorted doc positions, or as a packed bitset for dense terms
+    def __init__(self, positions, bits, df):
+        self.positions = positions
+        self.bits = bits
+        self.cost = df
+
+    def matches(self, start, stop):
+        if self.bits is not None:
+            return bitset_range(self.bits, start, stop)
+        positions = self.positions
+        return np.asarray(positions[np.searchsorted(positions, start):np.searchsorted(positions, stop)], dtype=np.int64)
+
+    def contains(self, candidates, start, stop):
+        if self.bits is not None:
+            return bitset_contains(self.bits, candidates)
+        # skip to the window, then binary search each (sorted) candidate in what is left of the list
+        window = self.positions[np.searchsorted(self.positions, start):np.searchsorted(self.positions, stop)]
+        if not len(window):
+            return np.zeros(len(candidates), dtype=bool)
+        idx = np.minimum(np.searchsorted(window, candidates), len(window) - 1)
+        return window[idx] == candidates
+
+
+class _Not:
+    def __init__(self, child, num_docs):
+        self.child = child
+        self.cost = num_docs - child.cost
+
+    def matches(self, start, stop):
+        candidates = np.arange(start, stop)
+        return candidates[~self.child.contains(candidates, start, stop)]
+
+    def contains(self, candidates, start, stop):
+        return ~self.child.contains(candidates, start, stop)
+
+
+class _And:
+    def __init__(self, children, num_docs):
+        # the rarest positive operand drives, every other one only filters its matches
+        positive = sorted((child for child in children if not isinstance(child, _Not)), key=lambda child: child.cost)
+        self.driver = positive[0] if positive else None
+        self.filters = positive[1:] + [child for child in children if isinstance(child, _Not)]
+        self.cost = self.driver.cost if self.driver is not None else num_docs
+
+    def matches(self, start, stop):
+        candidates = self.driver.matches(start, stop) if self.driver is not None else np.arange(start, stop)
+        for child in self.filters:
+            if not len(candidates):
+                break
+            candidates = candidates[child.contains(candidates, start, stop)]
+        return candidates
+
+    def contains(self, candidates, start, stop):
+        mask = np.ones(len(candidates), dtype=bool)
+        for child in ([self.driver] if self.driver is not None else []) + self.filters:
+            mask[mask] = child.contains(candidates[mask], start, stop)
+        return mask
+
+
+class _Or:
+    def __init__(self, children, num_docs):
+        self.children = children
+        self.cost = min(sum(child.cost for child in children), num_docs)
+
+    def matches(self, start, stop):
+        matches = [child.matches(start, stop) for child in self.children]
+        return np.unique(np.concatenate(matches))
+
+    def contains(self, candidates, start, stop):
+        mask = np.zeros(len(candidates), dtype=bool)
+        for child in self.children:
+            mask[~mask] = child.contains(candidates[~mask], start, stop)
+        return mask
+
+
+def compile_query(tree, doc_set, num_docs, phrase_set=None):
+    # doc_set(token) and phrase_set(tokens) -> (sorted positions or None, packed bitset or None, df);
+    # phrases need phrase_set, i.e. a positional index
+    match tree:
+        case ('term', token):
+            return _Term(*doc_set(token))
+        case ('phrase', tokens):
+            if phrase_set is None:
+                raise ValueError("phrase queries need a positional index, build it with --positional")
+            return _Term(*phrase_set(tokens))
+        case ('not', child):
+            return _Not(compile_query(child, doc_set, num_docs, phrase_set), num_docs)
+        case ('and', children):
+            return _And([compile_query(child, doc_set, num_docs, phrase_set) for child in children], num_docs)
+        case ('or', children):
+            return _Or([compile_query(child, doc_set, num_docs, phrase_set) for child in children], num_docs)
+    raise ValueError(f"unknown query node {tree!r}")
+
+
+def evaluate(node, num_docs, limit=None):
+    # the first limit matching doc positions in index order. The index is evaluated in windows sized
+    # from the estimated match rate and doubled each round, so a query stops reading postings once
+    # limit docs matched
+    if limit is None:
+        return node.matches(0, num_docs)
+    found, total = [], 0
+    start = 0
+    size = max(MIN_WINDOW, limit * num_docs // max(node.cost, 1))
+    while start < num_docs and total < limit:
+        stop = min(start + size, num_docs)
+        hits = node.matches(start, stop)[:limit - total]
+        found.append(hits)
+        total += len(hits)
+        start, size = stop, size * 2
+    return np.concatenate(found) if found else np.zeros(0, dtype=np.int64)
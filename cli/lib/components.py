@@ -0,0 +1,38 @@
+import threading
+
+# expensive shared objects (models, API clients, caches) by name; a factory only runs on the first
+# get() of its name, so importing a module or constructing a search object never loads any of them
+_factories = {}
+_instances = {}
+_lock = threading.RLock()
+
+
+def register(name, factory):
+    _factories[name] = factory
+
+
+def get(name):
+    instance = _instances.get(name)
+    if instance is None:
+        with _lock:
+            if name not in _instances:
+                if name not in _factories:
+                    raise ValueError(f"unknown component {name!r}, registered: {', '.join(sorted(_factories))}")
+                _instances[name] = _factories[name]()
+            instance = _instances[name]
+    return instance
+
+
+def provide(name, instance):
+    # use instance for name from now on, e.g. a fake client
+    with _lock:
+        _instances[name] = instance
+
+
+def warm(*names):
+    for name in names:
+        get(name)
+
+
+def loaded():
+    return sorted(_instances)
@@ -0,0 +1,35 @@
+import numpy as np
+
+from lib.search_utils import CACHE_PATH
+from lib.two_tier_cache import TwoTierCache
+
+QUERY_CACHE_SIZE = 10_000
+QUERY_DISK_CACHE_SIZE = 1_000_000
+
+
+def normalize_query(text):
+    # the MiniLM tokenizer lowercases and splits on whitespace, so this never changes the embedding
+    return ' '.join(text.lower().split())
+
+
+class EmbeddingCache(TwoTierCache):
+    # query text -> embedding for one model: an in-process LRU in front of a sqlite store under
+    # CACHE_PATH that survives restarts; both tiers are bounded and evict least recently used first
+    counter = 'query_embedding_cache'
+
+    def __init__(self, model_name, size=QUERY_CACHE_SIZE, disk_size=QUERY_DISK_CACHE_SIZE, path=None):
+        super().__init__(size, disk_size, path or CACHE_PATH / 'query_embeddings.sqlite')
+        self.model_name = model_name
+
+    def dump(self, vector):
+        return np.asarray(vector, dtype=np.float32).tobytes()
+
+    def load(self, stored):
+        # a read-only view of the cached bytes, shared by every caller
+        return np.frombuffer(stored, dtype=np.float32)
+
+    def get(self, text):
+        return super().get(f'{self.model_name}:{normalize_query(text)}')
+
+    def put(self, text, vector):
+        super().put(f'{self.model_name}:{normalize_query(text)}', vector)
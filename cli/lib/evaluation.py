@@ -0,0 +1,188 @@
+import itertools
+import json
+import time
+
+import numpy as np
+
+from lib.hybrid_search import HybridSearch, rerank_results
+from lib.search_utils import json_default
+
+EVAL_METHODS = ('rrf', 'weighted', 'keyword', 'semantic')
+EVAL_OBJECTIVES = ('mrr', 'precision', 'recall')
+EVAL_LATENCIES = ('p50_ms', 'p95_ms', 'mean_ms')
+# fused results handed to a reranker per result kept, as the rrf command does
+RERANK_CANDIDATES = 5
+
+
+def load_golden(path, docmap):
+    # [(query, {relevant doc ids})] from a JSON file ({"test_cases": [...]} or a list) or JSON Lines;
+    # a case has a "query" and "relevant_ids", or "relevant_docs" titles resolved against docmap
+    with open(path, mode='r') as f:
+        text = f.read()
+    try:
+        data = json.loads(text)
+        cases = data.get('test_cases', [data]) if isinstance(data, dict) else data
+    except json.JSONDecodeError:
+        cases = [json.loads(line) for line in text.splitlines() if line.strip()]
+    ids_by_title = None
+    golden = []
+    for number, case in enumerate(cases, start=1):
+        if not isinstance(case, dict) or not isinstance(case.get('query'), str):
+            raise ValueError(f"{path}: case {number} has no 'query' string")
+        if 'relevant_ids' in case:
+            relevant = {int(doc_id) for doc_id in case['relevant_ids']}
+        elif 'relevant_docs' in case:
+            if ids_by_title is None:
+                ids_by_title = {}
+                for doc_id in docmap:
+                    ids_by_title.setdefault(docmap[doc_id]['title'], set()).add(doc_id)
+            missing = [title for title in case['relevant_docs'] if title not in ids_by_title]
+            if missing:
+                raise ValueError(f"{path}: case {number} names unknown titles: {', '.join(missing)}")
+            relevant = set().union(*(ids_by_title[title] for title in case['relevant_docs']))
+        else:
+            raise ValueError(f"{path}: case {number} needs 'relevant_ids' or 'relevant_docs'")
+        golden.append((case['query'], relevant))
+    return golden
+
+
+def precision_at_k(ranked_ids, relevant, k):
+    return len(set(ranked_ids[:k]) & relevant) / k if k else 0.
+
+
+def recall_at_k(ranked_ids, relevant, k):
+    return len(set(ranked_ids[:k]) & relevant) / len(relevant) if relevant else 0.
+
+
+def reciprocal_rank(ranked_ids, relevant):
+    for rank, doc_id in enumerate(ranked_ids, start=1):
+        if doc_id in relevant:
+            return 1 / rank
+    return 0.
+
+
+def sweep_configs(methods=('rrf',), limits=(5,), ks=(60,), alphas=(0.5,), depths=(None,), k1s=(None,), bs=(None,),
+                  nprobes=(0,), reranks=(None,), rerank_tops=(None,)):
+    # the grid of configurations, leaving out parameters a method ignores so no configuration repeats
+    seen = set()
+    for method, limit, k, alpha, depth, k1, b, nprobe, rerank, rerank_top in itertools.product(
+            methods, limits, ks, alphas, depths, k1s, bs, nprobes, reranks, rerank_tops):
+        config = {
+            'method': method,
+            'limit': limit,
+            'k': k if method == 'rrf' else None,
+            'alpha': alpha if method == 'weighted' else None,
+            'depth': depth if method in ('rrf', 'weighted') else None,
+            'k1': k1 if method != 'semantic' else None,
+            'b': b if method != 'semantic' else None,
+            'nprobe': nprobe if method != 'keyword' else 0,
+            'rerank': rerank,
+            'rerank_top': rerank_top if rerank == 'cross-encoder' else None,
+        }
+        key = tuple(config.values())
+        if key not in seen:
+            seen.add(key)
+            yield config
+
+
+def _apply_config(hs, config, defaults):
+    hs.k1 = defaults['k1'] if config['k1'] is None else config['k1']
+    hs.b = defaults['b'] if config['b'] is None else config['b']
+    hs.max_depth = defaults['max_depth'] if config['depth'] is None else config['depth']
+    if config['nprobe']:
+        if hs.semantic_search.ann_index is None:
+            hs.semantic_search.enable_ann(config['nprobe'])
+        hs.semantic_search.ann_nprobe = config['nprobe']
+    else:
+        hs.semantic_search.disable_ann()
+
+
+def _ranked_ids(hs, query, config, rerank=True):
+    limit = config['limit']
+    fetch = limit * RERANK_CANDIDATES if config['rerank'] else limit
+    match config['method']:
+        case 'rrf':
+            results = hs.rrf_search(query, config['k'], fetch)
+        case 'weighted':
+            results = hs.weighted_search(query, config['alpha'], fetch)
+        case 'keyword':
+            results = hs.idx.bm25_search(query, fetch, hs.k1, hs.b)
+        case 'semantic':
+            results = [{**result, 'doc_id': result['id']} for result in hs.semantic_search.search_chunks(query, fetch)]
+        case method:
+            raise ValueError(f"unknown method {method!r}, expected one of {', '.join(EVAL_METHODS)}")
+    if rerank and config['rerank']:
+        results = rerank_results(query, results, config['rerank'], config['rerank_top'])
+    return [result['doc_id'] for result in results[:limit]]
+
+
+def evaluate_config(hs, golden, config, defaults):
+    # quality and latency of one configuration; an untimed pass without reranking first warms the
+    # per-configuration state (term scores for new bm25 parameters, the ANN index) so it is not timed
+    _apply_config(hs, config, defaults)
+    for query, _ in golden:
+        _ranked_ids(hs, query, config, rerank=False)
+    latencies, precisions, recalls, reciprocal_ranks = [], [], [], []
+    for query, relevant in golden:
+        started = time.perf_counter()
+        ranked_ids = _ranked_ids(hs, query, config)
+        latencies.append(time.perf_counter() - started)
+        precisions.append(precision_at_k(ranked_ids, relevant, config['limit']))
+        recalls.append(recall_at_k(ranked_ids, relevant, config['limit']))
+        reciprocal_ranks.append(reciprocal_rank(ranked_ids, relevant))
+    latencies = np.asarray(latencies) * 1000
+    return {
+        **config,
+        'precision': float(np.mean(precisions)),
+        'recall': float(np.mean(recalls)),
+        'mrr': float(np.mean(reciprocal_ranks)),
+        'p50_ms': float(np.percentile(latencies, 50)),
+        'p95_ms': float(np.percentile(latencies, 95)),
+        'mean_ms': float(latencies.mean()),
+    }
+
+
+def pareto_frontier(rows, objective='mrr', latency='p50_ms'):
+    # rows no other row beats on both objective (higher) and latency (lower), fastest first
+    frontier = []
+    best = -1.
+    for row in sorted(rows, key=lambda row: (row[latency], -row[objective])):
+        if row[objective] > best:
+            frontier.append(row)
+            best = row[objective]
+    return frontier
+
+
+def _describe(config):
+    return ' '.join(f"{name}={value}" for name, value in config.items()
+                    if name in ('method', 'limit', 'k', 'alpha', 'depth', 'k1', 'b', 'nprobe', 'rerank', 'rerank_top')
+                    and value is not None and not (name == 'nprobe' and not value))
+
+
+def sweep(golden_path, configs, objective='mrr', latency='p50_ms', output=None):
+    # every configuration against one loaded HybridSearch; golden queries are embedded once up front
+    if objective not in EVAL_OBJECTIVES:
+        raise ValueError(f"objective must be one of {', '.join(EVAL_OBJECTIVES)}")
+    if latency not in EVAL_LATENCIES:
+        raise ValueError(f"latency must be one of {', '.join(EVAL_LATENCIES)}")
+    hs = HybridSearch()
+    defaults = {'k1': hs.k1, 'b': hs.b, 'max_depth': hs.max_depth}
+    golden = load_golden(golden_path, hs.idx.docmap)
+    if not golden:
+        raise ValueError(f"{golden_path} has no test cases")
+    hs.semantic_search.generate_embeddings_many([query for query, _ in golden])
+    rows = []
+    for config in configs:
+        row = evaluate_config(hs, golden, config, defaults)
+        rows.append(row)
+        print(f"{objective} {row[objective]:.4f}  P@k {row['precision']:.4f}  R@k {row['recall']:.4f}  "
+              f"{latency} {row[latency]:8.2f}  {_describe(config)}")
+    frontier = pareto_frontier(rows, objective, latency)
+    print(f"\nPareto frontier ({objective} vs {latency}):")
+    for row in frontier:
+        print(f"  {objective} {row[objective]:.4f}  {latency} {row[latency]:8.2f}  {_describe(row)}")
+    if output:
+        with open(output, mode='w') as f:
+            json.dump({'golden': str(golden_path), 'queries': len(golden), 'objective': objective, 'latency': latency,
+                       'results': rows, 'frontier': frontier}, f, indent=2, default=json_default)
+    return rows, frontier
@@ -1,45 +1,84 @@
-import os
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy as np
+
+from lib import tracing
+from lib.batch_search import QUERY_BATCH_SIZE, run_batch
+from lib.embedding_cache import normalize_query
+from lib.index_format import HEADER_FILE
 from lib.llm import correct_spellings, rewrite_query, expand_query
 from lib.rerank import individual_rerank, batch_rerank, cross_encoder_rerank
-from lib.search_utils import load_movies
+from lib.result_cache import ResultCache, RESULT_DISK_CACHE_SIZE, data_version
+from lib.search_utils import iter_movies, BM25_K1, BM25_B
+from lib.spelling import correct_spelling
 from .keyword_search import InvertedIndex
 from .semantic_search import ChunkedSemanticSearch
 
 
-def rrf_search(query, k=60, limit=5, enhance=None, rerank_method=None):
-    movies = load_movies()
-    hs = HybridSearch(movies)
-
-    match enhance:
-        case 'spell':
-            new_query = correct_spellings(query)
-            print(f"original query {query}->enhanced query: {new_query}")
-            query = new_query
-        case 'rewrite':
-            new_query = rewrite_query(query)
-            print(f"original query {query}->enhanced query: {new_query}")
-            query = new_query
-        case 'expand':
-            new_query = expand_query(query)
-            print(f"original query {query}->enhanced query: {new_query}")
-            query = new_query
-
-    rrf_limit = limit * 5 if rerank_method else 5
-    results = hs.rrf_search(query, k=k, limit=rrf_limit)
-    match rerank_method:
-        case "individual":
-            results = individual_rerank(query, results)
-            print(f"reranking top{limit} using individual method")
-        case "batch":
-            results = batch_rerank(query, results)
-            print(f"reranking top{limit} using batch rerank method")
-        case "cross-encoder":
-            results = cross_encoder_rerank(query, results)
-            print(f"reranking top{limit} using cross-encoder rerank method")
-        case _:
-            pass
+# candidates asked of each retriever: rrf starts at FUSION_START_DEPTH per result (at least
+# FUSION_MIN_DEPTH) and grows by FUSION_DEPTH_GROWTH up to HybridSearch.max_depth (default
+# FUSION_MAX_DEPTH) per result
+FUSION_START_DEPTH = 10
+FUSION_MIN_DEPTH = 50
+FUSION_DEPTH_GROWTH = 4
+FUSION_MAX_DEPTH = 500
+
+RERANK_LABELS = {
+    "individual": "individual method",
+    "batch": "batch rerank method",
+    "cross-encoder": "cross-encoder rerank method",
+}
+
+
+def enhance_query(query, enhance=None):
+    with tracing.span('hybrid.enhance'):
+        match enhance:
+            case 'spell':
+                return correct_spelling(query, fallback=correct_spellings)
+            case 'rewrite':
+                return rewrite_query(query)
+            case 'expand':
+                return expand_query(query)
+        return query
+
+
+def rerank_results(query, results, rerank_method=None, rerank_top=None):
+    # rerank_top cascades the cross-encoder over only the best rerank_top fused results
+    if rerank_method not in RERANK_LABELS:
+        return results
+    with tracing.span(f'rerank.{rerank_method}'):
+        match rerank_method:
+            case "individual":
+                return individual_rerank(query, results)
+            case "batch":
+                return batch_rerank(query, results)
+            case "cross-encoder":
+                return cross_encoder_rerank(query, results, rerank_top)
+
+
+def result_cache(disk=False):
+    # an in-process LRU, plus the sqlite tier when disk so one-shot commands share results across runs
+    return ResultCache(disk_size=RESULT_DISK_CACHE_SIZE if disk else 0)
+
+
+def rrf_search(query, k=60, limit=5, enhance=None, rerank_method=None, nprobe=None, rerank_top=None, sharded=False,
+               disk_cache=False):
+    hs = HybridSearch(nprobe=nprobe, sharded=sharded, result_cache=result_cache(disk_cache))
+    response = hs.rrf_query(query, k, limit, enhance, rerank_method, rerank_top)
+    if enhance:
+        print(f"original query {query}->enhanced query: {response['query']}")
+    if rerank_method in RERANK_LABELS:
+        print(f"reranking top{limit} using {RERANK_LABELS[rerank_method]}")
+
+    print_rrf_results(response['results'], rrf_limit(limit, rerank_method), rerank_method)
 
+
+def rrf_limit(limit, rerank_method=None):
+    # fused results kept for printing: limit * 5 when they are reranked, else 5
+    return limit * 5 if rerank_method else 5
+
+
+def print_rrf_results(results, rrf_limit, rerank_method=None):
     for idx, result in enumerate(results[:rrf_limit], start=1):
         print(f'{idx}: {result['title']}')
         print(f"RRF SCORE:, {result['rrf_score']}")
@@ -49,44 +88,187 @@ def rrf_search(query, k=60, limit=5, enhance=None, rerank_method=None):
         print(result['description'][:100])
 
 
-def weighted_search(query, alpha=0.5, limit=5):
-    movies = load_movies()
-    hs = HybridSearch(movies)
-    results = hs.weighted_search(query, alpha, limit)
+def weighted_search(query, alpha=0.5, limit=5, nprobe=None, sharded=False, disk_cache=False):
+    hs = HybridSearch(nprobe=nprobe, sharded=sharded, result_cache=result_cache(disk_cache))
+    print_weighted_results(hs.weighted_query(query, alpha, limit)['results'], limit)
+
+
+def print_weighted_results(results, limit):
     for idx, result in enumerate(results[:limit]):
         print(f'{idx + 1}: {result['title']}')
         print(f"Hybrid score:, {result['hybrid_score']}")
         print(f"BM25 score:, {result['bm25_score']}, Semantic score: {result['sem_score']} ")
         print(result['description'][:100])
 
+
+def batch_command(source='-', output='-', method='rrf', limit=5, k=60, alpha=0.5, nprobe=None,
+                  batch_size=QUERY_BATCH_SIZE, sharded=False):
+    hs = HybridSearch(nprobe=nprobe, sharded=sharded)
+    match method:
+        case 'rrf':
+            return run_batch(lambda queries: hs.rrf_search_many(queries, k, limit), source, output, batch_size)
+        case 'weighted':
+            return run_batch(lambda queries: hs.weighted_search_many(queries, alpha, limit), source, output, batch_size)
+    raise ValueError(f"unknown batch method {method!r}, expected rrf or weighted")
+
+
 class HybridSearch:
-    def __init__(self, documents):
+    def __init__(self, documents=None, nprobe=None, storage='float32', sharded=False, result_cache=None):
+        # without documents everything comes from the saved index and embeddings, and the corpus is
+        # only streamed for whatever has not been built yet. sharded searches the saved shards in
+        # one worker process each instead, see lib/sharded_search
         self.documents = documents
-        self.semantic_search = ChunkedSemanticSearch()
-        self.semantic_search.load_or_create_chunk_embeddings(documents)
+        self.shards = None
+        if sharded:
+            if documents is not None:
+                raise ValueError("a sharded search reads the saved shards, it takes no documents")
+            from lib.sharded_search import ShardPool, ShardedIndex, ShardedChunkSearch
+
+            self.shards = ShardPool(storage=storage, nprobe=nprobe)
+            self.idx = ShardedIndex(self.shards)
+            self.semantic_search = ShardedChunkSearch(self.shards)
+            self.version = data_version(self.shards.header_path)
+        else:
+            self.idx = InvertedIndex()
+            if self.idx.exists():
+                self.idx.load()
+            else:
+                self.idx.build(movies=documents)
+                self.idx.save()
+
+            self.semantic_search = ChunkedSemanticSearch(storage)
+            if documents is not None:
+                self.semantic_search.load_or_create_chunk_embeddings(documents)
+            elif not self.semantic_search.load_chunk_embeddings(self.idx.docmap):
+                self.semantic_search.build_chunk_embeddings(iter_movies())
+            if nprobe:
+                self.semantic_search.enable_ann(nprobe)
+            self.version = data_version(self.idx.columnar_path / HEADER_FILE, self.semantic_search.embeddings_path,
+                                        self.semantic_search.metadata_path, self.semantic_search.ann_path)
+        self.nprobe = nprobe
+        # whole responses of rrf_query() and weighted_query(), keyed on everything that shapes them
+        # including self.version, which changes when the index or embeddings are rebuilt
+        self.result_cache = result_cache if result_cache is not None else ResultCache()
+        # tunables, e.g. swept by the evaluation tool: bm25 parameters and candidates per result
+        self.k1 = BM25_K1
+        self.b = BM25_B
+        self.max_depth = FUSION_MAX_DEPTH
+        self._pool = None
+
+    def _retrieve(self, queries, depth):
+        # both retrievers at once: bm25 on a worker thread, the chunk search (whose embedding model
+        # and matmul release the GIL) on this one; (ids, scores) arrays per retriever and query
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='bm25')
+        with tracing.span('hybrid.retrieve'):
+            bm25 = self._pool.submit(self._bm25_ranked_many, queries, depth)
+            if len(queries) == 1:
+                sem = [self.semantic_search.search_chunks_ranked(queries[0], depth)]
+            else:
+                sem = self.semantic_search.search_chunks_ranked_many(queries, depth)
+            return list(zip(bm25.result(), sem))
 
-        self.idx = InvertedIndex()
-        if not os.path.exists(self.idx.index_path):
-            self.idx.build()
-            self.idx.save()
+    def _bm25_ranked_many(self, queries, depth):
+        return self.idx.bm25_ranked_many(queries, depth, self.k1, self.b)
 
-    def _bm25_search(self, query, limit):
-        self.idx.load()
-        return self.idx.bm25_search(query, limit)
+    def _cache_key(self, method, query, *params):
+        # queries differing only in case or spacing share an entry, both retrievers lowercase anyway
+        return [method, normalize_query(query), *params, self.k1, self.b, self.max_depth,
+                self.semantic_search.storage, self.nprobe, self.version]
+
+    def rrf_query(self, query, k=60, limit=5, enhance=None, rerank_method=None, rerank_top=None):
+        # {'query': the enhanced query, 'results': fused and reranked results}, as the rrf command and
+        # the server return them; a cached response skips enhancement, both retrievers and the reranker
+        key = self._cache_key('rrf', query, k, limit, enhance, rerank_method, rerank_top)
+        response = self.result_cache.get(key)
+        if response is None:
+            if enhance:
+                query = enhance_query(query, enhance)
+            results = self.rrf_search(query, k=k, limit=rrf_limit(limit, rerank_method))
+            response = {'query': query, 'results': rerank_results(query, results, rerank_method, rerank_top)}
+            self.result_cache.put(key, response)
+        return response
+
+    def weighted_query(self, query, alpha=0.5, limit=5):
+        key = self._cache_key('weighted', query, alpha, limit)
+        response = self.result_cache.get(key)
+        if response is None:
+            response = {'query': query, 'results': self.weighted_search(query, alpha, limit)[:limit]}
+            self.result_cache.put(key, response)
+        return response
 
     def weighted_search(self, query, alpha, limit=5):
-        bm25_results = self._bm25_search(query, limit * 500)
-        sem_results = self.semantic_search.search_chunks(query, limit * 500)
-        combined_results = combine_search_results(bm25_results, sem_results, alpha)
-        return combined_results
+        return self.weighted_search_many([query], alpha, limit)[0]
 
+    def weighted_search_many(self, queries, alpha, limit=5):
+        # min-max normalisation runs over the whole candidate lists, so their depth cannot adapt
+        results = []
+        for (bm25_ids, bm25_scores), (sem_ids, sem_scores) in self._retrieve(queries, limit * self.max_depth):
+            with tracing.span('hybrid.fusion'):
+                fused = weighted_fuse(bm25_ids, bm25_scores, sem_ids, sem_scores, alpha)
+            with tracing.span('hybrid.format'):
+                results.append(self._format_weighted(fused, limit))
+        return results
 
     def rrf_search(self, query, k, limit=10):
-        bm25_results = self._bm25_search(query, limit * 500)
-        sem_results = self.semantic_search.search_chunks(query, limit * 500)
-        combined_results = rrf_combine_search_results(bm25_results, sem_results, k, limit)
-        return combined_results[:limit]
+        return self.rrf_search_many([query], k, limit)[0]
+
+    def rrf_search_many(self, queries, k, limit=10):
+        # the candidate depth starts small and grows only for queries where a doc outside the retrieved
+        # prefixes could still reach the fused top limit; the top is then the one the full
+        # limit * max_depth gives
+        max_depth = limit * self.max_depth
+        depth = max_depth
+        if self.semantic_search.storage == 'float32':
+            # quantized storage rescores a shortlist sized by the depth, so only the full one is exact
+            depth = min(max(limit * FUSION_START_DEPTH, FUSION_MIN_DEPTH), max_depth)
+        fused = [None] * len(queries)
+        pending = list(range(len(queries)))
+        while pending:
+            retrieved = self._retrieve([queries[i] for i in pending], depth)
+            tracing.count('hybrid.rrf_rounds')
+            unstable = []
+            with tracing.span('hybrid.fusion'):
+                for i, ((bm25_ids, _), (sem_ids, _)) in zip(pending, retrieved):
+                    fused[i] = rrf_fuse(bm25_ids, sem_ids, k)
+                    if depth < max_depth and not rrf_is_stable(fused[i], bm25_ids, sem_ids, k, depth, limit):
+                        unstable.append(i)
+            pending = unstable
+            depth = min(depth * FUSION_DEPTH_GROWTH, max_depth)
+        with tracing.span('hybrid.format'):
+            return [self._format_rrf(f, k, limit) for f in fused]
 
+    def _format_weighted(self, fused, limit):
+        results = []
+        for i in fused['order'][:limit]:
+            doc = self.idx.docmap[int(fused['ids'][i])]
+            results.append({
+                'doc_id': doc['id'],
+                'bm25_score': fused['bm25_score'](i),
+                'sem_score': fused['sem_score'](i),
+                'title': doc['title'],
+                'description': doc['description'] if fused['in_bm25'][i] else doc['description'][:100],
+                'hybrid_score': fused['hybrid_score'](i),
+            })
+        return results
+
+    def _format_rrf(self, fused, k, limit):
+        results = []
+        for i in fused['order'][:limit]:
+            doc = self.idx.docmap[int(fused['ids'][i])]
+            bm25_rank = int(fused['bm25_ranks'][i]) or None
+            sem_rank = int(fused['sem_ranks'][i]) or None
+            results.append({
+                'doc_id': doc['id'],
+                'bm25_rank': bm25_rank,
+                'bm25_score': rrf_score(bm25_rank, k) if bm25_rank else None,
+                'sem_rank': sem_rank,
+                'sem_score': rrf_score(sem_rank, k) if sem_rank else None,
+                'title': doc['title'],
+                'description': doc['description'] if bm25_rank else doc['description'][:100],
+                'rrf_score': float(fused['scores'][i]),
+            })
+        return results
 
 
 def hybrid_score(bm25_score, sem_score, alpha=0.5):
@@ -168,6 +350,105 @@ def combine_search_results(bm25_results, sem_results, alpha=0.5):
     return results
 
 
+def _union_ranks(bm25_ids, sem_ids):
+    # ids of both lists in the order the dict based combiners insert them (bm25 hits, then
+    # semantic-only hits) with each id's 1-based rank per list, 0 where it is absent
+    order = np.argsort(sem_ids, kind='stable')
+    sem_rank_of_bm25 = np.zeros(len(bm25_ids), dtype=np.int64)
+    if len(sem_ids):
+        pos = np.minimum(np.searchsorted(sem_ids[order], bm25_ids), len(sem_ids) - 1)
+        found = sem_ids[order][pos] == bm25_ids
+        sem_rank_of_bm25[found] = order[pos[found]] + 1
+    sem_only = np.ones(len(sem_ids), dtype=bool)
+    sem_only[sem_rank_of_bm25[sem_rank_of_bm25 > 0] - 1] = False
+    ids = np.concatenate([bm25_ids, sem_ids[sem_only]]).astype(np.int64)
+    bm25_ranks = np.concatenate([np.arange(1, len(bm25_ids) + 1), np.zeros(sem_only.sum(), dtype=np.int64)])
+    sem_ranks = np.concatenate([sem_rank_of_bm25, np.flatnonzero(sem_only) + 1])
+    return ids, bm25_ranks, sem_ranks
+
+
+def rrf_fuse(bm25_ids, sem_ids, k):
+    # rrf_combine_search_results over id arrays: order is the fused ranking over ids
+    ids, bm25_ranks, sem_ranks = _union_ranks(bm25_ids, sem_ids)
+    both = (bm25_ranks > 0) & (sem_ranks > 0)
+    scores = np.zeros(len(ids))
+    scores[both] = 1 / (k + bm25_ranks[both]) + 1 / (k + sem_ranks[both])
+    return {
+        'ids': ids,
+        'bm25_ranks': bm25_ranks,
+        'sem_ranks': sem_ranks,
+        'scores': scores,
+        'order': np.argsort(-scores, kind='stable'),
+    }
+
+
+def rrf_is_stable(fused, bm25_ids, sem_ids, k, depth, limit):
+    # True when no doc outside the depth prefixes can score above the fused limit-th score; a list
+    # shorter than depth is complete, so docs missing from it never get that rank at any depth
+    top = fused['scores'][fused['order'][:limit]]
+    if len(top) < limit or top[-1] <= 0:
+        return len(bm25_ids) < depth and len(sem_ids) < depth
+    bm25_complete, sem_complete = len(bm25_ids) < depth, len(sem_ids) < depth
+    bound = 0.
+    bm25_only = fused['bm25_ranks'][(fused['bm25_ranks'] > 0) & (fused['sem_ranks'] == 0)]
+    sem_only = fused['sem_ranks'][(fused['sem_ranks'] > 0) & (fused['bm25_ranks'] == 0)]
+    if len(bm25_only) and not sem_complete:
+        bound = max(bound, 1 / (k + bm25_only.min()) + 1 / (k + len(sem_ids) + 1))
+    if len(sem_only) and not bm25_complete:
+        bound = max(bound, 1 / (k + sem_only.min()) + 1 / (k + len(bm25_ids) + 1))
+    if not bm25_complete and not sem_complete:
+        bound = max(bound, 1 / (k + len(bm25_ids) + 1) + 1 / (k + len(sem_ids) + 1))
+    return top[-1] > bound
+
+
+def weighted_fuse(bm25_ids, bm25_scores, sem_ids, sem_scores, alpha=0.5):
+    # combine_search_results over id/score arrays with the same arithmetic: semantic scores are
+    # float32, so a doc with one is summed in float32 exactly as the scalar expression would be
+    ids, bm25_ranks, sem_ranks = _union_ranks(bm25_ids, sem_ids)
+    bm25_norm = normalize_score_array(bm25_scores)
+    sem_norm = normalize_score_array(sem_scores)
+    in_bm25, in_sem = bm25_ranks > 0, sem_ranks > 0
+    bm25_part = np.zeros(len(ids))
+    bm25_part[in_bm25] = alpha * bm25_norm[bm25_ranks[in_bm25] - 1]
+    sem_part = np.zeros(len(ids), dtype=sem_norm.dtype)
+    sem_part[in_sem] = (1 - alpha) * sem_norm[sem_ranks[in_sem] - 1]
+    scores = bm25_part + sem_part
+    float32_sum = in_sem & (sem_norm.dtype == np.float32)
+    scores[float32_sum] = bm25_part[float32_sum].astype(np.float32) + sem_part[float32_sum]
+
+    def bm25_score(i):
+        return float(bm25_norm[bm25_ranks[i] - 1]) if in_bm25[i] else 0
+
+    def sem_score(i):
+        return _score_value(sem_norm, sem_ranks[i] - 1) if in_sem[i] else 0
+
+    def hybrid_score(i):
+        return np.float32(scores[i]) if float32_sum[i] else float(scores[i])
+
+    return {
+        'ids': ids,
+        'in_bm25': in_bm25,
+        'order': np.argsort(-scores, kind='stable'),
+        'bm25_score': bm25_score,
+        'sem_score': sem_score,
+        'hybrid_score': hybrid_score,
+    }
+
+
+def _score_value(scores, i):
+    return scores[i] if scores.dtype == np.float32 else float(scores[i])
+
+
+def normalize_score_array(scores):
+    # normalize_scores over an array, keeping the dtype its scalar arithmetic has
+    if not len(scores):
+        return scores
+    min_score, max_score = scores.min(), scores.max()
+    if min_score == max_score:
+        return np.ones(len(scores))
+    return (scores - min_score) / (max_score - min_score)
+
+
 def normalized_search_results(results):
     scores = [r['score'] for r in results]
 
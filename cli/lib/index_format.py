@@ -0,0 +1,256 @@
+import json
+import os
+import statistics
+import threading
+from collections.abc import Mapping
+
+import numpy as np
+
+from lib.postings import BITSET, decode_postings, encode_posting_lists, encode_delta_runs, decode_delta_runs
+
+FORMAT_NAME = 'columnar-inverted-index'
+# version 2 compresses the doc positions of each posting list (see lib/postings); version 1 indexes,
+# which stored them as plain int32, are still read
+FORMAT_VERSION = 2
+READABLE_VERSIONS = (1, 2)
+HEADER_FILE = 'header.json'
+# term -> id lookups remembered per index, oldest dropped first; terms not in the index never are
+TERM_ID_CACHE_SIZE = 100_000
+
+
+def _save_array(path, name, array):
+    np.save(path / f'{name}.npy', array)
+
+
+def _load_array(path, name):
+    try:
+        return np.load(path / f'{name}.npy', mmap_mode='r')
+    except ValueError:
+        # zero-length arrays cannot be memory-mapped
+        return np.load(path / f'{name}.npy')
+
+
+def _encode_blob(items):
+    offsets = np.zeros(len(items) + 1, dtype=np.int64)
+    chunks = []
+    for i, item in enumerate(items):
+        chunks.append(item)
+        offsets[i + 1] = offsets[i] + len(item)
+    return np.frombuffer(b''.join(chunks), dtype=np.uint8), offsets
+
+
+def write_columnar_index(path, docmap, index, term_frequencies, doc_lengths, token_offsets=None):
+    # layout, all arrays positional over docs in docmap order:
+    #   terms/term_offsets             sorted utf-8 term dictionary
+    #   postings_offsets/postings_data per-term byte ranges of the encoded doc positions
+    #   postings_kinds                 per-term encoding, varbyte gaps or a bitset over all docs
+    #   tfs_offsets/postings_tfs       CSR row pointers and term frequencies, one row per term
+    #   positional/positional_offsets  optional, per-term byte ranges of where each posting's term
+    #                                  occurs in its doc, tf token offsets per posting as varbyte gaps
+    #   doc_ids/doc_lengths            per-doc external id and token count
+    #   sorted_doc_ids/sorted_doc_pos  doc id -> position lookup
+    #   docs/doc_offsets               json encoded documents
+    os.makedirs(path, exist_ok=True)
+    doc_ids = list(docmap)
+    positions = {doc_id: pos for pos, doc_id in enumerate(doc_ids)}
+
+    terms = sorted((term for term, docs in index.items() if docs), key=lambda term: term.encode())
+    tfs_offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+    postings_docs, postings_tfs, postings_token_offsets = [], [], []
+    for i, term in enumerate(terms):
+        term_positions = sorted(positions[doc_id] for doc_id in index[term])
+        postings_docs.extend(term_positions)
+        postings_tfs.extend(term_frequencies[doc_ids[pos]][term] for pos in term_positions)
+        if token_offsets is not None:
+            for pos in term_positions:
+                postings_token_offsets.extend(token_offsets[doc_ids[pos]][term])
+        tfs_offsets[i + 1] = len(postings_docs)
+    postings_kinds, postings_data, postings_offsets = encode_posting_lists(postings_docs, tfs_offsets, len(doc_ids))
+    # term frequencies are small, store them in the narrowest unsigned type that holds them all
+    tfs_dtype = np.min_scalar_type(max(postings_tfs, default=0))
+
+    terms_blob, term_offsets = _encode_blob([term.encode() for term in terms])
+    docs_blob, doc_offsets = _encode_blob([json.dumps(docmap[doc_id]).encode() for doc_id in doc_ids])
+    doc_ids_array = np.asarray(doc_ids, dtype=np.int64)
+    sorted_doc_pos = np.argsort(doc_ids_array, kind='stable')
+
+    _save_array(path, 'terms', terms_blob)
+    _save_array(path, 'term_offsets', term_offsets)
+    _save_array(path, 'postings_offsets', postings_offsets)
+    _save_array(path, 'postings_kinds', postings_kinds)
+    _save_array(path, 'postings_data', postings_data)
+    _save_array(path, 'tfs_offsets', tfs_offsets)
+    _save_array(path, 'postings_tfs', np.asarray(postings_tfs, dtype=tfs_dtype))
+    _save_array(path, 'doc_ids', doc_ids_array)
+    _save_array(path, 'doc_lengths', np.asarray([doc_lengths[doc_id] for doc_id in doc_ids], dtype=np.int32))
+    _save_array(path, 'sorted_doc_ids', doc_ids_array[sorted_doc_pos])
+    _save_array(path, 'sorted_doc_pos', sorted_doc_pos.astype(np.int64))
+    if token_offsets is not None:
+        positional, run_offsets = encode_delta_runs(postings_token_offsets, postings_tfs)
+        _save_array(path, 'positional', positional)
+        _save_array(path, 'positional_offsets', run_offsets[tfs_offsets])
+    _save_array(path, 'docs', docs_blob)
+    _save_array(path, 'doc_offsets', doc_offsets)
+
+    # the header goes last so a half-written index is never picked up as valid
+    header = {
+        'format': FORMAT_NAME,
+        'version': FORMAT_VERSION,
+        'num_docs': len(doc_ids),
+        'num_terms': len(terms),
+        'num_postings': len(postings_tfs),
+        'postings_bytes': int(postings_offsets[-1]),
+        'positional': token_offsets is not None,
+        'avg_doc_length': statistics.mean(doc_lengths.values()) if doc_lengths else 0,
+    }
+    with open(path / HEADER_FILE, mode='w') as f:
+        json.dump(header, f)
+
+
+def read_header(path):
+    with open(path / HEADER_FILE, mode='r') as f:
+        header = json.load(f)
+    if header.get('format') != FORMAT_NAME:
+        raise ValueError(f"{path} is not a {FORMAT_NAME}")
+    if header.get('version') not in READABLE_VERSIONS:
+        raise ValueError(f"unsupported index version {header.get('version')} in {path}, expected {FORMAT_VERSION}")
+    return header
+
+
+class ColumnarIndex:
+    def __init__(self, path):
+        self.path = path
+        self.header = read_header(path)
+        self.num_docs = self.header['num_docs']
+        self.num_terms = self.header['num_terms']
+        self.avg_doc_length = self.header['avg_doc_length']
+        self._terms = _load_array(path, 'terms')
+        self._term_offsets = _load_array(path, 'term_offsets')
+        self._postings_offsets = _load_array(path, 'postings_offsets')
+        if self.header['version'] == 1:
+            self._postings_kinds = None
+            self._postings_docs = _load_array(path, 'postings_docs')
+            self._tfs_offsets = self._postings_offsets
+        else:
+            self._postings_kinds = _load_array(path, 'postings_kinds')
+            self._postings_data = _load_array(path, 'postings_data')
+            self._tfs_offsets = _load_array(path, 'tfs_offsets')
+        self._postings_tfs = _load_array(path, 'postings_tfs')
+        self.positional = self.header.get('positional', False)
+        if self.positional:
+            self._positional = _load_array(path, 'positional')
+            self._positional_offsets = _load_array(path, 'positional_offsets')
+        self.doc_ids = _load_array(path, 'doc_ids')
+        self.doc_lengths = _load_array(path, 'doc_lengths')
+        self._sorted_doc_ids = _load_array(path, 'sorted_doc_ids')
+        self._sorted_doc_pos = _load_array(path, 'sorted_doc_pos')
+        self._docs = _load_array(path, 'docs')
+        self._doc_offsets = _load_array(path, 'doc_offsets')
+        # indexed terms that were actually looked up, insertion ordered so the oldest is evicted first
+        self._term_ids = {}
+        self._term_ids_lock = threading.Lock()
+
+    def _term_at(self, term_id):
+        return self._terms[self._term_offsets[term_id]:self._term_offsets[term_id + 1]].tobytes()
+
+    def term_id(self, term):
+        term_id = self._term_ids.get(term)
+        if term_id is None:
+            key = term.encode()
+            lo, hi = 0, self.num_terms
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if self._term_at(mid) < key:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            if lo == self.num_terms or self._term_at(lo) != key:
+                # misses stay uncached, or every unknown query word would grow the dict
+                return -1
+            term_id = lo
+            with self._term_ids_lock:
+                if len(self._term_ids) >= TERM_ID_CACHE_SIZE:
+                    del self._term_ids[next(iter(self._term_ids))]
+                self._term_ids[term] = term_id
+        return term_id
+
+    def terms(self):
+        for term_id in range(self.num_terms):
+            yield self._term_at(term_id).decode()
+
+    def df(self, term):
+        term_id = self.term_id(term)
+        if term_id < 0:
+            return 0
+        return int(self._tfs_offsets[term_id + 1] - self._tfs_offsets[term_id])
+
+    def dfs(self):
+        # df of every term, in term id order
+        return np.diff(self._tfs_offsets)
+
+    def _positions(self, term_id):
+        start, end = self._postings_offsets[term_id], self._postings_offsets[term_id + 1]
+        if self._postings_kinds is None:
+            return self._postings_docs[start:end]
+        return decode_postings(self._postings_kinds[term_id], self._postings_data[start:end])
+
+    def _tfs(self, term_id):
+        return self._postings_tfs[self._tfs_offsets[term_id]:self._tfs_offsets[term_id + 1]]
+
+    def postings(self, term):
+        # (sorted doc positions, tfs), decoded on every call
+        term_id = self.term_id(term)
+        if term_id < 0:
+            return np.zeros(0, dtype=np.int64), self._postings_tfs[:0]
+        return self._positions(term_id), self._tfs(term_id)
+
+    def bitset(self, term):
+        # the packed doc bitset of a term stored as one, read straight from the mapped file, else None
+        term_id = self.term_id(term)
+        if term_id < 0 or self._postings_kinds is None or self._postings_kinds[term_id] != BITSET:
+            return None
+        return self._postings_data[self._postings_offsets[term_id]:self._postings_offsets[term_id + 1]]
+
+    def token_offsets(self, term):
+        # where term occurs in each doc of its postings, the tf offsets of every posting back to back
+        term_id = self.term_id(term)
+        if term_id < 0:
+            return np.zeros(0, dtype=np.int64)
+        start, end = self._positional_offsets[term_id], self._positional_offsets[term_id + 1]
+        return decode_delta_runs(self._positional[start:end], self._tfs(term_id))
+
+    def iter_postings(self):
+        # (term, doc positions, tfs) for every term in dictionary order
+        for term_id, term in enumerate(self.terms()):
+            yield term, self._positions(term_id), self._tfs(term_id)
+
+    def doc_position(self, doc_id):
+        i = int(np.searchsorted(self._sorted_doc_ids, doc_id))
+        if i >= self.num_docs or self._sorted_doc_ids[i] != doc_id:
+            return -1
+        return int(self._sorted_doc_pos[i])
+
+    def document_at(self, pos):
+        return json.loads(self._docs[self._doc_offsets[pos]:self._doc_offsets[pos + 1]].tobytes())
+
+
+class DocStore(Mapping):
+    # read-only docmap over a ColumnarIndex, documents are decoded on access
+    def __init__(self, columnar):
+        self.columnar = columnar
+
+    def __getitem__(self, doc_id):
+        pos = self.columnar.doc_position(doc_id)
+        if pos < 0:
+            raise KeyError(doc_id)
+        return self.columnar.document_at(pos)
+
+    def __contains__(self, doc_id):
+        return self.columnar.doc_position(doc_id) >= 0
+
+    def __iter__(self):
+        for doc_id in self.columnar.doc_ids:
+            yield int(doc_id)
+
+    def __len__(self):
+        return self.columnar.num_docs
@@ -1,18 +1,42 @@
+import itertools
 import math
-import os
 import pickle
-import string
-from collections import defaultdict, Counter
-
-from nltk.stem import PorterStemmer
-
-from lib.search_utils import load_movies, load_stopwords, CACHE_PATH, BM25_K1, BM25_B
-
-stemmer = PorterStemmer()
+from collections import defaultdict, deque, Counter
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from lib import tracing
+from lib.analyzer import Analyzer, get_analyzer
+from lib.batch_search import QUERY_BATCH_SIZE, run_batch
+from lib.boolean_query import parse_query, compile_query, evaluate
+from lib.index_format import ColumnarIndex, DocStore, HEADER_FILE, write_columnar_index
+from lib.spelling import SPELLING_FILE, SpellingDictionary
+from lib.search_utils import iter_movies, CACHE_PATH, BM25_K1, BM25_B, document_hash, load_manifest, save_manifest
+
+TERM_CACHE_SIZE = 4096
+MANIFEST_FILE = 'manifest.json'
+# the corpus is streamed through the build in batches; a parallel build hands each worker shards of
+# BUILD_SHARD_SIZE docs and keeps at most BUILD_SHARDS_IN_FLIGHT of them queued per worker
+BUILD_BATCH_SIZE = 10_000
+BUILD_SHARD_SIZE = 2_000
+BUILD_SHARDS_IN_FLIGHT = 2
+# a positional index adds, for each adjacent pair of query terms, a bm25-style score of how often
+# the second follows the first within PROXIMITY_WINDOW tokens, each occurrence weighted 1 / distance²
+PROXIMITY_WINDOW = 5
+PROXIMITY_WEIGHT = 1.0
 
 
 class InvertedIndex:
-    def __init__(self):
+    def __init__(self, analyzer=None, positional=False):
+        self.analyzer = analyzer or get_analyzer()
+        # positional indexes also record the token offsets of every term in every doc, for phrase
+        # queries and the proximity score; load() takes this from the saved index
+        self.positional = positional
+        self.proximity_weight = PROXIMITY_WEIGHT
+        # (num_docs, avg_doc_length, df(token)) of a whole collection this index is one shard of; bm25
+        # then uses them for idf and length norms so shard scores equal the unsharded ones
+        self.collection_stats = None
         self.index = defaultdict(set)
         self.docmap = {}
         self.index_path = CACHE_PATH / 'index.pkl'
@@ -21,46 +45,261 @@ class InvertedIndex:
         self.term_frequencies_path = CACHE_PATH / 'term_frequencies.pkl'
         self.doc_lengths = {}
         self.doc_lengths_path = CACHE_PATH / 'doc_lengths.pkl'
-
-
-    def _add_document(self, doc_id, text):
-        tokens = tokenize_text(text)
-        for token in set(tokens):
+        self._total_doc_length = 0
+        # {doc_id: {term: [token offsets]}}, only filled for positional indexes
+        self.token_offsets = {}
+        # {doc_id: content hash} of what is indexed, read lazily since only updates need it
+        self.manifest = None
+        # {surface word: stem} of every word analyzed into the index, for the spelling dictionary; read
+        # lazily from the saved dictionary since only updates need it
+        self.surface_forms = None
+        self.columnar_path = CACHE_PATH / 'index'
+        # set by load(); postings, lengths and docs are then read from the memory-mapped arrays
+        self.columnar = None
+        self._reset_caches()
+
+    def _reset_caches(self):
+        # derived scoring state, rebuilt lazily after build()/load()
+        self._avg_doc_length = None
+        self._doc_ids = None
+        self._doc_positions = None
+        self._doc_length_array = None
+        self._postings = {}
+        self._term_scores = {}
+        self._token_offsets = {}
+        self._phrases = {}
+
+    def _add_document(self, doc_id, text, tokens=None):
+        if tokens is None:
+            tokens = self.analyzer.analyze(text)
+        offsets = _token_offsets(tokens) if self.positional else None
+        self._add_term_frequencies(doc_id, Counter(tokens), len(tokens), offsets)
+
+    def _add_term_frequencies(self, doc_id, term_frequencies, length, token_offsets=None):
+        for token in term_frequencies:
             self.index[token].add(doc_id)
-        self.term_frequencies[doc_id].update(tokens)
-        self.doc_lengths[doc_id] = len(tokens)
+        self.term_frequencies[doc_id].update(term_frequencies)
+        self.doc_lengths[doc_id] = length
+        self._total_doc_length += length
+        if token_offsets is not None:
+            self.token_offsets[doc_id] = token_offsets
+
+    def _remove_document(self, doc_id):
+        # drops the postings of doc_id but keeps its docmap slot, so an update keeps its position
+        for token in self.term_frequencies.pop(doc_id, ()):
+            docs = self.index[token]
+            docs.discard(doc_id)
+            if not docs:
+                del self.index[token]
+        self._total_doc_length -= self.doc_lengths.pop(doc_id)
+        self.token_offsets.pop(doc_id, None)
 
     def _get_avg_doc_length(self):
-        import statistics
-        return statistics.mean(self.doc_lengths.values())
+        if self._avg_doc_length is None:
+            if self.collection_stats is not None:
+                self._avg_doc_length = self.collection_stats[1]
+            elif self.columnar is not None:
+                self._avg_doc_length = self.columnar.avg_doc_length
+            else:
+                # same value statistics.mean() gives for ints, without the pass over every doc
+                self._avg_doc_length = self._total_doc_length / len(self.doc_lengths)
+        return self._avg_doc_length
+
+    def _get_doc_ids(self):
+        # doc id at each position; positions follow docmap order and break score ties
+        if self._doc_ids is None:
+            if self.columnar is not None:
+                self._doc_ids = self.columnar.doc_ids
+            else:
+                self._doc_ids = np.asarray(list(self.docmap), dtype=np.int64)
+        return self._doc_ids
+
+    def _get_doc_lengths(self):
+        if self._doc_length_array is None:
+            if self.columnar is not None:
+                self._doc_length_array = self.columnar.doc_lengths
+            else:
+                self._doc_length_array = np.asarray([self.doc_lengths[doc_id] for doc_id in self.docmap], dtype=np.int32)
+        return self._doc_length_array
+
+    def _get_doc_position(self, doc_id):
+        if self.columnar is not None:
+            return self.columnar.doc_position(doc_id)
+        if self._doc_positions is None:
+            self._doc_positions = {doc_id: pos for pos, doc_id in enumerate(self.docmap)}
+        return self._doc_positions.get(doc_id, -1)
+
+    def _get_df(self, token):
+        if self.columnar is not None:
+            return self.columnar.df(token)
+        return len(self.index.get(token, ()))
+
+    def _get_postings(self, token):
+        # (sorted doc positions, tfs) for an already tokenized term; a loaded index decodes them from
+        # the compressed postings once per cached term
+        if token not in self._postings:
+            if len(self._postings) >= TERM_CACHE_SIZE:
+                del self._postings[next(iter(self._postings))]
+            if self.columnar is not None:
+                self._postings[token] = self.columnar.postings(token)
+            else:
+                positions = np.sort(np.fromiter(
+                    (self._get_doc_position(doc_id) for doc_id in self.index.get(token, ())), dtype=np.int64))
+                doc_ids = self._get_doc_ids()
+                tfs = np.fromiter((self.term_frequencies[doc_ids[pos]][token] for pos in positions),
+                                  dtype=np.int32, count=len(positions))
+                self._postings[token] = (positions, tfs)
+        return self._postings[token]
+
+    def _get_token_offsets(self, token):
+        # (doc position, token offset) of every occurrence of token, sorted, as two arrays
+        if token not in self._token_offsets:
+            if len(self._token_offsets) >= TERM_CACHE_SIZE:
+                del self._token_offsets[next(iter(self._token_offsets))]
+            positions, tfs = self._get_postings(token)
+            if self.columnar is not None:
+                offsets = self.columnar.token_offsets(token)
+            else:
+                doc_ids = self._get_doc_ids()
+                offsets = np.fromiter(itertools.chain.from_iterable(
+                    self.token_offsets[doc_ids[pos]][token] for pos in positions), dtype=np.int64)
+            self._token_offsets[token] = (np.repeat(np.asarray(positions, dtype=np.int64), tfs), offsets)
+        return self._token_offsets[token]
+
+    def _get_phrase_set(self, tokens):
+        # (positions, None, df) of the docs where tokens occur one right after the other, in the
+        # shape of _get_doc_set; a start of the phrase survives only if every term is where it should be
+        if tokens not in self._phrases:
+            if len(self._phrases) >= TERM_CACHE_SIZE:
+                del self._phrases[next(iter(self._phrases))]
+            keys = [_occurrence_keys(*self._get_token_offsets(token), len(tokens) - i) for i, token in enumerate(tokens)]
+            keys.sort(key=len)
+            starts = keys[0]
+            for other in keys[1:]:
+                if len(starts):
+                    starts = starts[_lookup(other, starts)[0]]
+            self._phrases[tokens] = np.unique(starts >> 32)
+        positions = self._phrases[tokens]
+        return positions, None, len(positions)
+
+    def _get_pair_scores(self, pair, k1=BM25_K1, b=BM25_B):
+        # (doc positions, proximity scores) of one adjacent pair of query terms: the pair's weighted
+        # occurrence count acc goes through the bm25 saturation with the doc's length norm, scaled by
+        # the smaller of the two idfs
+        key = (pair, k1, b, self.proximity_weight)
+        if key not in self._term_scores:
+            if len(self._term_scores) >= TERM_CACHE_SIZE:
+                del self._term_scores[next(iter(self._term_scores))]
+            first = _occurrence_keys(*self._get_token_offsets(pair[0]))
+            second = _occurrence_keys(*self._get_token_offsets(pair[1]))
+            near, weights = [], []
+            for distance in range(1, PROXIMITY_WINDOW + 1):
+                hits = first[_lookup(second, first + distance)[0]]
+                near.append(hits >> 32)
+                weights.append(np.full(len(hits), 1 / distance ** 2))
+            positions, inverse = np.unique(np.concatenate(near), return_inverse=True)
+            acc = np.bincount(inverse, weights=np.concatenate(weights), minlength=len(positions))
+            norms = k1 * (1 - b + b * (self._get_doc_lengths()[positions] / self._get_avg_doc_length()))
+            idf = min(self._token_bm25_idf(pair[0]), self._token_bm25_idf(pair[1]))
+            self._term_scores[key] = (positions, ((acc * (k1 + 1)) / (acc + norms)) * idf * self.proximity_weight)
+        return self._term_scores[key]
+
+    def _query_features(self, query_tokens):
+        # what a query's score adds up: its tokens, then on a positional index its adjacent term pairs
+        features = list(query_tokens)
+        if self.positional and self.proximity_weight:
+            features += [pair for pair in itertools.pairwise(query_tokens) if pair[0] != pair[1]]
+        return features
+
+    def _get_feature_scores(self, feature, k1=BM25_K1, b=BM25_B):
+        if isinstance(feature, tuple):
+            return self._get_pair_scores(feature, k1, b)
+        return self._get_term_scores(feature, k1, b)
+
+    def _get_doc_set(self, token):
+        # (positions, bitset, df) for boolean queries; dense terms of a loaded index are tested
+        # against their stored bitset without decoding it
+        bits = self.columnar.bitset(token) if self.columnar is not None else None
+        if bits is not None:
+            return None, bits, self._get_df(token)
+        positions, _ = self._get_postings(token)
+        return positions, None, len(positions)
+
+    def _get_token_tf(self, doc_id, token):
+        if self.columnar is None:
+            return self.term_frequencies[doc_id][token]
+        pos = self._get_doc_position(doc_id)
+        positions, tfs = self._get_postings(token)
+        i = np.searchsorted(positions, pos)
+        if pos < 0 or i >= len(positions) or positions[i] != pos:
+            return 0
+        return int(tfs[i])
+
+    def _get_length_norm(self, doc_id, k1=BM25_K1, b=BM25_B):
+        length = self._get_doc_lengths()[self._get_doc_position(doc_id)]
+        return k1 * (1 - b + b * (float(length) / self._get_avg_doc_length()))
+
+    def _token_bm25_idf(self, token):
+        if self.collection_stats is not None:
+            doc_count, _, df = self.collection_stats
+            term_doc_count = df(token)
+        else:
+            doc_count = len(self.docmap)
+            term_doc_count = self._get_df(token)
+        return math.log((doc_count - term_doc_count + 0.5) / (term_doc_count + 0.5) + 1)
+
+    def _get_term_scores(self, token, k1=BM25_K1, b=BM25_B):
+        # (doc positions, bm25 contributions) over the postings of token, same arithmetic as bm25()
+        key = (token, k1, b)
+        if key not in self._term_scores:
+            if len(self._term_scores) >= TERM_CACHE_SIZE:
+                del self._term_scores[next(iter(self._term_scores))]
+            positions, tfs = self._get_postings(token)
+            tfs = tfs.astype(np.float64)
+            norms = k1 * (1 - b + b * (self._get_doc_lengths()[positions] / self._get_avg_doc_length()))
+            scores = ((tfs * (k1 + 1)) / (tfs + norms)) * self._token_bm25_idf(token)
+            self._term_scores[key] = (positions, scores)
+        return self._term_scores[key]
 
     def get_document(self, term):
-        result = sorted(self.index[term])
-        return list(result)
+        positions, _ = self._get_postings(term)
+        return np.sort(self._get_doc_ids()[positions]).tolist()
+
+    def boolean_search(self, query, limit=None, default_operator='or'):
+        # ids of the first limit docs, in index order, matching an AND/OR/NOT query
+        with tracing.span('boolean.parse'):
+            tree = parse_query(query, self.analyzer.analyze, default_operator)
+        if tree is None:
+            return []
+        with tracing.span('boolean.evaluate'):
+            num_docs = len(self.docmap)
+            phrase_set = self._get_phrase_set if self.positional else None
+            positions = evaluate(compile_query(tree, self._get_doc_set, num_docs, phrase_set), num_docs, limit)
+        return np.asarray(self._get_doc_ids())[positions].tolist()
 
     def get_tf(self, doc_id, term):
-        tokens = tokenize_text(term)
+        tokens = self.analyzer.analyze(term)
         if len(tokens) != 1:
             raise ValueError("can only have 1 tokens")
         token = tokens[0]
-        return self.term_frequencies[doc_id][token]
+        return self._get_token_tf(doc_id, token)
 
     def bm25_get_tf(self, doc_id, term, k1=BM25_K1, b=BM25_B):
-        tokens = tokenize_text(term)
+        tokens = self.analyzer.analyze(term)
         if len(tokens) != 1:
             raise ValueError("can only have 1 tokens")
         token = tokens[0]
-        tf = self.term_frequencies[doc_id][token]
-        length_norm = 1 - b + b * (self.doc_lengths[doc_id] / self._get_avg_doc_length())
-        return (tf * (k1 + 1)) / (tf + k1 * length_norm)
+        tf = self._get_token_tf(doc_id, token)
+        length_norm = self._get_length_norm(doc_id, k1, b)
+        return (tf * (k1 + 1)) / (tf + length_norm)
 
     def get_idf(self, term):
-        tokens = tokenize_text(term)
+        tokens = self.analyzer.analyze(term)
         if len(tokens) != 1:
             raise ValueError("can only have 1 tokens")
         token = tokens[0]
         doc_count = len(self.docmap)
-        term_doc_count = len(self.index[token])
+        term_doc_count = self._get_df(token)
 
         return math.log((doc_count + 1) / (term_doc_count + 1))
 
@@ -70,63 +309,288 @@ class InvertedIndex:
         return tf * idf
 
     def get_bm25_idf(self, term: str) -> float:
-        tokens = tokenize_text(term)
+        tokens = self.analyzer.analyze(term)
         if len(tokens) != 1:
             raise ValueError("can only have 1 tokens")
-        token = tokens[0]
-        doc_count = len(self.docmap)
-        term_doc_count = len(self.index[token])
-        return math.log((doc_count - term_doc_count + 0.5) / (term_doc_count + 0.5) + 1)
+        return self._token_bm25_idf(tokens[0])
 
     def bm25(self, doc_id, term, k1=BM25_K1, b=BM25_B):
         tf = self.bm25_get_tf(doc_id, term, k1=k1, b=b)
         idf = self.get_bm25_idf(term)
         return tf * idf
 
-    def bm25_search(self, query, limit=5):
-        query_tokens = tokenize_text(query)
-        scores = {}
-        for doc_id in self.docmap:
-            score = 0
-            for token in query_tokens:
-                score += self.bm25(doc_id, token, BM25_K1, BM25_B)
-            scores[doc_id] = score
-        sorted_scores = sorted(scores.items(), key=lambda x: x[1], reverse=True)
-        results = sorted_scores[:limit]
-        formatted_results = []
-        for doc_id, score in results:
-            title = self.docmap[doc_id]['title']
-            formatted_results.append({
-                "doc_id": doc_id,
-                "title": title,
-                "score": score,
-                "description": self.docmap[doc_id]['description'],
-            })
-        return formatted_results
-
-
-
-
-
-    def build(self):
-        movies = load_movies()
+    def bm25_search(self, query, limit=5, k1=BM25_K1, b=BM25_B, prune=True):
+        return format_bm25_results(self.docmap, *self.bm25_ranked(query, limit, k1, b, prune))
+
+    def bm25_search_many(self, queries, limit=5, k1=BM25_K1, b=BM25_B):
+        return [format_bm25_results(self.docmap, *ranked) for ranked in self.bm25_ranked_many(queries, limit, k1, b)]
+
+    def bm25_ranked_many(self, queries, limit=5, k1=BM25_K1, b=BM25_B):
+        # the queries are analyzed together, each distinct word stemmed once for the whole batch
+        with tracing.span('bm25.analyze'):
+            token_lists = self.analyzer.analyze_many(queries)
+        with tracing.span('bm25.score'):
+            return [self._bm25_max_score(query_tokens, limit, k1, b) for query_tokens in token_lists]
+
+    def bm25_ranked(self, query, limit=5, k1=BM25_K1, b=BM25_B, prune=True):
+        # (doc ids, scores) arrays in bm25_search order, without touching any document
+        with tracing.span('bm25.analyze'):
+            query_tokens = self.analyzer.analyze(query)
+        with tracing.span('bm25.score'):
+            if prune:
+                return self._bm25_max_score(query_tokens, limit, k1, b)
+            return self._bm25_term_at_a_time(query_tokens, limit, k1, b)
+
+    def _bm25_term_at_a_time(self, query_tokens, limit, k1=BM25_K1, b=BM25_B):
+        if limit <= 0 or not len(self.docmap):
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+        term_scores = [self._get_feature_scores(feature, k1, b) for feature in self._query_features(query_tokens)]
+        if not term_scores:
+            return self._top_k(np.zeros(0, dtype=np.int64), np.zeros(0), limit)
+        # bincount adds weights in array order, i.e. per doc in query token order, so sums are
+        # bit-identical to scoring each doc token by token
+        positions, inverse = np.unique(np.concatenate([p for p, _ in term_scores]), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate([s for _, s in term_scores]), minlength=len(positions))
+        tracing.count('bm25.postings_scored', len(inverse))
+        tracing.count('bm25.candidates', len(positions))
+        return self._top_k(positions, scores, limit)
+
+    def _bm25_max_score(self, query_tokens, limit, k1=BM25_K1, b=BM25_B):
+        # term-at-a-time max-score: once the bounds of the remaining terms cannot lift a new doc
+        # over the current k-th score, stop opening accumulators and only update existing ones
+        if limit <= 0 or not len(self.docmap):
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+        features = self._query_features(query_tokens)
+        query_counts = Counter(features)
+        terms = [feature for feature in query_counts if len(self._get_feature_scores(feature, k1, b)[0])]
+        bounds = {
+            feature: float(self._get_feature_scores(feature, k1, b)[1].max()) * query_counts[feature] * (1 + 1e-9)
+            for feature in terms
+        }
+        terms.sort(key=bounds.get, reverse=True)
+        remaining = sum(bounds.values())
+        threshold = 0.
+        acc_positions = np.zeros(0, dtype=np.int64)
+        acc_scores = np.zeros(0)
+        for feature in terms:
+            positions, scores = self._get_feature_scores(feature, k1, b)
+            scores = scores * query_counts[feature]
+            tracing.count('bm25.postings_scored', len(positions))
+            if remaining < threshold:
+                hits, idx = _lookup(positions, acc_positions)
+                acc_scores[hits] += scores[idx[hits]]
+            else:
+                acc_positions, inverse = np.unique(np.concatenate([acc_positions, positions]), return_inverse=True)
+                acc_scores = np.bincount(inverse, weights=np.concatenate([acc_scores, scores]), minlength=len(acc_positions))
+            remaining -= bounds[feature]
+            if len(acc_positions) > limit:
+                threshold = float(np.partition(acc_scores, -limit)[-limit]) * (1 - 1e-9)
+                if remaining < threshold:
+                    keep = acc_scores + remaining >= threshold
+                    acc_positions, acc_scores = acc_positions[keep], acc_scores[keep]
+        if len(acc_positions) > limit:
+            # partial sums above were taken in bound order; rescore the shortlist in query order so
+            # scores are bit-identical to the exhaustive path
+            kth = float(np.partition(acc_scores, -limit)[-limit]) * (1 - 1e-9)
+            acc_positions = acc_positions[acc_scores >= kth]
+        tracing.count('bm25.candidates', len(acc_positions))
+        exact = np.zeros(len(acc_positions))
+        for feature in features:
+            positions, scores = self._get_feature_scores(feature, k1, b)
+            hits, idx = _lookup(positions, acc_positions)
+            exact[hits] += scores[idx[hits]]
+        return self._top_k(acc_positions, exact, limit)
+
+    def _top_k(self, positions, scores, limit):
+        # highest score first, ties in docmap order; docs outside every posting list score 0 and
+        # fill the tail in docmap order, exactly as a full scan over docmap would return them
+        if len(positions) > limit:
+            kth = np.partition(scores, -limit)[-limit]
+            keep = scores >= kth
+            positions, scores = positions[keep], scores[keep]
+        order = np.lexsort((positions, -scores))[:limit]
+        positions, scores = positions[order], scores[order]
+        if len(positions) < limit:
+            scored = positions[scores > 0]
+            candidates = np.arange(min(len(self.docmap), limit + len(scored)))
+            tail = np.setdiff1d(candidates, scored)[:limit - len(positions)]
+            positions = np.concatenate([positions, tail])
+            scores = np.concatenate([scores, np.zeros(len(tail))])
+        return np.asarray(self._get_doc_ids())[positions].astype(np.int64), scores
+
+    def build(self, workers=1, movies=None):
+        # movies defaults to the streamed corpus and may be any iterable of movie dicts
+        with tracing.span('index.build'):
+            movies = iter_movies() if movies is None else movies
+            self.manifest = {}
+            self.surface_forms = {}
+            if workers > 1:
+                self._build_parallel(movies, workers)
+            else:
+                for batch in itertools.batched(movies, BUILD_BATCH_SIZE):
+                    texts = [f"{movie['title']}, {movie['description']}" for movie in batch]
+                    token_lists, stems = self.analyzer.analyze_many_with_stems(texts)
+                    self.surface_forms.update(stems)
+                    for movie, text, tokens in zip(batch, texts, token_lists):
+                        self._add_document(movie['id'], text, tokens)
+                        self.docmap[movie['id']] = movie
+                        self.manifest[movie['id']] = document_hash(movie)
+            self.columnar = None
+            self._reset_caches()
+
+    def _build_parallel(self, movies, workers):
+        # shards are analyzed in a process pool and merged back in corpus order, which gives the same
+        # docmap order, postings and lengths as the serial build
+        with ProcessPoolExecutor(workers, initializer=_init_build_worker,
+                                 initargs=(self.analyzer.stopwords, self.analyzer.stem_cache_path)) as pool:
+            pending = deque()
+            for shard in itertools.batched(movies, BUILD_SHARD_SIZE):
+                texts = [f"{movie['title']}, {movie['description']}" for movie in shard]
+                pending.append((shard, pool.submit(_analyze_shard, texts, self.positional)))
+                if len(pending) >= workers * BUILD_SHARDS_IN_FLIGHT:
+                    self._merge_shard(*pending.popleft())
+            while pending:
+                self._merge_shard(*pending.popleft())
+
+    def _merge_shard(self, shard, future):
+        term_frequencies, lengths, token_offsets, stems = future.result()
+        for movie, doc_tfs, length, offsets in zip(shard, term_frequencies, lengths, token_offsets):
+            self._add_term_frequencies(movie['id'], doc_tfs, length, offsets)
+            self.docmap[movie['id']] = movie
+            self.manifest[movie['id']] = document_hash(movie)
+        self.surface_forms.update(stems)
+        self.analyzer.update_stem_cache(stems)
+
+    def _get_manifest(self):
+        if self.manifest is None:
+            if self.columnar is not None:
+                self.manifest = load_manifest(self.columnar_path / MANIFEST_FILE)
+            if self.manifest is None:
+                # indexes saved before manifests existed
+                self.manifest = {doc_id: document_hash(doc) for doc_id, doc in self.docmap.items()}
+        return self.manifest
+
+    def _get_surface_forms(self):
+        if self.surface_forms is None:
+            path = self.columnar_path / SPELLING_FILE
+            if self.columnar is not None and path.exists():
+                self.surface_forms = SpellingDictionary.load(path).stem_table()
+            else:
+                # indexes saved before spelling dictionaries
+                self.surface_forms = self.analyzer.stem_table()
+        return self.surface_forms
+
+    def _thaw(self):
+        # a loaded index is memory-mapped and read-only; copy it into the mutable dicts once, which
+        # is a pass over the postings but no re-tokenization
+        if self.columnar is None:
+            return
+        self._get_manifest()
+        self._get_surface_forms()
+        columnar = self.columnar
+        doc_ids = columnar.doc_ids.tolist()
+        self.docmap = {doc_id: columnar.document_at(pos) for pos, doc_id in enumerate(doc_ids)}
+        self.doc_lengths = dict(zip(doc_ids, columnar.doc_lengths.tolist()))
+        self._total_doc_length = sum(self.doc_lengths.values())
+        self.index = defaultdict(set)
+        self.term_frequencies = defaultdict(Counter, {doc_id: Counter() for doc_id in doc_ids})
+        self.token_offsets = {doc_id: {} for doc_id in doc_ids} if self.positional else {}
+        for term, positions, tfs in columnar.iter_postings():
+            term_docs = [doc_ids[pos] for pos in positions.tolist()]
+            self.index[term] = set(term_docs)
+            for doc_id, tf in zip(term_docs, tfs.tolist()):
+                self.term_frequencies[doc_id][term] = tf
+            if self.positional:
+                offsets = columnar.token_offsets(term).tolist()
+                ends = list(itertools.accumulate(tfs.tolist()))
+                for doc_id, start, end in zip(term_docs, [0] + ends, ends):
+                    self.token_offsets[doc_id][term] = offsets[start:end]
+        self.columnar = None
+        self._reset_caches()
+
+    def upsert_documents(self, movies):
+        # adds new movies and re-indexes changed ones in place; movies whose content hash matches the
+        # manifest are skipped, so only what changed is tokenized
+        manifest = self._get_manifest()
+        changed = []
         for movie in movies:
-            text = f"{movie['title']}, {movie['description']}"
-            self._add_document(movie['id'], text)
+            doc_hash = document_hash(movie)
+            if manifest.get(movie['id']) != doc_hash:
+                changed.append((movie, doc_hash))
+        if not changed:
+            return 0
+        self._thaw()
+        texts = [f"{movie['title']}, {movie['description']}" for movie, _ in changed]
+        token_lists, stems = self.analyzer.analyze_many_with_stems(texts)
+        self._get_surface_forms().update(stems)
+        for (movie, doc_hash), text, tokens in zip(changed, texts, token_lists):
+            if movie['id'] in self.doc_lengths:
+                self._remove_document(movie['id'])
+            self._add_document(movie['id'], text, tokens)
             self.docmap[movie['id']] = movie
+            manifest[movie['id']] = doc_hash
+        self._reset_caches()
+        return len(changed)
+
+    def delete_documents(self, doc_ids):
+        manifest = self._get_manifest()
+        doc_ids = [doc_id for doc_id in doc_ids if doc_id in self.docmap]
+        if not doc_ids:
+            return 0
+        self._thaw()
+        for doc_id in doc_ids:
+            self._remove_document(doc_id)
+            del self.docmap[doc_id]
+            manifest.pop(doc_id, None)
+        self._reset_caches()
+        return len(doc_ids)
+
+    def sync_documents(self, movies):
+        # brings the index in line with movies: deletes what is gone, upserts what is new or changed
+        movies = list(movies)
+        live_ids = {movie['id'] for movie in movies}
+        deleted = self.delete_documents([doc_id for doc_id in self._get_manifest() if doc_id not in live_ids])
+        upserted = self.upsert_documents(movies)
+        return upserted, deleted
 
     def save(self):
-        os.makedirs(CACHE_PATH, exist_ok=True)
-        with open(self.index_path, mode='wb') as f:
-            pickle.dump(self.index, f)
-        with open(self.docmap_path, mode='wb') as f:
-            pickle.dump(self.docmap, f)
-        with open(self.term_frequencies_path, mode='wb') as f:
-            pickle.dump(self.term_frequencies, f)
-        with open(self.doc_lengths_path, mode='wb') as f:
-            pickle.dump(self.doc_lengths, f)
+        with tracing.span('index.save'):
+            write_columnar_index(self.columnar_path, self.docmap, self.index, self.term_frequencies, self.doc_lengths,
+                                 self.token_offsets if self.positional else None)
+            # written after the index: a stale manifest only makes the next update redo some work
+            save_manifest(self.columnar_path / MANIFEST_FILE, self._get_manifest())
+            self.spelling_dictionary().save(self.columnar_path / SPELLING_FILE)
+            self.analyzer.save_stem_cache()
+
+    def exists(self):
+        return (self.columnar_path / HEADER_FILE).exists()
+
+    def term_dfs(self):
+        # {term: df} over the whole vocabulary
+        if self.columnar is not None:
+            return dict(zip(self.columnar.terms(), self.columnar.dfs().tolist()))
+        return {term: len(doc_ids) for term, doc_ids in self.index.items() if doc_ids}
+
+    def spelling_dictionary(self):
+        # the corpus words that stem to an indexed term, for local spelling correction
+        return SpellingDictionary.from_index(self.term_dfs(), self._get_surface_forms())
 
     def load(self):
+        with tracing.span('index.load'):
+            self.columnar = ColumnarIndex(self.columnar_path)
+            self.positional = self.columnar.positional
+            self.docmap = DocStore(self.columnar)
+            self.index = defaultdict(set)
+            self.term_frequencies = defaultdict(Counter)
+            self.doc_lengths = {}
+            self.token_offsets = {}
+            self._total_doc_length = 0
+            self.manifest = None
+            self.surface_forms = None
+            self._reset_caches()
+
+    def load_pickles(self):
+        # the pre-columnar format: four pickles, fully deserialized
         with open(self.index_path, mode='rb') as f:
             self.index = pickle.load(f)
         with open(self.docmap_path, mode='rb') as f:
@@ -135,16 +599,103 @@ class InvertedIndex:
             self.term_frequencies = pickle.load(f)
         with open(self.doc_lengths_path, mode='rb') as f:
             self.doc_lengths = pickle.load(f)
+        self._total_doc_length = sum(self.doc_lengths.values())
+        self.positional = False
+        self.token_offsets = {}
+        self.manifest = None
+        self.surface_forms = None
+        self.columnar = None
+        self._reset_caches()
 
 
-def build_command():
-    idx = InvertedIndex()
-    idx.build()
+_worker_analyzer = None
+
+
+def _init_build_worker(stopwords, stem_cache_path):
+    global _worker_analyzer
+    _worker_analyzer = Analyzer(stopwords)
+    _worker_analyzer.load_stem_cache(stem_cache_path)
+
+
+def _analyze_shard(texts, positional=False):
+    # partial index of one shard: term frequencies, length and token offsets (positional only) per
+    # doc, plus the stems it computed
+    token_lists, stems = _worker_analyzer.analyze_many_with_stems(texts)
+    offsets = [_token_offsets(tokens) if positional else None for tokens in token_lists]
+    return [Counter(tokens) for tokens in token_lists], [len(tokens) for tokens in token_lists], offsets, stems
+
+
+def format_bm25_results(docmap, doc_ids, scores):
+    formatted_results = []
+    for doc_id, score in zip(doc_ids.tolist(), scores.tolist()):
+        doc = docmap[doc_id]
+        formatted_results.append({
+            "doc_id": doc_id,
+            "title": doc['title'],
+            "score": score,
+            "description": doc['description'],
+        })
+    return formatted_results
+
+
+def _token_offsets(tokens):
+    offsets = defaultdict(list)
+    for offset, token in enumerate(tokens):
+        offsets[token].append(offset)
+    return dict(offsets)
+
+
+def _occurrence_keys(positions, offsets, shift=0):
+    # one sortable int per occurrence, the doc position in the high 32 bits and offset + shift below
+    return (positions << 32) | (offsets + shift)
+
+
+def _lookup(positions, targets):
+    # for each target doc position, whether it is in the sorted postings and where
+    idx = np.searchsorted(positions, targets)
+    idx[idx >= len(positions)] = 0
+    hits = positions[idx] == targets if len(positions) else np.zeros(len(targets), dtype=bool)
+    return hits, idx
+
+
+def load_docmap():
+    # id -> movie read from the saved index, so query paths never parse the corpus; the corpus is
+    # only streamed when no index has been built yet
+    path = InvertedIndex().columnar_path
+    if (path / HEADER_FILE).exists():
+        return DocStore(ColumnarIndex(path))
+    return {movie['id']: movie for movie in iter_movies()}
+
+
+def build_command(workers=1, positional=False):
+    idx = InvertedIndex(positional=positional)
+    idx.build(workers)
     idx.save()
     # docs = idx.get_document("merida")
     # print(f"firstdoc: {docs[0]}")
 
 
+def update_command():
+    # applies edits to movies.json to the saved index without a full rebuild
+    idx = InvertedIndex()
+    if not idx.exists():
+        build_command()
+        print(f"no index at {idx.columnar_path}, built it from scratch")
+        return
+    idx.load()
+    upserted, deleted = idx.sync_documents(iter_movies())
+    if upserted or deleted:
+        idx.save()
+    print(f"updated {upserted} and deleted {deleted} documents in {idx.columnar_path}")
+
+
+def convert_command():
+    idx = InvertedIndex()
+    idx.load_pickles()
+    idx.save()
+    print(f"converted {len(idx.docmap)} documents to {idx.columnar_path}")
+
+
 def tf_command(doc_id, term):
     idx = InvertedIndex()
     idx.load()
@@ -157,6 +708,11 @@ def bm25_command(query):
     return idx.bm25_search(query)
 
 
+def batch_command(source='-', output='-', limit=5, batch_size=QUERY_BATCH_SIZE):
+    idx = InvertedIndex()
+    idx.load()
+    return run_batch(lambda queries: idx.bm25_search_many(queries, limit), source, output, batch_size)
+
 
 def bm25_tf_command(doc_id, term, b=BM25_B):
     idx = InvertedIndex()
@@ -186,27 +742,11 @@ def bm25_idf_command(term):
 
 
 def clean_text(text):
-    text = text.lower()
-    text = text.translate(str.maketrans('', '', string.punctuation))
-    return text
+    return get_analyzer().clean(text)
 
 
 def tokenize_text(text):
-    text = clean_text(text)
-    stop_words = load_stopwords()
-    result = []
-
-    def _filter(tokens):
-        if token and token not in stop_words:
-            return True
-        return False
-
-    for token in text.split():
-        if _filter(token):
-            token = stemmer.stem(token)
-            result.append(token)
-
-    return result
+    return get_analyzer().analyze(text)
 
 
 def is_matching(query_toks, movie_toks):
@@ -217,29 +757,7 @@ def is_matching(query_toks, movie_toks):
     return False
 
 
-def search_movies(query, n_results=5):
-    movies = load_movies()
-    result = []
+def search_movies(query, n_results=5, default_operator='or'):
     idx = InvertedIndex()
     idx.load()
-    seen, res = set(), []
-    query_tokens = tokenize_text(query)
-    for qt in query_tokens:
-        matching_doc_ids = idx.get_document(qt)
-        for matching_doc_id in matching_doc_ids:
-            if matching_doc_id in seen:
-                continue
-            seen.add(matching_doc_id)
-            matching_doc = idx.docmap[matching_doc_id]
-            result.append(matching_doc)
-            if len(result) >= n_results:
-                return result
-
-    # query_tokens = tokenize_text(query)
-    # for movie in movies:
-    #     movie_tokens = tokenize_text(movie['title'])
-    #     if is_matching(query_tokens, movie_tokens):
-    #         result.append(movie)
-    #     if len(result) == n_results:
-    #         break
-    return result
+    return [idx.docmap[doc_id] for doc_id in idx.boolean_search(query, n_results, default_operator)]
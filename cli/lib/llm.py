@@ -1,38 +1,148 @@
+import hashlib
+import json
 import os
+import re
+import threading
+import time
+from abc import ABC, abstractmethod
+from functools import cache
 
-from dotenv import load_dotenv
+from lib import components, tracing
+from lib.search_utils import PROMPT_PATH, CACHE_PATH
+from lib.two_tier_cache import TwoTierCache
 
-from lib.search_utils import PROMPT_PATH
+model = "gemini-2.5-flash"
+LLM_BACKENDS = ('gemini', 'fake')
+RESPONSE_CACHE_SIZE = 4096
+RESPONSE_DISK_CACHE_SIZE = 100_000
+RESPONSE_CACHE_TTL = 7 * 24 * 3600
 
-load_dotenv()
-api_key = os.environ.get("GOOGLE_API_KEY")
-print(f"Using key {api_key[:6]}...")
 
-from google import genai
+@cache
+def load_prompt(name):
+    # (template, hash) of a prompt file, read once per process
+    with open(PROMPT_PATH / name, mode='r') as f:
+        template = f.read()
+    return template, hashlib.sha256(template.encode()).hexdigest()[:16]
 
-model = "gemini-2.5-flash"
-client = genai.Client(api_key=api_key)
+
+class LLMClient(ABC):
+    # backend interface: a fully formatted prompt in, the response text out
+    model = None
+
+    @abstractmethod
+    def generate(self, prompt):
+        ...
+
+
+class GeminiClient(LLMClient):
+    def __init__(self, model=model, api_key=None):
+        from dotenv import load_dotenv
+        from google import genai
+
+        load_dotenv()
+        api_key = api_key or os.environ.get("GOOGLE_API_KEY")
+        if not api_key:
+            raise ValueError("GOOGLE_API_KEY is not set")
+        self.model = model
+        self._client = genai.Client(api_key=api_key)
+
+    def generate(self, prompt):
+        return self._client.models.generate_content(model=self.model, contents=prompt).text
+
+
+class FakeClient(LLMClient):
+    # deterministic offline stand-in: the answer depends only on the prompt and has the shape that
+    # prompt asks for; latency simulates the round trip for benchmarks
+    def __init__(self, latency=0., model='fake-local'):
+        self.model = model
+        self.latency = latency
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def generate(self, prompt):
+        with self._lock:
+            self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        digest = hashlib.sha256(prompt.encode()).hexdigest()
+        ids = re.findall(r'<movie id=(\d+)=>', prompt)
+        if ids:
+            return json.dumps(sorted((int(i) for i in ids), key=lambda i: hashlib.sha256(f'{digest}{i}'.encode()).digest()))
+        if 'Rate 0-10' in prompt:
+            return str(int(digest, 16) % 11)
+        match = re.search(r'(?:Query|Original): "(.*)"', prompt)
+        return match.group(1) if match else ''
+
+
+class ResponseCache(TwoTierCache):
+    # (prompt template hash, model, prompt fields) -> response: an in-process LRU in front of a sqlite
+    # store under CACHE_PATH; entries expire ttl seconds after they were fetched and both tiers are bounded
+    counter = 'llm_cache'
+
+    def __init__(self, size=RESPONSE_CACHE_SIZE, disk_size=RESPONSE_DISK_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL, path=None):
+        super().__init__(size, disk_size, path or CACHE_PATH / 'llm_responses.sqlite', ttl)
+
+    @staticmethod
+    def key(template_hash, model_name, fields):
+        return hashlib.sha256(json.dumps([template_hash, model_name, fields], sort_keys=True).encode()).hexdigest()
+
+
+def _create_client():
+    # LLM_BACKEND=fake selects the offline client
+    backend = os.environ.get('LLM_BACKEND', 'gemini')
+    match backend:
+        case 'gemini':
+            return GeminiClient()
+        case 'fake':
+            return FakeClient()
+    raise ValueError(f"LLM_BACKEND must be one of {', '.join(LLM_BACKENDS)}, got {backend!r}")
+
+
+components.register('llm_client', _create_client)
+components.register('llm_response_cache', ResponseCache)
+
+
+def get_client():
+    return components.get('llm_client')
+
+
+def set_client(client):
+    components.provide('llm_client', client)
+
+
+def get_response_cache():
+    return components.get('llm_response_cache')
+
+
+def complete(prompt_name, **fields):
+    # prompt_name formatted with fields, answered from the response cache when possible
+    template, template_hash = load_prompt(prompt_name)
+    client = get_client()
+    response_cache = get_response_cache()
+    key = response_cache.key(template_hash, client.model, fields)
+    response = response_cache.get(key)
+    if response is None:
+        with tracing.span('llm.generate'):
+            response = client.generate(template.format(**fields))
+        if response is not None:
+            response_cache.put(key, response)
+    return response
 
 
 def generate_content(prompt, query):
     prompt = prompt.format(query=query)
-    response = client.models.generate_content(model=model, contents=prompt)
-    return response.text
+    with tracing.span('llm.generate'):
+        return get_client().generate(prompt)
 
 
 def correct_spellings(query):
-    with open(PROMPT_PATH / 'spelling.md', mode='r') as f:
-        prompt = f.read()
-    return generate_content(prompt, query)
+    return complete('spelling.md', query=query)
 
 
 def rewrite_query(query):
-    with open(PROMPT_PATH / 'rewrite.md', mode='r') as f:
-        prompt = f.read()
-    return generate_content(prompt, query)
+    return complete('rewrite.md', query=query)
 
 
 def expand_query(query):
-    with open(PROMPT_PATH / 'expand.md', mode='r') as f:
-        prompt = f.read()
-    return generate_content(prompt, query)
+    return complete('expand.md', query=query)
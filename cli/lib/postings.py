@@ -0,0 +1,109 @@
+import numpy as np
+
+# posting lists are stored one of two ways, whichever is smaller:
+#   varbyte  gaps between sorted doc positions (the first gap from 0), 7 bits per byte, low bits
+#            first, the high bit set on the last byte of each gap
+#   bitset   one bit per doc position in the index, most significant bit first (np.packbits order)
+VARBYTE = 0
+BITSET = 1
+
+_VARBYTE_LIMITS = np.asarray([1 << 7, 1 << 14, 1 << 21, 1 << 28, 1 << 35], dtype=np.uint64)
+
+
+def _varbyte_sizes(values):
+    return 1 + np.searchsorted(_VARBYTE_LIMITS, values, side='right')
+
+
+def encode_varbyte(values):
+    # variable-byte encoding of non-negative ints, vectorized over the whole array
+    values = np.asarray(values, dtype=np.uint64)
+    if not len(values):
+        return np.zeros(0, dtype=np.uint8)
+    sizes = _varbyte_sizes(values)
+    ends = np.cumsum(sizes)
+    owner = np.repeat(np.arange(len(values)), sizes)
+    shifts = (np.arange(ends[-1]) - (ends - sizes)[owner]) * 7
+    encoded = ((values[owner] >> shifts.astype(np.uint64)) & np.uint64(0x7f)).astype(np.uint8)
+    encoded[ends - 1] |= 0x80
+    return encoded
+
+
+def decode_varbyte(data):
+    data = np.asarray(data, dtype=np.uint8)
+    if not len(data):
+        return np.zeros(0, dtype=np.int64)
+    ends = np.flatnonzero(data & 0x80)
+    starts = np.concatenate([[0], ends[:-1] + 1])
+    owner = np.repeat(np.arange(len(ends)), ends - starts + 1)
+    shifts = (np.arange(len(data)) - starts[owner]) * 7
+    return np.add.reduceat((data & 0x7f).astype(np.int64) << shifts, starts)
+
+
+def encode_delta_runs(values, run_lengths):
+    # sorted runs of values back to back, each stored as varbyte gaps restarting at its first value.
+    # Returns (encoded bytes, byte offset of every run boundary)
+    values = np.asarray(values, dtype=np.int64)
+    boundaries = np.concatenate([[0], np.cumsum(run_lengths, dtype=np.int64)])
+    gaps = np.diff(values, prepend=0)
+    starts = boundaries[:-1][boundaries[:-1] < boundaries[1:]]
+    gaps[starts] = values[starts]
+    byte_offsets = np.concatenate([[0], np.cumsum(_varbyte_sizes(gaps.astype(np.uint64)))])[boundaries]
+    return encode_varbyte(gaps), byte_offsets
+
+
+def decode_delta_runs(data, run_lengths):
+    # the values of encode_delta_runs, given the same run lengths
+    gaps = decode_varbyte(data)
+    run_lengths = np.asarray(run_lengths, dtype=np.int64)
+    totals = np.cumsum(gaps)
+    starts = np.cumsum(run_lengths) - run_lengths
+    nonempty = run_lengths > 0
+    return totals - np.repeat((totals - gaps)[starts[nonempty]], run_lengths[nonempty])
+
+
+def bitset_size(num_docs):
+    return (num_docs + 7) // 8
+
+
+def encode_posting_lists(positions, offsets, num_docs):
+    # every posting list in one pass: list i is the sorted positions[offsets[i]:offsets[i + 1]].
+    # Returns (kind per list, encoded bytes back to back, byte offsets per list)
+    positions = np.asarray(positions, dtype=np.int64)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    encoded, varbyte_offsets = encode_delta_runs(positions, np.diff(offsets))
+    varbyte_lengths = np.diff(varbyte_offsets)
+    kinds = np.where(varbyte_lengths > bitset_size(num_docs), BITSET, VARBYTE).astype(np.uint8)
+    data_offsets = np.concatenate([[0], np.cumsum(np.where(kinds == BITSET, bitset_size(num_docs), varbyte_lengths))])
+    if not kinds.any():
+        return kinds, encoded, data_offsets
+    # move the varbyte lists to their place between the bitsets, then fill the bitsets in
+    data = np.zeros(data_offsets[-1], dtype=np.uint8)
+    owner = np.repeat(np.arange(len(kinds)), varbyte_lengths)
+    keep = kinds[owner] == VARBYTE
+    data[np.flatnonzero(keep) + (data_offsets[:-1] - varbyte_offsets[:-1])[owner[keep]]] = encoded[keep]
+    for i in np.flatnonzero(kinds == BITSET):
+        bits = np.zeros(num_docs, dtype=bool)
+        bits[positions[offsets[i]:offsets[i + 1]]] = True
+        data[data_offsets[i]:data_offsets[i + 1]] = np.packbits(bits)
+    return kinds, data, data_offsets
+
+
+def decode_postings(kind, data):
+    # sorted doc positions of one posting list
+    if kind == BITSET:
+        return np.flatnonzero(np.unpackbits(np.asarray(data, dtype=np.uint8)))
+    return np.cumsum(decode_varbyte(data))
+
+
+def bitset_contains(bits, positions):
+    # membership of sorted doc positions in a packed bitset
+    positions = np.asarray(positions, dtype=np.int64)
+    return (bits[positions >> 3] & (0x80 >> (positions & 7)).astype(np.uint8)) != 0
+
+
+def bitset_range(bits, start, stop):
+    # the doc positions in [start, stop) set in a packed bitset, unpacking only those bytes
+    first = start >> 3
+    window = np.unpackbits(np.asarray(bits[first:(stop + 7) >> 3], dtype=np.uint8))
+    positions = np.flatnonzero(window) + (first << 3)
+    return positions[(positions >= start) & (positions < stop)]
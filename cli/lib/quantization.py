@@ -0,0 +1,78 @@
+import os
+
+import numpy as np
+
+STORAGE_TYPES = ('float32', 'float16', 'int8')
+SCORE_BATCH_SIZE = 65536
+
+
+class QuantizedMatrix:
+    # reduced precision copy of the L2-normalized rows of an embedding matrix, used for a first
+    # scoring pass; int8 codes are scaled per dimension so that row ~= codes * scale
+    def __init__(self, codes, scale=None):
+        self.codes = codes
+        self.scale = scale
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + (self.scale.nbytes if self.scale is not None else 0)
+
+    def __len__(self):
+        return len(self.codes)
+
+    @classmethod
+    def from_matrix(cls, matrix, storage):
+        matrix = np.asarray(matrix, dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        matrix = matrix / norms
+        if storage == 'float16':
+            return cls(matrix.astype(np.float16))
+        if storage == 'int8':
+            scale = np.abs(matrix).max(axis=0) / 127 if len(matrix) else np.ones(matrix.shape[1], dtype=np.float32)
+            scale[scale == 0] = 1
+            codes = np.clip(np.rint(matrix / scale), -127, 127).astype(np.int8)
+            return cls(codes, scale.astype(np.float32))
+        raise ValueError(f"unknown quantized storage {storage!r}")
+
+    @staticmethod
+    def paths(path, storage):
+        # cache/chunk_embeddings.npy -> cache/chunk_embeddings.int8.npy (+ .int8.scale.npy)
+        return path.with_suffix(f'.{storage}.npy'), path.with_suffix(f'.{storage}.scale.npy')
+
+    def save(self, path, storage):
+        codes_path, scale_path = self.paths(path, storage)
+        np.save(codes_path, self.codes)
+        if self.scale is not None:
+            np.save(scale_path, self.scale)
+
+    @classmethod
+    def load(cls, path, storage):
+        codes_path, scale_path = cls.paths(path, storage)
+        codes = np.load(codes_path, mmap_mode='r')
+        scale = np.load(scale_path) if storage == 'int8' else None
+        return cls(codes, scale)
+
+    @classmethod
+    def load_or_create(cls, path, storage, matrix):
+        # reuse the quantized copy of the float32 file at path unless it is missing or older
+        codes_path, _ = cls.paths(path, storage)
+        if codes_path.exists() and path.exists() and os.path.getmtime(codes_path) >= os.path.getmtime(path):
+            quantized = cls.load(path, storage)
+            if len(quantized) == len(matrix):
+                return quantized
+        quantized = cls.from_matrix(matrix, storage)
+        quantized.save(path, storage)
+        return cls.load(path, storage)
+
+    def scores(self, queries):
+        # approximate inner products of queries (d,) or (q, d) with every row, computed blockwise so
+        # only one float32 block of the matrix exists at a time
+        queries = np.asarray(queries, dtype=np.float32)
+        if self.scale is not None:
+            queries = queries * self.scale
+        out = np.empty(queries.shape[:-1] + (len(self.codes),), dtype=np.float32)
+        for start in range(0, len(self.codes), SCORE_BATCH_SIZE):
+            block = np.asarray(self.codes[start:start + SCORE_BATCH_SIZE], dtype=np.float32)
+            out[..., start:start + len(block)] = queries @ block.T
+        return out
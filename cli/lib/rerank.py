@@ -1,54 +1,152 @@
+import asyncio
+import hashlib
 import json
-import os
-
-from dotenv import load_dotenv
-from sentence_transformers import CrossEncoder
-
-from lib.search_utils import PROMPT_PATH
-
-load_dotenv()
-api_key = os.environ.get("GOOGLE_API_KEY")
-print(f"Using key {api_key[:6]}...")
-
-from google import genai
-
-model = "gemini-2.5-flash"
-client = genai.Client(api_key=api_key)
-
-
-def individual_rerank(query, documents):
-    with open(PROMPT_PATH / 'individual_rerank.md') as f:
-        prompt = f.read()
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from lib import components, tracing
+from lib.llm import complete
+
+# individual reranking rates up to RERANK_CONCURRENCY documents at once; a call that takes longer than
+# RERANK_TIMEOUT seconds or fails is retried RERANK_RETRIES times with exponential backoff, after which
+# the document gets RERANK_FALLBACK_SCORE
+RERANK_CONCURRENCY = 8
+RERANK_TIMEOUT = 10.
+RERANK_RETRIES = 2
+RERANK_BACKOFF = 0.5
+RERANK_FALLBACK_SCORE = 0
+cross_encoder_model = "cross-encoder/ms-marco-TinyBERT-L2-v2"
+CROSS_ENCODER_BATCH_SIZE = 32
+CROSS_ENCODER_CACHE_SIZE = 50_000
+
+
+class CrossEncoderReranker:
+    # the cross-encoder loaded once, with (query, document text hash) -> score remembered in a bounded
+    # LRU so only unseen pairs reach the model, all of them in a single batched predict; a document
+    # that changes on update or sync gets a new key
+    def __init__(self, model_name=cross_encoder_model, batch_size=CROSS_ENCODER_BATCH_SIZE,
+                 cache_size=CROSS_ENCODER_CACHE_SIZE):
+        from sentence_transformers import CrossEncoder
+
+        self.model = CrossEncoder(model_name)
+        self.batch_size = batch_size
+        self.cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+        self._scores = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def document_text(doc):
+        # fused results carry the text as 'description', raw semantic results as 'document'
+        return f"{doc.get('title', '')} - {doc.get('description', doc.get('document', ''))}"
+
+    @staticmethod
+    def _key(query, doc):
+        return query, hashlib.sha256(CrossEncoderReranker.document_text(doc).encode()).hexdigest()[:16]
+
+    def score(self, query, documents):
+        keys = [self._key(query, doc) for doc in documents]
+        with self._lock:
+            scores = [self._scores.get(key) for key in keys]
+            for key, score in zip(keys, scores):
+                if score is not None:
+                    self._scores.move_to_end(key)
+            missing = [i for i, score in enumerate(scores) if score is None]
+            self.hits += len(keys) - len(missing)
+            self.misses += len(missing)
+        tracing.count('cross_encoder.cache_hits', len(keys) - len(missing))
+        tracing.count('cross_encoder.pairs_scored', len(missing))
+        if missing:
+            pairs = [[query, self.document_text(documents[i])] for i in missing]
+            with tracing.span('rerank.cross_encoder_predict'):
+                predicted = self.model.predict(pairs, batch_size=self.batch_size)
+            with self._lock:
+                for i, score in zip(missing, predicted):
+                    scores[i] = score
+                    self._scores[keys[i]] = score
+                while len(self._scores) > self.cache_size:
+                    self._scores.popitem(last=False)
+        return scores
+
+    def rerank(self, query, documents, top_m=None):
+        # cascade: only the first top_m documents are scored and reordered, the rest follow unchanged
+        head = documents if top_m is None else documents[:top_m]
+        results = [{**doc, 'cross_encoder_score': score} for doc, score in zip(head, self.score(query, head))]
+        results = sorted(results, key=lambda r: r['cross_encoder_score'], reverse=True)
+        return results + [{**doc, 'cross_encoder_score': None} for doc in documents[len(head):]]
+
+
+components.register('cross_encoder', CrossEncoderReranker)
+
+
+def get_reranker():
+    return components.get('cross_encoder')
+
+
+async def _rate_document(query, doc, semaphore, pool, timeout, retries, backoff, fallback_score):
+    loop = asyncio.get_running_loop()
+    async with semaphore:
+        for attempt in range(retries + 1):
+            if attempt:
+                await asyncio.sleep(backoff * 2 ** (attempt - 1))
+            call = loop.run_in_executor(
+                pool, lambda: complete('individual_rerank.md', query=query, title=doc["title"], description=doc["description"]))
+            tracing.count('rerank.llm_calls')
+            try:
+                response = await asyncio.wait_for(call, timeout)
+            except Exception:
+                # timeouts and client errors alike are retried
+                tracing.count('rerank.failed_calls')
+                continue
+            try:
+                return int((response or "0").strip())
+            except ValueError:
+                # an unparsable answer comes back the same from the response cache, so do not retry it
+                tracing.count('rerank.fallback_scores')
+                return fallback_score
+    tracing.count('rerank.fallback_scores')
+    return fallback_score
+
+
+async def _rate_documents(query, documents, concurrency, timeout, retries, backoff, fallback_score):
+    semaphore = asyncio.Semaphore(concurrency)
+    # timed out calls keep their thread until the client returns, so retries get threads of their own
+    pool = ThreadPoolExecutor(max_workers=concurrency * (retries + 1))
+    try:
+        return await asyncio.gather(*(
+            _rate_document(query, doc, semaphore, pool, timeout, retries, backoff, fallback_score)
+            for doc in documents))
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def individual_rerank(query, documents, concurrency=RERANK_CONCURRENCY, timeout=RERANK_TIMEOUT,
+                      retries=RERANK_RETRIES, backoff=RERANK_BACKOFF, fallback_score=RERANK_FALLBACK_SCORE):
+    # every document is rated by its own LLM call, up to `concurrency` of them in flight at once
+    scores = asyncio.run(_rate_documents(query, documents, concurrency, timeout, retries, backoff, fallback_score))
     results = []
-    for doc in documents:
-        prompt1 = prompt.format(query=query, title=doc["title"], description=doc["description"])
-        response = client.models.generate_content(model=model, contents=prompt1)
-        clean_response_text = (response.text or "0").strip()
-        data = {**doc, 'rerank_response': int(clean_response_text)}
+    for doc, score in zip(documents, scores):
+        data = {**doc, 'rerank_response': score}
 
         print(data["title"], data["rerank_response"], sep='\t')
 
         results.append(data)
-
-        # doc["rerank_response"] =
+    # stable, documents with equal ratings keep their retrieval order
     results = sorted(results, key=lambda r: r['rerank_response'], reverse=True)
     return results
 
 
 def batch_rerank(query, documents):
-    with open(PROMPT_PATH / 'batch_rerank.md') as f:
-        prompt = f.read()
     mtemp = '''<movie id={idx}=>{title}>\n{desc}\n</movie>\n'''
     doc_list_str = ''
     for idx, doc in enumerate(documents):
         doc_list_str += mtemp.format(idx=idx, title=doc["title"], desc=doc["description"])
 
-    prompt1 = prompt.format(
-        query=query,
-        doc_list_str=doc_list_str)
-    response = client.models.generate_content(model=model, contents=prompt1)
+    response = complete('batch_rerank.md', query=query, doc_list_str=doc_list_str)
 
-    response_parsed = json.loads(response.text.strip('```json').strip('```').strip())
+    response_parsed = json.loads(response.strip('```json').strip('```').strip())
     results = []
     for idx, doc in enumerate(documents):
         results.append({**doc, 'rerank_score': response_parsed.index(idx)})
@@ -56,14 +154,5 @@ def batch_rerank(query, documents):
     return results
 
 
-def cross_encoder_rerank(query, documents):
-    pairs = []
-    for doc in documents:
-        pairs.append([query, f"{doc.get('title', '')} - {doc.get('document', '')}"])
-    cross_encoder = CrossEncoder("cross-encoder/ms-marco-TinyBERT-L2-v2")
-    scores = cross_encoder.predict(pairs)
-    results = []
-    for idx, doc in enumerate(documents):
-        results.append({**doc, 'cross_encoder_score': scores[idx]})
-    results = sorted(results, key=lambda r: r['cross_encoder_score'], reverse=True)
-    return results
+def cross_encoder_rerank(query, documents, top_m=None):
+    return get_reranker().rerank(query, documents, top_m)
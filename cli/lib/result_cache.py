@@ -0,0 +1,41 @@
+import hashlib
+import json
+
+from lib.search_utils import CACHE_PATH, json_default
+from lib.two_tier_cache import TwoTierCache
+
+RESULT_CACHE_SIZE = 1_000
+RESULT_DISK_CACHE_SIZE = 100_000
+
+
+def data_version(*paths):
+    # changes whenever one of paths is rewritten, e.g. an index header or embedding matrix on rebuild
+    digest = hashlib.sha1()
+    for path in paths:
+        if path.exists():
+            stat = path.stat()
+            digest.update(f'{path}:{stat.st_mtime_ns}:{stat.st_size};'.encode())
+    return digest.hexdigest()[:16]
+
+
+class ResultCache(TwoTierCache):
+    # search key -> final response, an in-process LRU optionally backed by a sqlite store under
+    # CACHE_PATH (disk_size > 0). Keys are lists of JSON values that should include a data_version(),
+    # so entries of a rebuilt index or embeddings are never hit again and age out of both tiers.
+    # Responses are kept as JSON, every hit decodes a fresh copy
+    counter = 'result_cache'
+
+    def __init__(self, size=RESULT_CACHE_SIZE, disk_size=0, path=None):
+        super().__init__(size, disk_size, path or CACHE_PATH / 'results.sqlite')
+
+    def dump(self, response):
+        return json.dumps(response, default=json_default)
+
+    def load(self, stored):
+        return json.loads(stored)
+
+    def get(self, key):
+        return super().get(json.dumps(key))
+
+    def put(self, key, response):
+        super().put(json.dumps(key), response)
@@ -0,0 +1,192 @@
+import http.client
+import json
+import os
+import socket
+import socketserver
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from lib import tracing
+from lib.search_utils import json_default
+
+SERVER_ADDRESS = 'http://127.0.0.1:8765'
+SEARCH_METHODS = ('keyword', 'semantic', 'weighted', 'rrf')
+
+
+class SearchService:
+    # everything expensive is loaded once here and reused by every request
+    def __init__(self, warm_reranker=True, nprobe=None, sharded=False, disk_cache=False):
+        from lib import components
+        from lib.hybrid_search import HybridSearch, result_cache
+        from lib.rerank import get_reranker
+
+        started = time.perf_counter()
+        self.hybrid = HybridSearch(nprobe=nprobe, sharded=sharded, result_cache=result_cache(disk_cache))
+        # the embedding model is lazy, load it now rather than on the first request
+        components.warm('embedding_model')
+        self.idx = self.hybrid.idx
+        self.semantic_search = self.hybrid.semantic_search
+        if warm_reranker:
+            get_reranker()
+        self.load_seconds = time.perf_counter() - started
+        # index caches and the embedding model are not safe to share across request threads
+        self._lock = threading.Lock()
+
+    def search(self, method, query, limit=5, k=60, alpha=0.5, enhance=None, rerank_method=None, rerank_top=None):
+        with self._lock:
+            match method:
+                case 'keyword':
+                    return {'query': query, 'results': self.idx.bm25_search(query, limit)}
+                case 'semantic':
+                    return {'query': query, 'results': self.semantic_search.search_chunks(query, limit)}
+                case 'weighted':
+                    return self.hybrid.weighted_query(query, alpha, limit)
+                case 'rrf':
+                    return self.hybrid.rrf_query(query, k, limit, enhance, rerank_method, rerank_top)
+        raise ValueError(f"unknown search method {method!r}, expected one of {', '.join(SEARCH_METHODS)}")
+
+
+class SearchRequestHandler(BaseHTTPRequestHandler):
+    service = None
+
+    def _send(self, status, payload):
+        body = json.dumps(payload, default=json_default).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_text(self, status, text, content_type):
+        body = text.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path == '/health':
+            self._send(200, {'status': 'ok', 'load_seconds': self.service.load_seconds,
+                             'query_cache': self.service.semantic_search.query_cache.stats(),
+                             'result_cache': self.service.hybrid.result_cache.stats()})
+        elif url.path == '/metrics':
+            # Prometheus text by default, ?format=json for the raw snapshot; empty unless serving with --metrics
+            if urllib.parse.parse_qs(url.query).get('format') == ['json']:
+                self._send(200, {'enabled': tracing.enabled(), **tracing.snapshot()})
+            else:
+                self._send_text(200, tracing.metrics_text(), 'text/plain; version=0.0.4; charset=utf-8')
+        else:
+            self._send(404, {'error': f"no route {self.path}"})
+
+    def do_POST(self):
+        if self.path != '/search':
+            self._send(404, {'error': f"no route {self.path}"})
+            return
+        try:
+            params = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            started = time.perf_counter()
+            with tracing.span('server.search'):
+                response = self.service.search(**params)
+            response['elapsed_ms'] = (time.perf_counter() - started) * 1000
+        except (TypeError, ValueError) as e:
+            self._send(400, {'error': str(e)})
+            return
+        except Exception as e:
+            # anything else is the server's fault; the client still gets a JSON answer
+            tracing.count('server.errors')
+            self.log_error('search failed: %r', e)
+            self._send(500, {'error': str(e)})
+            return
+        self._send(200, response)
+
+    def address_string(self):
+        # unix socket peers have no host/port
+        return self.client_address[0] if self.client_address else 'unix'
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        socketserver.UnixStreamServer.server_bind(self)
+        self.server_name, self.server_port = 'localhost', 0
+
+
+def _parse_address(address):
+    parsed = urllib.parse.urlparse(address)
+    if parsed.scheme == 'unix':
+        return 'unix', parsed.path
+    if parsed.scheme == 'http':
+        return 'http', (parsed.hostname or '127.0.0.1', parsed.port or 80)
+    raise ValueError(f"server address must be http://host:port or unix:///path, got {address!r}")
+
+
+def serve(address=SERVER_ADDRESS, nprobe=None, metrics=False, sharded=False, disk_cache=False):
+    kind, location = _parse_address(address)
+    if metrics:
+        tracing.enable()
+    print("loading search components...")
+    handler = type('BoundSearchRequestHandler', (SearchRequestHandler,), {'service': SearchService(nprobe=nprobe, sharded=sharded, disk_cache=disk_cache)})
+    print(f"loaded in {handler.service.load_seconds:.2f}s")
+    if kind == 'unix':
+        if os.path.exists(location):
+            os.remove(location)
+        server = ThreadingUnixHTTPServer(location, handler)
+    else:
+        server = ThreadingHTTPServer(location, handler)
+    print(f"serving on {address}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class SearchClient:
+    def __init__(self, address=SERVER_ADDRESS, timeout=60):
+        self.kind, self.location = _parse_address(address)
+        self.timeout = timeout
+
+    def _connection(self):
+        if self.kind == 'unix':
+            return _UnixHTTPConnection(self.location, self.timeout)
+        return http.client.HTTPConnection(*self.location, timeout=self.timeout)
+
+    def _request(self, verb, path, payload=None):
+        conn = self._connection()
+        try:
+            body = json.dumps(payload) if payload is not None else None
+            conn.request(verb, path, body=body, headers={'Content-Type': 'application/json'})
+            response = conn.getresponse()
+            data = json.loads(response.read())
+        finally:
+            conn.close()
+        if response.status != 200:
+            raise RuntimeError(f"search server error {response.status}: {data.get('error')}")
+        return data
+
+    def health(self):
+        return self._request('GET', '/health')
+
+    def metrics(self):
+        return self._request('GET', '/metrics?format=json')
+
+    def search(self, method, query, **params):
+        params = {key: value for key, value in params.items() if value is not None}
+        return self._request('POST', '/search', {'method': method, 'query': query, **params})
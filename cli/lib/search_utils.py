@@ -1,19 +1,99 @@
+import hashlib
 import json
+import os
 
 from pathlib import Path
 project_root = Path(__file__).resolve().parent.parent.parent
 data_path = project_root/'data'/'movies.json'
+jsonl_path = project_root/'data'/'movies.jsonl'
 stopwords_path = project_root/'data'/'stopwords.txt'
 BM25_K1 = 1.5
 BM25_B = 0.75
-CACHE_PATH = project_root/'cache'
+# SEARCH_CACHE_PATH points everything built or cached at another directory, e.g. a benchmark's scratch one
+CACHE_PATH = Path(os.environ.get('SEARCH_CACHE_PATH', project_root/'cache'))
 PROMPT_PATH = project_root / 'cli' / 'lib' / 'prompts'
 
+READ_SIZE = 1 << 16
+
+
 def load_movies()->list[dict]:
-    with open(data_path, mode='r') as f:
-        data = json.load(f)
-        return data['movies']
+    return list(iter_movies())
+
+
+def iter_movies(path=None):
+    # movies one at a time: JSON Lines when data/movies.jsonl exists, otherwise the "movies" array of
+    # movies.json decoded incrementally, so the whole file is never parsed into memory at once
+    if path is None:
+        path = jsonl_path if jsonl_path.exists() else data_path
+    if path.suffix == '.jsonl':
+        with open(path, mode='r') as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        return
+    yield from _iter_json_array(path, 'movies')
+
+
+def _iter_json_array(path, key):
+    decoder = json.JSONDecoder()
+    with open(path, mode='r') as f:
+        buffer = ''
+        while True:
+            chunk = f.read(READ_SIZE)
+            buffer += chunk
+            start = buffer.find(f'"{key}"')
+            bracket = buffer.find('[', start) if start >= 0 else -1
+            if bracket >= 0:
+                buffer = buffer[bracket + 1:]
+                break
+            if not chunk:
+                raise ValueError(f"no {key!r} array in {path}")
+        pos = 0
+        while True:
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+                pos += 1
+            if pos < len(buffer) and buffer[pos] == ']':
+                return
+            try:
+                item, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                # the next item is cut off at the end of the buffer
+                chunk = f.read(READ_SIZE)
+                if not chunk:
+                    raise
+                buffer = buffer[pos:] + chunk
+                pos = 0
+                continue
+            yield item
+            pos = end
+            if pos > READ_SIZE:
+                buffer = buffer[pos:]
+                pos = 0
 def load_stopwords():
     with open(stopwords_path, mode='r') as f:
         data = f.read().splitlines(keepends= False)
-    return data
\ No newline at end of file
+    return data
+
+
+def document_hash(doc):
+    return hashlib.sha256(json.dumps(doc, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def load_manifest(path):
+    # {doc_id: content hash} of the documents an index or embedding file was built from
+    if not path.exists():
+        return None
+    with open(path, mode='r') as f:
+        return {int(doc_id): doc_hash for doc_id, doc_hash in json.load(f).items()}
+
+
+def save_manifest(path, manifest):
+    with open(path, mode='w') as f:
+        json.dump({str(doc_id): doc_hash for doc_id, doc_hash in manifest.items()}, f)
+
+
+def json_default(value):
+    # json.dumps default for numpy scalars and arrays in search results
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
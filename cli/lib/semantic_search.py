@@ -1,145 +1,607 @@
+import itertools
 import json
+import os
 import re
-from collections import defaultdict
+import time
 
 import numpy as np
-from sentence_transformers import SentenceTransformer
 
-from lib.search_utils import load_movies, CACHE_PATH
+from lib import components, tracing
+from lib.ann import IVFIndex
+from lib.batch_search import QUERY_BATCH_SIZE, run_batch
+from lib.embedding_cache import EmbeddingCache
+from lib.keyword_search import load_docmap
+from lib.quantization import QuantizedMatrix, STORAGE_TYPES
+from lib.search_utils import iter_movies, load_movies, CACHE_PATH, document_hash, load_manifest, save_manifest
+
+MODEL_NAME = 'all-MiniLM-L6-v2'
+DEFAULT_NPROBE = 8
+# quantized storage rescores max(limit * RESCORE_FACTOR, RESCORE_MIN) candidates in full precision
+RESCORE_FACTOR = 4
+RESCORE_MIN = 50
+# documents are chunked and encoded in batches of this many so a build streams over the corpus
+EMBED_BATCH_SIZE = 10_000
+
+
+def _load_embedding_model():
+    from sentence_transformers import SentenceTransformer
+
+    return SentenceTransformer(MODEL_NAME)
+
+
+components.register('embedding_model', _load_embedding_model)
 
 
 class SemanticSearch:
-    def __init__(self):
-        self.model = SentenceTransformer('all-MiniLM-L6-v2')
+    def __init__(self, storage='float32'):
+        if storage not in STORAGE_TYPES:
+            raise ValueError(f"storage must be one of {', '.join(STORAGE_TYPES)}")
+        # query embeddings, so repeated queries never reach the model
+        self.query_cache = EmbeddingCache(MODEL_NAME, path=CACHE_PATH / 'query_embeddings.sqlite')
+        self.storage = storage
         self.embeddings = None
+        self._normalized_embeddings = None
+        self._quantized_embeddings = None
         self.documents = None
         self.document_map = {}
+        # doc id of each embedding row
+        self.row_ids = []
         self.embeddings_path = CACHE_PATH / 'embeddings.npy'
 
+    @property
+    def model(self):
+        # shared and loaded on first use, commands that never embed never load it
+        return components.get('embedding_model')
+
+    @property
+    def manifest_path(self):
+        # cache/embeddings.npy -> cache/embeddings.manifest.json, {doc_id: content hash} in row order
+        return self.embeddings_path.with_suffix('.manifest.json')
+
     def build_embeddings(self, documents):
-        self.documents = documents
-        movie_strings = []
-        for doc in documents:
-            self.document_map[doc['id']] = doc
-            movie_strings.append(f"{doc['title']}: {doc['description']}")
-        self.embeddings = self.model.encode(movie_strings, show_progress_bar=True)
-        np.save(self.embeddings_path, self.embeddings)
+        # documents may be any iterable, it is encoded batch by batch
+        self.documents = []
+        self.document_map = {}
+        manifest = {}
+        batches = []
+        for batch in itertools.batched(documents, EMBED_BATCH_SIZE):
+            movie_strings = []
+            for doc in batch:
+                self.document_map[doc['id']] = doc
+                manifest[doc['id']] = document_hash(doc)
+                movie_strings.append(f"{doc['title']}: {doc['description']}")
+            batches.append(self.model.encode(movie_strings, show_progress_bar=True))
+            self.documents += batch
+        embeddings = np.concatenate(batches) if batches else self.model.encode([])
+        np.save(self.embeddings_path, embeddings)
+        save_manifest(self.manifest_path, manifest)
+        self.row_ids = [doc['id'] for doc in self.documents]
+        self._set_embeddings(embeddings)
         return self.embeddings
 
+    def _set_embeddings(self, embeddings):
+        # rows are L2-normalized once so cosine similarity becomes a single matmul per query; with
+        # quantized storage the float32 rows stay memory-mapped and are only read for rescoring
+        self.embeddings = embeddings
+        if self.storage == 'float32':
+            self._normalized_embeddings = normalize_rows(embeddings)
+        else:
+            self._normalized_embeddings = None
+            self._quantized_embeddings = QuantizedMatrix.load_or_create(self.embeddings_path, self.storage, embeddings)
+
+    def _mmap_mode(self):
+        return None if self.storage == 'float32' else 'r'
+
+    def load_embeddings(self, document_map):
+        # the saved embeddings as they are, for querying only: documents are looked up in document_map
+        # (e.g. the index's document store) so the corpus is never read; False when nothing usable is saved
+        manifest = load_manifest(self.manifest_path)
+        if manifest is None or not self.embeddings_path.exists():
+            return False
+        embeddings = np.load(self.embeddings_path, mmap_mode=self._mmap_mode())
+        if len(manifest) != len(embeddings):
+            return False
+        self.documents = None
+        self.document_map = document_map
+        self.row_ids = list(manifest)
+        self._set_embeddings(embeddings)
+        return True
+
     def load_or_create_embeddings(self, documents):
-        embeddings = documents
+        documents = list(documents)
         self.document_map = {}
         self.documents = documents
         # docs and embeddings match check
         for doc in self.documents:
             self.document_map[doc['id']] = doc
         if self.embeddings_path.exists():
-            self.embeddings = np.load(self.embeddings_path)
-            if len(self.documents) == len(self.embeddings):
+            embeddings = np.load(self.embeddings_path, mmap_mode=self._mmap_mode())
+            manifest = load_manifest(self.manifest_path)
+            if manifest is None and len(self.documents) == len(embeddings):
+                # embeddings saved before manifests existed are trusted as they always were
+                save_manifest(self.manifest_path, {doc['id']: document_hash(doc) for doc in documents})
+                self.row_ids = [doc['id'] for doc in documents]
+                self._set_embeddings(embeddings)
+                return self.embeddings
+            if manifest is not None and len(manifest) == len(embeddings):
+                self.row_ids = [doc['id'] for doc in documents]
+                self._set_embeddings(self._sync_embeddings(embeddings, manifest, documents))
                 return self.embeddings
         return self.build_embeddings(documents)
 
+    def _sync_embeddings(self, embeddings, manifest, documents):
+        # rows of documents whose content hash is unchanged are reused, only the others are encoded
+        rows = {doc_id: row for row, doc_id in enumerate(manifest)}
+        hashes = [document_hash(doc) for doc in documents]
+        reused = [rows[doc['id']] if manifest.get(doc['id']) == doc_hash else -1
+                  for doc, doc_hash in zip(documents, hashes)]
+        if reused == list(range(len(embeddings))):
+            return embeddings
+        reused = np.asarray(reused, dtype=np.int64)
+        synced = np.empty((len(documents), embeddings.shape[1]), dtype=embeddings.dtype)
+        kept = np.flatnonzero(reused >= 0)
+        synced[kept] = embeddings[reused[kept]]
+        changed = np.flatnonzero(reused < 0)
+        if len(changed):
+            synced[changed] = self.model.encode(
+                [f"{documents[i]['title']}: {documents[i]['description']}" for i in changed])
+        np.save(self.embeddings_path, synced)
+        save_manifest(self.manifest_path, {doc['id']: doc_hash for doc, doc_hash in zip(documents, hashes)})
+        return synced
+
     def generate_embeddings(self, text):
         if not text or not text.strip():
             raise ValueError('text is empty')
-        return self.model.encode([text])[0]
+        embedding = self.query_cache.get(text)
+        if embedding is None:
+            with tracing.span('semantic.embed_query'):
+                embedding = self.model.encode([text])[0]
+            self.query_cache.put(text, embedding)
+        return embedding
+
+    def generate_embeddings_many(self, texts):
+        # cached texts are looked up, the rest are encoded in a single batch
+        for text in texts:
+            if not text or not text.strip():
+                raise ValueError('text is empty')
+        embeddings = [self.query_cache.get(text) for text in texts]
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if missing:
+            with tracing.span('semantic.embed_query'):
+                encoded = self.model.encode([texts[i] for i in missing])
+            for i, embedding in zip(missing, encoded):
+                self.query_cache.put(texts[i], embedding)
+                embeddings[i] = embedding
+        return np.stack(embeddings) if embeddings else self.model.encode(texts)
 
     def search(self, query, limit):
         if self.embeddings is None:
             raise ValueError('embeddings is None')
-        query_embedding = self.generate_embeddings(query)
-        similarities = []
-        for doc_emb, doc in zip(self.embeddings, self.documents):
-            _similarity = cosine_similarity(query_embedding, doc_emb)
-            similarities.append((_similarity, doc))
-        similarities.sort(key=lambda x: x[0], reverse=True)
+        scores = self._document_scores(normalize_rows(self.generate_embeddings(query)), limit)
+        return self._format_document_results(scores, limit)
+
+    def search_many(self, queries, limit):
+        if self.embeddings is None:
+            raise ValueError('embeddings is None')
+        query_embs = normalize_rows(self.generate_embeddings_many(queries))
+        if self.storage == 'float32':
+            scores = query_embs @ self._normalized_embeddings.T
+        else:
+            scores = [self._document_scores(query_emb, limit) for query_emb in query_embs]
+        return [self._format_document_results(row, limit) for row in scores]
+
+    def _document_scores(self, query_emb, limit):
+        # cosine score per document; with quantized storage only the shortlist of the approximate
+        # pass is rescored in full precision and everything else is left at -inf
+        with tracing.span('semantic.document_scores'):
+            if self.storage == 'float32':
+                return self._normalized_embeddings @ query_emb
+            approx = self._quantized_embeddings.scores(query_emb)
+            shortlist = np.sort(top_k_indices(approx, rescore_size(limit)))
+            scores = np.full(len(approx), -np.inf, dtype=np.float32)
+            scores[shortlist] = normalize_rows(self.embeddings[shortlist]) @ query_emb
+            return scores
+
+    def _format_document_results(self, scores, limit):
         results = []
-        for sc, doc in similarities[:limit]:
-            results.append({'score': sc, 'title': doc['title'], 'description': doc['description'][100], })
+        for i in top_k_indices(scores, limit):
+            doc = self.document_map[self.row_ids[i]]
+            results.append({'score': scores[i], 'title': doc['title'], 'description': doc['description'][:100], })
         return results
 
 
 class ChunkedSemanticSearch(SemanticSearch):
-    def __init__(self):
-        super().__init__()
+    def __init__(self, storage='float32'):
+        super().__init__(storage)
         self.chunk_embeddings = None
+        self._normalized_chunk_embeddings = None
+        self._quantized_chunk_embeddings = None
         self.chunk_metadata = None
         self.metadata_path = CACHE_PATH / 'chunk_metadata.json'
         self.embeddings_path = CACHE_PATH / 'chunk_embeddings.npy'
-
-    def build_chunk_embeddings(self, documents):
-        self.documents = documents
-        self.document_map = {doc['id']: doc for doc in documents}
+        # optional IVF index over the chunk embeddings, see enable_ann()
+        self.ann_index = None
+        self.ann_nprobe = DEFAULT_NPROBE
+        self.ann_path = CACHE_PATH / 'chunk_ivf.npz'
+        # {doc_id: description hash} of the documents the chunk embeddings were built from
+        self.manifest = {}
+
+    def _chunk_documents(self, documents):
+        # chunks only depend on the description, so that is all the manifest hashes
         all_chunks = []
         chunk_metadata = []
-        for midx, doc in enumerate(documents):
+        for doc in documents:
             if doc['description'].strip() == '':
                 continue
             chunks = semantic_chunk(doc['description'], overlap=1, max_chunk_size=4)
             all_chunks += chunks
             for cidx in range(len(chunks)):
-                chunk_metadata.append({"movie_idx": midx + 1, "chunk_idx": cidx + 1, "total_chunks": len(chunks)})
-        self.chunk_embeddings = self.model.encode(all_chunks, show_progress_bar=True)
-        self.chunk_metadata = chunk_metadata
-        np.save(self.embeddings_path, self.chunk_embeddings)
-        self.chunk_metadata = {'chunks': chunk_metadata, 'total_chunks': len(all_chunks)}
+                chunk_metadata.append({"movie_idx": doc['id'], "chunk_idx": cidx + 1, "total_chunks": len(chunks)})
+        return all_chunks, chunk_metadata
+
+    def build_chunk_embeddings(self, documents):
+        # documents may be any iterable, it is chunked and encoded batch by batch
+        with tracing.span('embeddings.build'):
+            self.documents = []
+            self.manifest = {}
+            chunk_metadata = []
+            batches = []
+            for batch in itertools.batched(documents, EMBED_BATCH_SIZE):
+                batch_chunks, batch_metadata = self._chunk_documents(batch)
+                if batch_chunks:
+                    batches.append(self.model.encode(batch_chunks, show_progress_bar=True))
+                chunk_metadata += batch_metadata
+                self.documents += batch
+                for doc in batch:
+                    self.manifest[doc['id']] = document_hash(doc['description'])
+            self.document_map = {doc['id']: doc for doc in self.documents}
+            chunk_embeddings = np.concatenate(batches) if batches else self.model.encode([])
+            self._save_chunk_embeddings(chunk_embeddings, chunk_metadata)
+            return self.chunk_embeddings
+
+    def _save_chunk_embeddings(self, chunk_embeddings, chunk_metadata):
+        np.save(self.embeddings_path, chunk_embeddings)
+        ann_enabled = self.ann_index is not None
+        self._set_chunk_embeddings(chunk_embeddings, {'chunks': chunk_metadata, 'total_chunks': len(chunk_metadata)})
         with open(self.metadata_path, 'w') as f:
             json.dump(self.chunk_metadata, f)
-        return self.chunk_embeddings
-
-    def load_or_create_chunk_embeddings(self, documents: list[dict]):
-        self.documents = documents
-        self.document_map = {doc['id']: doc for doc in documents}
-        if self.embeddings_path.exists() and self.metadata_path.exists():
-            self.chunk_embeddings = np.load(self.embeddings_path)
+        save_manifest(self.manifest_path, self.manifest)
+        if ann_enabled:
+            self.enable_ann(self.ann_nprobe)
+
+    def _replace_chunks(self, doc_ids, chunk_embeddings, chunk_metadata):
+        # drops every chunk of doc_ids, adds the new ones and lays the rows out in document order with
+        # chunks in order, exactly as a full build over self.documents would
+        old_metadata = self.chunk_metadata['chunks']
+        keep = np.fromiter((m['movie_idx'] not in doc_ids for m in old_metadata), dtype=bool, count=len(old_metadata))
+        embeddings = np.concatenate([np.asarray(self.chunk_embeddings)[keep], chunk_embeddings]).astype(
+            self.chunk_embeddings.dtype, copy=False)
+        metadata = [m for m, kept in zip(old_metadata, keep) if kept] + chunk_metadata
+        positions = {doc['id']: pos for pos, doc in enumerate(self.documents)}
+        order = np.lexsort((
+            np.asarray([m['chunk_idx'] for m in metadata], dtype=np.int64),
+            np.asarray([positions[m['movie_idx']] for m in metadata], dtype=np.int64)))
+        self._save_chunk_embeddings(embeddings[order], [metadata[i] for i in order])
+
+    def upsert_documents(self, documents):
+        # re-chunks and re-encodes only documents that are new or whose description changed
+        changed = []
+        for doc in documents:
+            doc_hash = document_hash(doc['description'])
+            if self.manifest.get(doc['id']) != doc_hash:
+                changed.append((doc, doc_hash))
+        updates = {doc['id']: doc for doc in documents}
+        self.documents = [updates.pop(doc['id'], doc) for doc in self.documents] + list(updates.values())
+        self.document_map = {doc['id']: doc for doc in self.documents}
+        if not changed:
+            return 0
+        all_chunks, chunk_metadata = self._chunk_documents([doc for doc, _ in changed])
+        if all_chunks:
+            chunk_embeddings = self.model.encode(all_chunks)
+        else:
+            chunk_embeddings = np.zeros((0, self.chunk_embeddings.shape[1]), dtype=self.chunk_embeddings.dtype)
+        for doc, doc_hash in changed:
+            self.manifest[doc['id']] = doc_hash
+        self._replace_chunks({doc['id'] for doc, _ in changed}, chunk_embeddings, chunk_metadata)
+        return len(changed)
+
+    def delete_documents(self, doc_ids):
+        doc_ids = {doc_id for doc_id in doc_ids if doc_id in self.manifest}
+        if not doc_ids:
+            return 0
+        self.documents = [doc for doc in self.documents if doc['id'] not in doc_ids]
+        self.document_map = {doc['id']: doc for doc in self.documents}
+        for doc_id in doc_ids:
+            del self.manifest[doc_id]
+        empty = np.zeros((0, self.chunk_embeddings.shape[1]), dtype=self.chunk_embeddings.dtype)
+        self._replace_chunks(doc_ids, empty, [])
+        return len(doc_ids)
+
+    def sync_documents(self, documents):
+        # brings the saved chunk embeddings in line with documents, in their order
+        live_ids = {doc['id'] for doc in documents}
+        deleted = self.delete_documents([doc_id for doc_id in self.manifest if doc_id not in live_ids])
+        self.documents = list(documents)
+        upserted = self.upsert_documents(documents)
+        return upserted, deleted
+
+    def _set_chunk_embeddings(self, chunk_embeddings, chunk_metadata):
+        self.chunk_embeddings = chunk_embeddings
+        self.chunk_metadata = chunk_metadata
+        if self.storage == 'float32':
+            self._normalized_chunk_embeddings = normalize_rows(chunk_embeddings)
+        else:
+            self._normalized_chunk_embeddings = None
+            self._quantized_chunk_embeddings = QuantizedMatrix.load_or_create(
+                self.embeddings_path, self.storage, chunk_embeddings)
+        movie_idx = np.asarray([m['movie_idx'] for m in chunk_metadata['chunks']], dtype=np.int64)
+        # chunks grouped by movie (stable) so the per-movie max is a single reduceat over the scores
+        self._chunk_order = np.argsort(movie_idx, kind='stable')
+        grouped = movie_idx[self._chunk_order]
+        if len(grouped):
+            self._chunk_group_starts = np.flatnonzero(np.r_[True, grouped[1:] != grouped[:-1]])
+        else:
+            self._chunk_group_starts = np.zeros(0, dtype=np.int64)
+        self._chunk_group_ends = np.r_[self._chunk_group_starts[1:], len(grouped)].astype(np.int64)
+        self._chunk_movie_keys = grouped[self._chunk_group_starts]
+        # index of each movie's first chunk, ties between movies keep this order
+        self._chunk_movie_first = self._chunk_order[self._chunk_group_starts]
+        self._chunk_movie_group = np.empty(len(movie_idx), dtype=np.int64)
+        self._chunk_movie_group[self._chunk_order] = np.cumsum(np.r_[True, grouped[1:] != grouped[:-1]])[:len(grouped)] - 1
+        self.ann_index = None
+
+    def enable_ann(self, nprobe=DEFAULT_NPROBE, nlist=None):
+        # route search_chunks through the IVF index, built and saved next to the embeddings on first use
+        if nlist is not None and nlist < 1:
+            raise ValueError(f"nlist must be at least 1, got {nlist}")
+        self.ann_nprobe = nprobe
+        n_chunks = len(self.chunk_embeddings)
+        if nlist is not None:
+            # IVFIndex.build clamps it the same way
+            nlist = min(nlist, n_chunks)
+        if self.ann_path.exists() and os.path.getmtime(self.ann_path) >= os.path.getmtime(self.embeddings_path):
+            ann_index = IVFIndex.load(self.ann_path)
+            if ann_index.size == n_chunks and (nlist is None or ann_index.nlist == nlist):
+                self.ann_index = ann_index
+                return self.ann_index
+        if n_chunks:
+            normalized = self._normalized_chunk_embeddings
+            if normalized is None:
+                normalized = normalize_rows(self.chunk_embeddings)
+            self.ann_index = IVFIndex.build(normalized, nlist)
+            self.ann_index.save(self.ann_path)
+        return self.ann_index
+
+    def disable_ann(self):
+        self.ann_index = None
+
+    def load_chunk_embeddings(self, document_map):
+        # the saved chunks as they are, for querying only: documents are looked up in document_map
+        # (e.g. the index's document store) so the corpus is never read; False when nothing is saved
+        with tracing.span('embeddings.load'):
+            if not (self.embeddings_path.exists() and self.metadata_path.exists()):
+                return False
+            chunk_embeddings = np.load(self.embeddings_path, mmap_mode=self._mmap_mode())
             with open(self.metadata_path, 'r') as f:
-                self.chunk_metadata = json.load(f)
+                self._set_chunk_embeddings(chunk_embeddings, json.load(f))
+            self.documents = None
+            self.document_map = document_map
+            return True
+
+    def load_or_create_chunk_embeddings(self, documents):
+        documents = list(documents)
+        if self.load_chunk_embeddings({doc['id']: doc for doc in documents}):
+            self.documents = documents
+            manifest = load_manifest(self.manifest_path)
+            if manifest is None:
+                # chunks saved before manifests existed are trusted as they always were
+                self.manifest = {doc['id']: document_hash(doc['description']) for doc in documents}
+                save_manifest(self.manifest_path, self.manifest)
+            else:
+                self.manifest = manifest
+                self.sync_documents(documents)
             return self.chunk_embeddings
         return self.build_chunk_embeddings(documents)
 
     def search_chunks(self, query: str, limit: int = 10):
-        query_emb = self.generate_embeddings(query)
-        chunk_scores = []
-        movie_scores = defaultdict(lambda: 0)
-        for idx in range(len(self.chunk_embeddings)):
-            chunk_embedding = self.chunk_embeddings[idx]
-            metadata = self.chunk_metadata['chunks'][idx]
-            midx, cidx = metadata['movie_idx'], metadata['chunk_idx']
-            sim = cosine_similarity(query_emb, chunk_embedding)
-            chunk_scores.append({
-                'movie_idx': midx,
-                'chunk_idx': cidx,
-                'score': sim,
-            })
-            movie_scores[midx] = max(movie_scores[midx], sim)
-        movie_scores_sorted = sorted(movie_scores.items(), key=lambda x: x[1], reverse=True)
-        res = []
-        for midx, score in movie_scores_sorted[:limit]:
-            doc = self.document_map[midx]
-            res.append(
-                {
-                    "id": doc['id'],
-                    "title": doc['title'],
-                    "document": doc['description'][:100],
-                    'score': round(score, 4),
-                    'metadata': {}
-
-                }
-            )
-        return res
-
-
-def searched_chunks(query, limit=10):
-    ss = ChunkedSemanticSearch()
-    movies = load_movies()
-    embeddings = ss.load_or_create_chunk_embeddings(movies)
+        return self._search_chunks_embedding(normalize_rows(self.generate_embeddings(query)), limit)
+
+    def search_chunks_ranked(self, query, limit=10):
+        # (movie ids, rounded scores) arrays in search_chunks order, without touching any document
+        return round_scores(self.top_movies(normalize_rows(self.generate_embeddings(query)), limit))
+
+    def search_chunks_ranked_many(self, queries, limit=10):
+        # search_chunks_ranked for every query, scored with one queries x chunks matmul where possible
+        query_embs = normalize_rows(self.generate_embeddings_many(queries))
+        return [round_scores(top) for top in self.top_movies_many(query_embs, limit)]
+
+    def top_movies(self, query_emb, limit):
+        # (movie ids, unrounded scores) of the best limit movies for a normalized query embedding
+        if self.ann_index is not None:
+            movie_scores, groups = self._ann_movie_scores(query_emb)
+        else:
+            movie_scores, groups = self._chunk_movie_scores(query_emb, limit), None
+        with tracing.span('semantic.rank'):
+            return self._top_movies(movie_scores, groups, limit)
+
+    def top_movies_many(self, query_embs, limit):
+        if self.ann_index is not None or self.storage != 'float32':
+            return [self.top_movies(query_emb, limit) for query_emb in query_embs]
+        with tracing.span('semantic.chunk_scores'):
+            movie_scores = self._movie_max_scores(query_embs @ self._normalized_chunk_embeddings.T)
+        tracing.count('semantic.chunks_scored', len(query_embs) * len(self._normalized_chunk_embeddings))
+        with tracing.span('semantic.rank'):
+            return [self._top_movies(row, None, limit) for row in movie_scores]
+
+    def search_chunks_many(self, queries, limit=10):
+        query_embs = normalize_rows(self.generate_embeddings_many(queries))
+        if self.ann_index is not None or self.storage != 'float32':
+            return [self._search_chunks_embedding(query_emb, limit) for query_emb in query_embs]
+        sims = query_embs @ self._normalized_chunk_embeddings.T
+        return [self._format_movie_results(row, limit) for row in self._movie_max_scores(sims)]
+
+    def _search_chunks_embedding(self, query_emb, limit):
+        if self.ann_index is not None:
+            return self._search_chunks_ann(query_emb, limit)
+        return self._format_movie_results(self._chunk_movie_scores(query_emb, limit), limit)
+
+    def _exact_chunk_scores(self, chunk_ids, query_emb):
+        if self._normalized_chunk_embeddings is not None:
+            return self._normalized_chunk_embeddings[chunk_ids] @ query_emb
+        return normalize_rows(self.chunk_embeddings[chunk_ids]) @ query_emb
+
+    def _chunk_movie_scores(self, query_emb, limit):
+        # best chunk score per movie; quantized storage ranks movies on the approximate scores and
+        # rescores every chunk of the shortlisted movies in full precision, the rest stay at -inf
+        with tracing.span('semantic.chunk_scores'):
+            if self.storage == 'float32':
+                tracing.count('semantic.chunks_scored', len(self._normalized_chunk_embeddings))
+                return self._movie_max_scores(self._normalized_chunk_embeddings @ query_emb)
+            approx = self._movie_max_scores(self._quantized_chunk_embeddings.scores(query_emb))
+            shortlist = top_k_indices(approx, rescore_size(limit), self._chunk_movie_first)
+            if not len(shortlist):
+                return approx
+            chunk_ids = np.sort(np.concatenate([
+                self._chunk_order[self._chunk_group_starts[g]:self._chunk_group_ends[g]] for g in shortlist]))
+            movie_scores = np.full(len(approx), -np.inf, dtype=np.float32)
+            np.maximum.at(movie_scores, self._chunk_movie_group[chunk_ids], self._exact_chunk_scores(chunk_ids, query_emb))
+            movie_scores[shortlist] = np.maximum(movie_scores[shortlist], 0)
+            return movie_scores
+
+    def _search_chunks_ann(self, query_emb, limit):
+        movie_scores, groups = self._ann_movie_scores(query_emb)
+        return self._format_movie_results(movie_scores, limit, groups)
+
+    def _ann_movie_scores(self, query_emb):
+        # exact scores for the chunks in the probed lists only; movies without a probed chunk are missed
+        with tracing.span('semantic.ann_scores'):
+            chunk_ids = np.sort(self.ann_index.candidates(query_emb, self.ann_nprobe))
+            sims = self._exact_chunk_scores(chunk_ids, query_emb)
+            tracing.count('semantic.chunks_scored', len(chunk_ids))
+            groups, inverse = np.unique(self._chunk_movie_group[chunk_ids], return_inverse=True)
+            movie_scores = np.full(len(groups), -np.inf, dtype=sims.dtype)
+            np.maximum.at(movie_scores, inverse, sims)
+            return np.maximum(movie_scores, 0), groups
+
+    def _movie_max_scores(self, sims):
+        # best chunk per movie along the last axis, floored at 0 as the per-movie running max started there
+        if not len(self._chunk_group_starts):
+            return sims[..., :0]
+        grouped = np.take(sims, self._chunk_order, axis=-1)
+        return np.maximum(np.maximum.reduceat(grouped, self._chunk_group_starts, axis=-1), 0)
+
+    def _top_movies(self, movie_scores, groups, limit):
+        # movie_scores[i] belongs to movie group groups[i] (all groups in order when None)
+        if groups is None:
+            groups = np.arange(len(movie_scores))
+        top = top_k_indices(movie_scores, limit, self._chunk_movie_first[groups])
+        return np.asarray(self._chunk_movie_keys[groups[top]], dtype=np.int64), movie_scores[top]
+
+    def _format_movie_results(self, movie_scores, limit, groups=None):
+        return format_movie_results(self.document_map, *round_scores(self._top_movies(movie_scores, groups, limit)))
+
+
+def round_scores(ranked):
+    movie_ids, scores = ranked
+    return movie_ids, np.round(scores, 4)
+
+
+def format_movie_results(document_map, movie_ids, scores):
+    res = []
+    for movie_id, score in zip(movie_ids, scores):
+        doc = document_map[int(movie_id)]
+        res.append(
+            {
+                "id": doc['id'],
+                "title": doc['title'],
+                "document": doc['description'][:100],
+                'score': score,
+                'metadata': {}
+
+            }
+        )
+    return res
+
+
+def searched_chunks(query, limit=10, nprobe=None, storage='float32'):
+    ss = ChunkedSemanticSearch(storage)
+    if not ss.load_chunk_embeddings(load_docmap()):
+        ss.build_chunk_embeddings(iter_movies())
+    if nprobe:
+        ss.enable_ann(nprobe)
     result = ss.search_chunks(query, limit)
+    print_chunk_results(result)
+
+
+def batch_command(source='-', output='-', limit=10, nprobe=None, storage='float32', batch_size=QUERY_BATCH_SIZE):
+    ss = ChunkedSemanticSearch(storage)
+    if not ss.load_chunk_embeddings(load_docmap()):
+        ss.build_chunk_embeddings(iter_movies())
+    if nprobe:
+        ss.enable_ann(nprobe)
+    return run_batch(lambda queries: ss.search_chunks_many(queries, limit), source, output, batch_size)
+
+
+def print_chunk_results(result):
     for i, res in enumerate(result):
         print(f"\n{i + 1}. {res['title']} (score: {res['score']:.4f})")
         print(f"{res['document']}...")
 
 
 
+def ann_recall(limit=10, num_queries=50, nprobes=(1, 2, 4, 8, 16), nlist=None):
+    # recall@limit of the IVF path against exact chunk search, movie titles serve as sample queries
+    css = ChunkedSemanticSearch()
+    movies = load_movies()
+    css.load_or_create_chunk_embeddings(movies)
+    rng = np.random.default_rng(0)
+    picks = rng.choice(len(movies), min(num_queries, len(movies)), replace=False)
+    queries = [movies[i]['title'] for i in picks if movies[i]['title'].strip()]
+    query_embs = normalize_rows(css.generate_embeddings_many(queries))
+
+    started = time.perf_counter()
+    exact = []
+    for query_emb in query_embs:
+        exact.append({r['id'] for r in css._search_chunks_embedding(query_emb, limit)})
+    exact_ms = (time.perf_counter() - started) * 1000 / len(queries)
+
+    ann_index = css.enable_ann(nlist=nlist)
+    print(f"{len(css.chunk_embeddings)} chunks, {ann_index.nlist} lists, {len(queries)} queries, recall@{limit}")
+    print(f"exact: {exact_ms:.3f} ms/query")
+    for nprobe in nprobes:
+        css.ann_nprobe = nprobe
+        started = time.perf_counter()
+        found = [{r['id'] for r in css._search_chunks_ann(query_emb, limit)} for query_emb in query_embs]
+        ann_ms = (time.perf_counter() - started) * 1000 / len(queries)
+        recall = np.mean([len(f & e) / len(e) for f, e in zip(found, exact) if e])
+        print(f"nprobe={nprobe}: recall {recall:.3f}, {ann_ms:.3f} ms/query")
+
+
+def quantization_report(limit=10, num_queries=50):
+    # resident scan matrix size, latency and recall@limit of each storage type against float32
+    css = ChunkedSemanticSearch()
+    movies = load_movies()
+    rng = np.random.default_rng(0)
+    picks = rng.choice(len(movies), min(num_queries, len(movies)), replace=False)
+    queries = [movies[i]['title'] for i in picks if movies[i]['title'].strip()]
+    query_embs = normalize_rows(css.generate_embeddings_many(queries))
+    baseline = None
+    for storage in STORAGE_TYPES:
+        css.storage = storage
+        css.load_or_create_chunk_embeddings(movies)
+        if storage == 'float32':
+            scanned = css._normalized_chunk_embeddings.nbytes
+        else:
+            scanned = css._quantized_chunk_embeddings.nbytes
+        started = time.perf_counter()
+        found = [[r['id'] for r in css._search_chunks_embedding(query_emb, limit)] for query_emb in query_embs]
+        elapsed_ms = (time.perf_counter() - started) * 1000 / len(queries)
+        if baseline is None:
+            baseline = found
+        recall = np.mean([len(set(f) & set(b)) / len(b) for f, b in zip(found, baseline) if b])
+        print(f"{storage}: {scanned / 2 ** 20:.2f} MiB scanned, recall@{limit} {recall:.3f}, {elapsed_ms:.3f} ms/query")
+
+
 def embed_chunks():
     movies = load_movies()
     css = ChunkedSemanticSearch()
@@ -189,16 +651,41 @@ def chunk_text(text, overlap: int, chunk_size=200):
         print(f"{i + 1}.) {chunk}")
 
 
-def search(query, limit=5):
-    ss = SemanticSearch()
-    movies = load_movies()
-    ss.load_or_create_embeddings(movies)
+def search(query, limit=5, storage='float32'):
+    ss = SemanticSearch(storage)
+    if not ss.load_embeddings(load_docmap()):
+        ss.load_or_create_embeddings(iter_movies())
     result = ss.search(query, limit)
 
     for idx, r in enumerate(result):
         print(f'{idx + 1}. score = {r['score']:.2f},{r["title"]}: {r["description"]}')
 
 
+def normalize_rows(matrix):
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+
+def rescore_size(limit):
+    return max(limit * RESCORE_FACTOR, RESCORE_MIN)
+
+
+def top_k_indices(scores, limit, tiebreak=None):
+    # indices of the `limit` highest scores in descending order; equal scores keep ascending
+    # tiebreak (default: index) order, as a stable sort over the full list would
+    if limit <= 0 or not len(scores):
+        return np.zeros(0, dtype=np.int64)
+    if limit < len(scores):
+        kth = np.partition(scores, -limit)[-limit]
+        candidates = np.flatnonzero(scores >= kth)
+    else:
+        candidates = np.arange(len(scores))
+    keys = candidates if tiebreak is None else tiebreak[candidates]
+    return candidates[np.lexsort((keys, -scores[candidates]))[:limit]]
+
+
 def cosine_similarity(vec1, vec2):
     dot_product = np.dot(vec1, vec2)
     norm1 = np.linalg.norm(vec1)
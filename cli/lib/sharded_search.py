@@ -0,0 +1,316 @@
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import threading
+from collections import Counter
+from collections.abc import Mapping
+from contextlib import contextmanager
+
+import numpy as np
+
+from lib import tracing
+from lib.index_format import ColumnarIndex, DocStore
+from lib.keyword_search import InvertedIndex, format_bm25_results
+from lib.search_utils import iter_movies, CACHE_PATH, BM25_K1, BM25_B
+from lib.semantic_search import ChunkedSemanticSearch, SemanticSearch, format_movie_results, normalize_rows, \
+    round_scores
+from lib.spelling import SPELLING_FILE, SpellingDictionary
+
+# the corpus split into contiguous slices, each with its own index and chunk embeddings:
+#   shards/shards.json            num_shards, num_docs, avg_doc_length, sizes, positional (written last)
+#   shards/shard_000/index/       a columnar index of the slice
+#   shards/shard_000/global_df.npy  df over the whole corpus of every term in that index, in term id order
+#   shards/shard_000/chunk_*      the slice's chunk embeddings, metadata and manifest
+#   shards/spelling.json          the spelling dictionary of the whole corpus, with corpus-wide dfs
+SHARDS_PATH = CACHE_PATH / 'shards'
+SHARDS_HEADER = 'shards.json'
+BLAS_THREAD_VARS = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS')
+
+
+def shard_dir(path, shard):
+    return path / f'shard_{shard:03d}'
+
+
+def _shard_index(path, shard, positional=False):
+    idx = InvertedIndex(positional=positional)
+    idx.columnar_path = shard_dir(path, shard) / 'index'
+    return idx
+
+
+def _shard_chunks(path, shard, storage='float32'):
+    chunks = ChunkedSemanticSearch(storage)
+    chunks.metadata_path = shard_dir(path, shard) / 'chunk_metadata.json'
+    chunks.embeddings_path = shard_dir(path, shard) / 'chunk_embeddings.npy'
+    chunks.ann_path = shard_dir(path, shard) / 'chunk_ivf.npz'
+    return chunks
+
+
+def build_shards(num_shards, workers=1, positional=False, movies=None, path=None):
+    # shards are built one after the other, each streamed from the corpus, so at most one slice is in
+    # memory; corpus-wide df and lengths are summed along the way and written once every shard exists
+    if num_shards < 1:
+        raise ValueError("need at least one shard")
+    path = path or SHARDS_PATH
+    if movies is None:
+        num_docs = sum(1 for _ in iter_movies())
+        movies = iter_movies()
+    else:
+        movies = list(movies)
+        num_docs = len(movies)
+    size = max(math.ceil(num_docs / num_shards), 1)
+    movies = iter(movies)
+    global_df = Counter()
+    total_length = 0
+    sizes = []
+    for shard in range(num_shards):
+        with tracing.span('shards.build'):
+            batch = list(itertools.islice(movies, size))
+            idx = _shard_index(path, shard, positional)
+            idx.build(workers, batch)
+            idx.save()
+            global_df.update({term: len(doc_ids) for term, doc_ids in idx.index.items()})
+            total_length += idx._total_doc_length
+            _shard_chunks(path, shard).build_chunk_embeddings(batch)
+            sizes.append(len(batch))
+    for shard in range(num_shards):
+        columnar = ColumnarIndex(shard_dir(path, shard) / 'index')
+        np.save(shard_dir(path, shard) / 'global_df.npy',
+                np.fromiter((global_df[term] for term in columnar.terms()), dtype=np.int64, count=columnar.num_terms))
+    shards_spelling_dictionary(path, num_shards).save(path / SPELLING_FILE)
+    header = {
+        'num_shards': num_shards,
+        'num_docs': num_docs,
+        # the unsharded index's avgdl, statistics.mean() of ints is the correctly rounded quotient too
+        'avg_doc_length': total_length / num_docs if num_docs else 0,
+        'sizes': sizes,
+        'positional': positional,
+    }
+    with open(path / SHARDS_HEADER, 'w') as f:
+        json.dump(header, f)
+    return header
+
+
+def shards_spelling_dictionary(path, num_shards=None):
+    # every shard's words, each with the corpus-wide df of its stem
+    num_shards = num_shards or read_shards_header(path)['num_shards']
+    term_dfs, stems = {}, {}
+    for shard in range(num_shards):
+        columnar = ColumnarIndex(shard_dir(path, shard) / 'index')
+        term_dfs.update(zip(columnar.terms(), np.load(shard_dir(path, shard) / 'global_df.npy').tolist()))
+        stems.update(SpellingDictionary.load(shard_dir(path, shard) / 'index' / SPELLING_FILE).stem_table())
+    return SpellingDictionary.from_index(term_dfs, stems)
+
+
+def read_shards_header(path=None):
+    path = path or SHARDS_PATH
+    if not (path / SHARDS_HEADER).exists():
+        raise ValueError(f"no sharded index at {path}, build it with sharded_search_cli.py build")
+    with open(path / SHARDS_HEADER) as f:
+        return json.load(f)
+
+
+class _Shard:
+    # what one worker process holds: the shard's index scoring with corpus-wide statistics, and its
+    # chunk embeddings; queries arrive analyzed or embedded by the parent only where that is cheaper
+    def __init__(self, path, shard, header, storage='float32', nprobe=None):
+        self.idx = _shard_index(path, shard)
+        self.idx.load()
+        global_df = np.load(shard_dir(path, shard) / 'global_df.npy', mmap_mode='r')
+        columnar = self.idx.columnar
+
+        def df(token):
+            term_id = columnar.term_id(token)
+            return int(global_df[term_id]) if term_id >= 0 else 0
+
+        self.idx.collection_stats = (header['num_docs'], header['avg_doc_length'], df)
+        self.chunks = _shard_chunks(path, shard, storage)
+        self.chunks.load_chunk_embeddings(self.idx.docmap)
+        if nprobe:
+            self.chunks.enable_ann(nprobe)
+
+    def bm25_ranked_many(self, queries, limit, k1=BM25_K1, b=BM25_B):
+        return self.idx.bm25_ranked_many(queries, limit, k1, b)
+
+    def top_movies(self, query_emb, limit):
+        return self.chunks.top_movies(query_emb, limit)
+
+    def top_movies_many(self, query_embs, limit):
+        return self.chunks.top_movies_many(query_embs, limit)
+
+
+def _serve_shard(conn, path, shard, header, storage, nprobe):
+    # worker loop: (method, args) in, (True, result) or (False, exception) out, None to stop
+    try:
+        target = _Shard(path, shard, header, storage, nprobe)
+        conn.send((True, None))
+    except Exception as e:
+        conn.send((False, e))
+        return
+    while (request := conn.recv()) is not None:
+        method, args = request
+        try:
+            conn.send((True, getattr(target, method)(*args)))
+        except Exception as e:
+            conn.send((False, e))
+
+
+@contextmanager
+def _blas_threads(threads):
+    # workers read these when numpy loads, so each shard's matmuls get its share of the cores
+    saved = {name: os.environ.get(name) for name in BLAS_THREAD_VARS}
+    os.environ.update({name: str(threads) for name in BLAS_THREAD_VARS})
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+class ShardPool:
+    # one process per shard, each loading its shard once; scatter() sends a call to every shard and
+    # gathers the replies in shard order
+    def __init__(self, path=None, storage='float32', nprobe=None):
+        self.path = path or SHARDS_PATH
+        self.header = read_shards_header(self.path)
+        self.header_path = self.path / SHARDS_HEADER
+        self.storage = storage
+        num_shards = self.header['num_shards']
+        # spawned rather than forked, the parent may already hold threads or a loaded model
+        context = multiprocessing.get_context('spawn')
+        self._conns = []
+        self._processes = []
+        with _blas_threads(max((os.cpu_count() or 1) // num_shards, 1)):
+            for shard in range(num_shards):
+                parent, child = context.Pipe()
+                process = context.Process(target=_serve_shard, daemon=True,
+                                          args=(child, self.path, shard, self.header, storage, nprobe))
+                process.start()
+                self._conns.append(parent)
+                self._processes.append(process)
+        self._lock = threading.Lock()
+        self._gather()
+        self.docmap = ShardedDocStore([DocStore(ColumnarIndex(shard_dir(self.path, shard) / 'index'))
+                                       for shard in range(num_shards)])
+
+    def _gather(self):
+        replies = []
+        for shard, conn in enumerate(self._conns):
+            try:
+                replies.append(conn.recv())
+            except EOFError:
+                raise RuntimeError(f"shard {shard} worker exited") from None
+        for shard, (ok, value) in enumerate(replies):
+            if not ok:
+                raise RuntimeError(f"shard {shard} failed: {value!r}") from value
+        return [value for _, value in replies]
+
+    def scatter(self, method, *args):
+        with self._lock, tracing.span('shards.scatter'):
+            for conn in self._conns:
+                conn.send((method, args))
+            return self._gather()
+
+    def close(self):
+        for conn in self._conns:
+            conn.send(None)
+        for process in self._processes:
+            process.join()
+        self._conns, self._processes = [], []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+class ShardedDocStore(Mapping):
+    # id -> movie over every shard's document store
+    def __init__(self, stores):
+        self.stores = stores
+
+    def __getitem__(self, doc_id):
+        for store in self.stores:
+            if doc_id in store:
+                return store[doc_id]
+        raise KeyError(doc_id)
+
+    def __contains__(self, doc_id):
+        return any(doc_id in store for store in self.stores)
+
+    def __iter__(self):
+        return itertools.chain.from_iterable(self.stores)
+
+    def __len__(self):
+        return sum(len(store) for store in self.stores)
+
+
+def merge_ranked(shard_results, limit):
+    # the global top limit of per-shard (ids, scores) rankings; shards hold contiguous slices of the
+    # corpus, so breaking ties by shard and then rank is the unsharded index-order tiebreak
+    ids = np.concatenate([ids for ids, _ in shard_results])
+    scores = np.concatenate([scores for _, scores in shard_results])
+    shard = np.repeat(np.arange(len(shard_results)), [len(ids) for ids, _ in shard_results])
+    rank = np.concatenate([np.arange(len(ids)) for ids, _ in shard_results])
+    order = np.lexsort((rank, shard, -scores))[:limit]
+    return ids[order], scores[order]
+
+
+class ShardedIndex:
+    # the InvertedIndex query interface over a ShardPool; every shard returns its own top limit and
+    # the merge keeps the best, with the same scores and order as the unsharded index
+    def __init__(self, pool):
+        self.pool = pool
+        self.docmap = pool.docmap
+
+    def bm25_ranked_many(self, queries, limit=5, k1=BM25_K1, b=BM25_B):
+        per_shard = self.pool.scatter('bm25_ranked_many', queries, limit, k1, b)
+        with tracing.span('shards.merge'):
+            return [merge_ranked(shard_results, limit) for shard_results in zip(*per_shard)]
+
+    def bm25_ranked(self, query, limit=5, k1=BM25_K1, b=BM25_B):
+        return self.bm25_ranked_many([query], limit, k1, b)[0]
+
+    def bm25_search(self, query, limit=5, k1=BM25_K1, b=BM25_B):
+        return format_bm25_results(self.docmap, *self.bm25_ranked(query, limit, k1, b))
+
+
+class ShardedChunkSearch:
+    # the chunk search interface over a ShardPool: queries are embedded once here and scored by
+    # every shard against its own chunks
+    def __init__(self, pool):
+        self.pool = pool
+        self.storage = pool.storage
+        self.document_map = pool.docmap
+        self._embedder = SemanticSearch()
+        self.query_cache = self._embedder.query_cache
+
+    def search_chunks_ranked(self, query, limit=10):
+        query_emb = normalize_rows(self._embedder.generate_embeddings(query))
+        shard_results = self.pool.scatter('top_movies', query_emb, limit)
+        with tracing.span('shards.merge'):
+            return round_scores(merge_ranked(shard_results, limit))
+
+    def search_chunks_ranked_many(self, queries, limit=10):
+        query_embs = normalize_rows(self._embedder.generate_embeddings_many(queries))
+        per_shard = self.pool.scatter('top_movies_many', query_embs, limit)
+        with tracing.span('shards.merge'):
+            return [round_scores(merge_ranked(shard_results, limit)) for shard_results in zip(*per_shard)]
+
+    def search_chunks(self, query, limit=10):
+        return format_movie_results(self.document_map, *self.search_chunks_ranked(query, limit))
+
+    def search_chunks_many(self, queries, limit=10):
+        return [format_movie_results(self.document_map, *ranked)
+                for ranked in self.search_chunks_ranked_many(queries, limit)]
+
+
+def build_command(num_shards, workers=1, positional=False):
+    header = build_shards(num_shards, workers, positional)
+    print(f"built {header['num_shards']} shards of {', '.join(map(str, header['sizes']))} documents in {SHARDS_PATH}")
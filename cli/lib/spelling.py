@@ -0,0 +1,192 @@
+import bisect
+import json
+import os
+
+import numpy as np
+
+from lib import components, tracing
+from lib.analyzer import get_analyzer
+
+SPELLING_FILE = 'spelling.json'
+# words of up to SHORT_WORD_LENGTH letters are corrected within 1 edit, longer ones within MAX_EDIT_DISTANCE;
+# words shorter than MIN_WORD_LENGTH are never corrected
+MAX_EDIT_DISTANCE = 2
+SHORT_WORD_LENGTH = 4
+MIN_WORD_LENGTH = 3
+# letters are counted in this many buckets (code point modulo) for the letter count filter
+LETTER_BUCKETS = 32
+
+
+class SpellingDictionary:
+    # the surface words of the indexed corpus, sorted, each with the df of the term it stems to. A lookup
+    # keeps the words whose length and letter counts are close enough, then runs the edit distance DP
+    # for all of them at once, one letter column at a time, dropping a word as soon as no ending could
+    # bring it back within range
+    def __init__(self, words=(), dfs=(), term_dfs=None, stems=()):
+        self.words = list(words)
+        self.dfs = np.asarray(dfs, dtype=np.int64)
+        # the stem of each word, empty for dictionaries saved before stems were
+        self.stems = list(stems)
+        # {indexed term: df}, words whose stem is indexed are known even if that spelling never was
+        self.term_dfs = term_dfs or {}
+        # letters as a (words x longest word) matrix of code points, zero padded
+        self._lengths = np.fromiter(map(len, self.words), dtype=np.int64, count=len(self.words))
+        codes = np.frombuffer(''.join(self.words).encode('utf-32-le'), dtype=np.uint32)
+        self._letters = np.zeros((len(self.words), int(self._lengths.max(initial=0))), dtype=np.uint32)
+        owner = np.repeat(np.arange(len(self.words)), self._lengths)
+        self._letters[owner, np.arange(len(codes)) - np.repeat(np.cumsum(self._lengths) - self._lengths, self._lengths)] = codes
+        self._letter_counts = np.zeros((len(self.words), LETTER_BUCKETS), dtype=np.int16)
+        np.add.at(self._letter_counts, (owner, codes % LETTER_BUCKETS), 1)
+
+    @classmethod
+    def from_index(cls, term_dfs, stems):
+        # term_dfs {term: df} of an index, stems {surface word: stem} of every word it was built from
+        words = sorted(word for word, stem in stems.items() if term_dfs.get(stem) and word.isalpha())
+        return cls(words, [term_dfs[stems[word]] for word in words], term_dfs, [stems[word] for word in words])
+
+    def save(self, path):
+        os.makedirs(path.parent, exist_ok=True)
+        with open(path, mode='w') as f:
+            json.dump({'words': self.words, 'dfs': self.dfs.tolist(), 'term_dfs': self.term_dfs,
+                       'stems': self.stems}, f)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, mode='r') as f:
+            data = json.load(f)
+        return cls(data['words'], data['dfs'], data['term_dfs'], data.get('stems', ()))
+
+    def stem_table(self):
+        # {word: stem} of every word, for adding to the dictionary when its index is updated
+        if not self.stems:
+            analyzer = get_analyzer()
+            self.stems = [analyzer.stem(word) for word in self.words]
+        return dict(zip(self.words, self.stems))
+
+    def __len__(self):
+        return len(self.words)
+
+    def df(self, word):
+        i = bisect.bisect_left(self.words, word)
+        return int(self.dfs[i]) if i < len(self.words) and self.words[i] == word else 0
+
+    def known(self, word):
+        return self.df(word) > 0 or self.term_dfs.get(get_analyzer().stem(word), 0) > 0
+
+    def candidates(self, word, max_distance=MAX_EDIT_DISTANCE):
+        # (distance, word, df) of every word within max_distance edits of word, where an edit inserts,
+        # deletes or substitutes a letter or swaps two adjacent ones; closest first, then most common
+        n = len(word)
+        query = np.frombuffer(word.encode('utf-32-le'), dtype=np.uint32)
+        steps = np.arange(n + 1, dtype=np.int16)
+        ids = np.flatnonzero(np.abs(self._lengths - n) <= max_distance)
+        # every edit adds at most one letter and removes at most one, a swap neither, so the letters a
+        # word has too many or too few of bound its distance from below
+        surplus = self._letter_counts[ids] - np.bincount(query % LETTER_BUCKETS, minlength=LETTER_BUCKETS).astype(np.int16)
+        ids = ids[np.maximum(np.maximum(surplus, 0).sum(axis=1), np.maximum(-surplus, 0).sum(axis=1)) <= max_distance]
+        letters, lengths = self._letters[ids], self._lengths[ids]
+        # row j of the DP holds the distances of a word's first j letters to every prefix of word
+        previous = np.broadcast_to(steps, (len(ids), n + 1))
+        before = None
+        found_ids, found_distances = [], []
+        for j in range(self._letters.shape[1]):
+            if not len(ids):
+                break
+            letter = letters[:, j:j + 1]
+            row = np.empty((len(ids), n + 1), dtype=np.int16)
+            row[:, 0] = j + 1
+            row[:, 1:] = np.minimum(previous[:, 1:] + 1, previous[:, :-1] + (query != letter))
+            if before is not None and n > 1:
+                swapped = (query[1:] == letters[:, j - 1:j]) & (query[:-1] == letter)
+                row[:, 2:] = np.where(swapped, np.minimum(row[:, 2:], before[:, :-2] + 1), row[:, 2:])
+            # insertions chain along the row: row[x] = min over k <= x of row[k] + x - k
+            row = np.minimum.accumulate(row - steps, axis=1) + steps
+            done = lengths == j + 1
+            hit = done & (row[:, n] <= max_distance)
+            found_ids.append(ids[hit])
+            found_distances.append(row[hit, n])
+            # a swap can reach back past this row to the one before, which may be one edit lower
+            keep = ~done & ((row.min(axis=1) <= max_distance) | (previous.min(axis=1) < max_distance))
+            ids, letters, lengths = ids[keep], letters[keep], lengths[keep]
+            previous, before = row[keep], previous[keep]
+        if not found_ids:
+            return []
+        ids, distances = np.concatenate(found_ids), np.concatenate(found_distances)
+        # words are sorted, so id order is alphabetical
+        order = np.lexsort((ids, -self.dfs[ids], distances))
+        return [(int(distances[i]), self.words[ids[i]], int(self.dfs[ids[i]])) for i in order]
+
+    def correct_word(self, word):
+        # the closest, most common in-vocabulary spelling, word itself if it is known, None if nothing is close
+        if self.known(word):
+            return word
+        max_distance = 1 if len(word) <= SHORT_WORD_LENGTH else MAX_EDIT_DISTANCE
+        found = self.candidates(word, max_distance)
+        return found[0][1] if found else None
+
+    def correct(self, query):
+        # (query with misspelled words replaced, words for which no spelling was close enough); stopwords,
+        # short words and anything that is not all letters are left as typed
+        analyzer = get_analyzer()
+        tokens, unresolved = [], []
+        for token in query.split():
+            word = analyzer.clean(token)
+            if len(word) < MIN_WORD_LENGTH or not word.isalpha() or word in analyzer.stopwords:
+                tokens.append(token)
+                continue
+            corrected = self.correct_word(word)
+            if corrected is None:
+                unresolved.append(token)
+                tokens.append(token)
+            else:
+                tokens.append(token if corrected == word else corrected)
+        return ' '.join(tokens), unresolved
+
+
+def _load_spelling_dictionary():
+    # saved next to the index by InvertedIndex.save() or next to the shards by build_shards(); indexes
+    # saved before that get it built once here, the unsharded index first
+    from lib.keyword_search import InvertedIndex
+    from lib.sharded_search import SHARDS_PATH, SHARDS_HEADER, shards_spelling_dictionary
+
+    idx = InvertedIndex()
+    path = idx.columnar_path / SPELLING_FILE
+    if path.exists():
+        return SpellingDictionary.load(path)
+    if idx.exists():
+        idx.load()
+        dictionary = idx.spelling_dictionary()
+    elif (SHARDS_PATH / SPELLING_FILE).exists():
+        return SpellingDictionary.load(SHARDS_PATH / SPELLING_FILE)
+    elif (SHARDS_PATH / SHARDS_HEADER).exists():
+        path = SHARDS_PATH / SPELLING_FILE
+        dictionary = shards_spelling_dictionary(SHARDS_PATH)
+    else:
+        return SpellingDictionary()
+    dictionary.save(path)
+    return dictionary
+
+
+components.register('spelling', _load_spelling_dictionary)
+
+
+def get_spelling_dictionary():
+    return components.get('spelling')
+
+
+def correct_spelling(query, fallback=None):
+    # local correction against the index vocabulary; fallback (e.g. the LLM) only sees queries with a
+    # word that has no in-vocabulary spelling close enough
+    with tracing.span('spell.local'):
+        corrected, unresolved = get_spelling_dictionary().correct(query)
+    if unresolved and fallback is not None:
+        tracing.count('spell.fallbacks')
+        return fallback(corrected)
+    return corrected
+
+
+def spell_command(query):
+    corrected, unresolved = get_spelling_dictionary().correct(query)
+    print(f"corrected: {corrected}")
+    if unresolved:
+        print(f"no close spelling for: {', '.join(unresolved)}")
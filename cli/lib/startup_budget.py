@@ -0,0 +1,63 @@
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+CLI_DIR = Path(__file__).resolve().parent.parent
+STARTUP_BUDGET = 1.0
+# modules that cheap commands must not import, they are only needed once a model or client is used
+HEAVY_MODULES = ('sentence_transformers', 'torch', 'transformers', 'google.genai', 'nltk')
+CHEAP_COMMANDS = {
+    'keyword --help': ['keyword_search_cli.py', '--help'],
+    'semantic chunk': ['semantic_search_cli.py', 'chunk', 'A cheap command. It never embeds anything.', '0', '4'],
+    'semantic semantic_chunk': ['semantic_search_cli.py', 'semantic_chunk',
+                                'A cheap command. It never embeds anything.', '0', '1'],
+    'hybrid normalized': ['hybrid_search_cli.py', 'normalized', '1', '2', '3'],
+    'server --help': ['search_server_cli.py', '--help'],
+    'sharded --help': ['sharded_search_cli.py', '--help'],
+}
+
+
+def parse_importtime(stderr):
+    # -X importtime lines: "import time: <self us> | <cumulative us> | <indent><module>"
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip())) // 2
+        imports.append((name.strip(), int(self_us), int(cumulative_us), depth))
+    return imports
+
+
+def measure(argv):
+    started = time.perf_counter()
+    proc = subprocess.run([sys.executable, '-X', 'importtime', *argv], cwd=CLI_DIR, capture_output=True, text=True)
+    seconds = time.perf_counter() - started
+    if proc.returncode != 0:
+        raise ValueError(f"{' '.join(argv)} exited with {proc.returncode}: {proc.stderr.splitlines()[-1:]}")
+    imports = parse_importtime(proc.stderr)
+    return {
+        'seconds': seconds,
+        'import_seconds': sum(self_us for _, self_us, _, _ in imports) / 1e6,
+        'heavy': sorted({name for name, *_ in imports
+                         if any(name == heavy or name.startswith(heavy + '.') for heavy in HEAVY_MODULES)}),
+        'slowest': sorted(((cumulative_us, name) for name, _, cumulative_us, depth in imports if depth == 1),
+                          reverse=True),
+    }
+
+
+def check_startup(budget=STARTUP_BUDGET, top=5):
+    # runs every cheap command in a fresh interpreter; fails if one is over budget or loads a heavy module
+    ok = True
+    for label, argv in CHEAP_COMMANDS.items():
+        result = measure(argv)
+        passed = result['seconds'] <= budget and not result['heavy']
+        ok = ok and passed
+        print(f"{'ok  ' if passed else 'FAIL'} {label}: {result['seconds']:.3f}s wall, "
+              f"{result['import_seconds']:.3f}s importing (budget {budget:.2f}s)")
+        if result['heavy']:
+            print(f"     heavy modules imported: {', '.join(result['heavy'])}")
+        for cumulative_us, name in result['slowest'][:top]:
+            print(f"     {cumulative_us / 1000:8.1f} ms  {name}")
+    return ok
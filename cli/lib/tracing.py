@@ -0,0 +1,126 @@
+import atexit
+import sys
+import threading
+import time
+from collections import defaultdict
+
+# per-stage timings and event counters for the search pipeline. Until enable() every span() returns
+# one shared no-op object and count() returns at once, so instrumentation costs a global check
+_enabled = False
+_lock = threading.Lock()
+# stage -> [calls, total seconds, max seconds]
+_stages = {}
+_counters = defaultdict(int)
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class _Span:
+    __slots__ = ('name', 'started')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.started
+        with _lock:
+            stage = _stages.get(self.name)
+            if stage is None:
+                _stages[self.name] = [1, seconds, seconds]
+            else:
+                stage[0] += 1
+                stage[1] += seconds
+                stage[2] = max(stage[2], seconds)
+        return False
+
+
+def enable():
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def enabled():
+    return _enabled
+
+
+def reset():
+    with _lock:
+        _stages.clear()
+        _counters.clear()
+
+
+def span(name):
+    # with span('bm25.score'): ... times the block under that stage name
+    return _Span(name) if _enabled else _NOOP_SPAN
+
+
+def count(name, value=1):
+    if _enabled:
+        with _lock:
+            _counters[name] += value
+
+
+def snapshot():
+    with _lock:
+        return {
+            'stages': {name: {'calls': calls, 'seconds': total, 'max_seconds': longest}
+                       for name, (calls, total, longest) in _stages.items()},
+            'counters': dict(_counters),
+        }
+
+
+def metrics_text(prefix='search'):
+    # Prometheus text exposition of the snapshot
+    data = snapshot()
+    lines = [f'# TYPE {prefix}_stage_seconds_total counter',
+             *(f'{prefix}_stage_seconds_total{{stage="{name}"}} {stage["seconds"]:.9f}'
+               for name, stage in sorted(data['stages'].items())),
+             f'# TYPE {prefix}_stage_calls_total counter',
+             *(f'{prefix}_stage_calls_total{{stage="{name}"}} {stage["calls"]}'
+               for name, stage in sorted(data['stages'].items())),
+             f'# TYPE {prefix}_stage_max_seconds gauge',
+             *(f'{prefix}_stage_max_seconds{{stage="{name}"}} {stage["max_seconds"]:.9f}'
+               for name, stage in sorted(data['stages'].items())),
+             f'# TYPE {prefix}_events_total counter',
+             *(f'{prefix}_events_total{{event="{name}"}} {value}' for name, value in sorted(data['counters'].items()))]
+    return '\n'.join(lines) + '\n'
+
+
+def print_profile(file=sys.stderr):
+    # stage breakdown, slowest total first; stages nest and bm25 runs beside the chunk search, so
+    # totals overlap rather than add up
+    data = snapshot()
+    print(f"{'stage':<32} {'calls':>7} {'total ms':>10} {'mean ms':>9} {'max ms':>9}", file=file)
+    for name, stage in sorted(data['stages'].items(), key=lambda item: -item[1]['seconds']):
+        print(f"{name:<32} {stage['calls']:>7} {stage['seconds'] * 1000:>10.2f} "
+              f"{stage['seconds'] * 1000 / stage['calls']:>9.3f} {stage['max_seconds'] * 1000:>9.2f}", file=file)
+    if data['counters']:
+        print(f"\n{'counter':<32} {'value':>10}", file=file)
+        for name, value in sorted(data['counters'].items()):
+            print(f"{name:<32} {value:>10}", file=file)
+
+
+def profile():
+    # the --profile flag: trace from here on and print the breakdown when the process exits
+    enable()
+    atexit.register(print_profile)
@@ -0,0 +1,116 @@
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from lib import tracing
+
+# share of the disk tier dropped, least recently used first, once it is over its bound
+DISK_EVICT_FRACTION = 0.1
+
+
+class TwoTierCache:
+    # string key -> value: an in-process LRU in front of an optional sqlite store at path (disk_size > 0)
+    # that survives restarts; both tiers are bounded and evict least recently used first, entries expire
+    # ttl seconds after they were put (never if ttl is None). Subclasses build the keys, name the tracing
+    # counters and turn values into what both tiers hold (dump) and back on every hit (load)
+    counter = 'cache'
+
+    def __init__(self, size, disk_size=0, path=None, ttl=None):
+        self.size = size
+        self.disk_size = disk_size
+        self.path = path
+        self.ttl = ttl
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._db = None
+        self._disk_count = 0
+        self._lock = threading.Lock()
+
+    def dump(self, value):
+        return value
+
+    def load(self, stored):
+        return stored
+
+    def _connect(self):
+        if self._db is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value BLOB, expires REAL, used REAL)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS entries_used ON entries (used)')
+            self._disk_count = self._db.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+        return self._db
+
+    def _remember(self, key, stored, expires):
+        self._memory[key] = (stored, expires)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.size:
+            self._memory.popitem(last=False)
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and (entry[1] is None or entry[1] > now):
+                self._memory.move_to_end(key)
+                self.hits += 1
+                tracing.count(f'{self.counter}.hits')
+                return self.load(entry[0])
+            if self.disk_size:
+                db = self._connect()
+                row = db.execute('SELECT value, expires FROM entries WHERE key = ? AND (expires IS NULL OR expires > ?)',
+                                 (key, now)).fetchone()
+                if row is not None:
+                    with db:
+                        db.execute('UPDATE entries SET used = ? WHERE key = ?', (now, key))
+                    self._remember(key, *row)
+                    self.disk_hits += 1
+                    tracing.count(f'{self.counter}.disk_hits')
+                    return self.load(row[0])
+            self.misses += 1
+            tracing.count(f'{self.counter}.misses')
+            return None
+
+    def put(self, key, value):
+        now = time.time()
+        stored = self.dump(value)
+        expires = now + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._remember(key, stored, expires)
+            if not self.disk_size:
+                return
+            db = self._connect()
+            with db:
+                self._disk_count += db.execute(
+                    'INSERT OR REPLACE INTO entries (key, value, expires, used) VALUES (?, ?, ?, ?)',
+                    (key, stored, expires, now)).rowcount
+                if self._disk_count > self.disk_size:
+                    self._disk_count -= db.execute('DELETE FROM entries WHERE expires <= ?', (now,)).rowcount
+                if self._disk_count > self.disk_size:
+                    evict = self._disk_count - self.disk_size + int(self.disk_size * DISK_EVICT_FRACTION)
+                    db.execute('DELETE FROM entries WHERE rowid IN '
+                               '(SELECT rowid FROM entries ORDER BY used LIMIT ?)', (evict,))
+                    self._disk_count = db.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            if self.disk_size:
+                db = self._connect()
+                with db:
+                    db.execute('DELETE FROM entries')
+                self._disk_count = 0
+
+    def stats(self):
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'hit_rate': (self.hits + self.disk_hits) / lookups if lookups else 0.,
+            'memory_entries': len(self._memory),
+        }
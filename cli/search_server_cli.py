@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+
+from lib.search_server import SERVER_ADDRESS, SearchClient, serve
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Search Server CLI")
+    subparsers = parser.add_subparsers(dest="command", help="Available commands")
+    serve_parser = subparsers.add_parser("serve", help="Load the index, embeddings and models once and serve queries")
+    serve_parser.add_argument("--address", type=str, default=SERVER_ADDRESS,
+                              help="http://host:port or unix:///path/to/socket")
+    serve_parser.add_argument("--nprobe", type=int, help="Use the approximate chunk index, probing this many lists")
+    serve_parser.add_argument("--metrics", action="store_true",
+                              help="Record per-stage timings and counters and expose them at GET /metrics")
+    serve_parser.add_argument("--sharded", action="store_true",
+                              help="Search the shards built by sharded_search_cli.py, one worker process per shard")
+    serve_parser.add_argument("--disk-cache", action="store_true",
+                              help="Keep hybrid results in a cache under cache/ that survives restarts")
+    health_parser = subparsers.add_parser("health", help="Check that a search server is up")
+    health_parser.add_argument("--address", type=str, default=SERVER_ADDRESS,
+                               help="http://host:port or unix:///path/to/socket")
+    metrics_parser = subparsers.add_parser("metrics", help="Print the stage timings of a server started with --metrics")
+    metrics_parser.add_argument("--address", type=str, default=SERVER_ADDRESS,
+                                help="http://host:port or unix:///path/to/socket")
+    args = parser.parse_args()
+
+    match args.command:
+        case "serve":
+            serve(args.address, nprobe=args.nprobe, metrics=args.metrics, sharded=args.sharded, disk_cache=args.disk_cache)
+        case "health":
+            print(SearchClient(args.address).health())
+        case "metrics":
+            print(json.dumps(SearchClient(args.address).metrics(), indent=2))
+        case _:
+            parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
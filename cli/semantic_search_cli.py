@@ -3,7 +3,11 @@
 import argparse
 
 from lib.semantic_search import verify_model, embed_text, verify_embeddings, embed_query_text, search, chunk_text, \
-    chunk_text_semantic, embed_chunks, searched_chunks
+    chunk_text_semantic, embed_chunks, searched_chunks, print_chunk_results, ann_recall, \
+    quantization_report, batch_command
+from lib.batch_search import QUERY_BATCH_SIZE
+from lib.search_server import SERVER_ADDRESS, SearchClient
+from lib import tracing
 
 
 def main():
@@ -20,6 +24,8 @@ def main():
     searcher_query = subparsers.add_parser("search", help="Search")
     searcher_query.add_argument("query", type=str, help="user query to search in final search")
     searcher_query.add_argument("limit", type=int, default=5, help="Number of searches to display")
+    searcher_query.add_argument("--storage", choices=["float32", "float16", "int8"], default="float32",
+                                help="Embedding precision for the first scoring pass")
     chunks = subparsers.add_parser("chunk", help="Chunkinggg express")
     chunks.add_argument("query", type=str, help="user text to chunk")
     chunks.add_argument("overlap", type=int, default=5, help="Number of overlaps")
@@ -34,17 +40,55 @@ def main():
     chunk_search = subparsers.add_parser("chunk_search", help="Search in the chunks")
     chunk_search.add_argument("query", type=str, help="user query to search in final search")
     chunk_search.add_argument("limit", type=int, default=5, help="Number of searches to display")
+    chunk_search.add_argument("--storage", choices=["float32", "float16", "int8"], default="float32",
+                              help="Embedding precision for the first scoring pass")
+    chunk_search.add_argument("--nprobe", type=int, help="Use the approximate chunk index, probing this many lists")
+    chunk_search.add_argument("--server", nargs='?', const=SERVER_ADDRESS,
+                              help=f"Send the query to a running search server (default {SERVER_ADDRESS})")
+    recall_parser = subparsers.add_parser("ann_recall", help="Measure approximate chunk search against exact search")
+    recall_parser.add_argument("--limit", type=int, default=10, help="Recall cutoff")
+    recall_parser.add_argument("--queries", type=int, default=50, help="Number of sample queries")
+    recall_parser.add_argument("--nprobe", type=int, nargs='+', default=[1, 2, 4, 8, 16], help="nprobe values to try")
+    recall_parser.add_argument("--nlist", type=int, help="Number of IVF lists (rebuilds the index if it differs)")
+    quant_parser = subparsers.add_parser("quantization_report", help="Compare float16/int8 chunk search to float32")
+    quant_parser.add_argument("--limit", type=int, default=10, help="Recall cutoff")
+    quant_parser.add_argument("--queries", type=int, default=50, help="Number of sample queries")
+    batch_parser = subparsers.add_parser("batch", help="Run many chunk searches and write ranked results as JSONL")
+    batch_parser.add_argument("input", nargs='?', default='-',
+                              help='JSONL queries, a string or an object with a "query" field per line (default stdin)')
+    batch_parser.add_argument("--output", "-o", default='-', help="Where to write the JSONL results (default stdout)")
+    batch_parser.add_argument("--limit", type=int, default=10, help="Results per query")
+    batch_parser.add_argument("--batch-size", type=int, default=QUERY_BATCH_SIZE,
+                              help="Queries embedded and scored together")
+    batch_parser.add_argument("--storage", choices=["float32", "float16", "int8"], default="float32",
+                              help="Embedding precision for the first scoring pass")
+    batch_parser.add_argument("--nprobe", type=int, help="Use the approximate chunk index, probing this many lists")
+    parser.add_argument("--profile", action="store_true", help="Print time spent per search stage to stderr on exit")
     args = parser.parse_args()
+    if args.profile:
+        tracing.profile()
 
     match args.command:
+        case 'batch':
+            batch_command(args.input, args.output, args.limit, args.nprobe, args.storage, args.batch_size)
         case 'chunk_search':
-            searched_chunks(args.query, args.limit)
+            if args.server:
+                if args.nprobe is not None or args.storage != 'float32':
+                    # the server searches with the options it was started with
+                    chunk_search.error("the server uses its own --nprobe and float32 embeddings, drop --nprobe and --storage with --server")
+                print_chunk_results(SearchClient(args.server).search('semantic', args.query, limit=args.limit)['results'])
+            else:
+                searched_chunks(args.query, args.limit, nprobe=args.nprobe, storage=args.storage)
+        case 'ann_recall':
+            ann_recall(args.limit, args.queries, args.nprobe, args.nlist)
         case 'embed_chunks':
             embed_chunks()
         case 'semantic_chunk':
             chunk_text_semantic(args.query, args.overlap, args.chunk_size)
         case 'search':
-            search(args.query, args.limit)
+            search(args.query, args.limit, storage=args.storage)
+        case 'quantization_report':
+            quantization_report(args.limit, args.queries)
         case 'chunk':
             chunk_text(args.query, args.overlap, args.chunk_size)
         case "embed_query":
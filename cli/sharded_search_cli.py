@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+
+import argparse
+
+from lib.sharded_search import build_command
+from lib import tracing
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Sharded Search CLI")
+    subparsers = parser.add_subparsers(dest="command", help="Available commands")
+    build_parser = subparsers.add_parser("build", help="Split the corpus into shards, each with its own index and chunks")
+    build_parser.add_argument("--shards", type=int, default=4, help="Number of shards, one worker process each")
+    build_parser.add_argument("--workers", type=int, default=1, help="Analyze each shard in this many processes")
+    build_parser.add_argument("--positional", action="store_true",
+                              help="Also index where terms occur, for the proximity score")
+    bm25search_parser = subparsers.add_parser("bm25search", help="BM25 over every shard with corpus-wide statistics")
+    bm25search_parser.add_argument("query", type=str, help="Search query")
+    bm25search_parser.add_argument("--limit", type=int, default=5, help="# of results to return")
+    search_parser = subparsers.add_parser("search", help="Chunk search over every shard")
+    search_parser.add_argument("query", type=str, help="Search query")
+    search_parser.add_argument("--limit", type=int, default=5, help="# of results to return")
+    search_parser.add_argument("--nprobe", type=int, help="Use the approximate chunk index, probing this many lists")
+    search_parser.add_argument("--storage", choices=["float32", "float16", "int8"], default="float32",
+                               help="Embedding precision for the first scoring pass")
+    parser.add_argument("--profile", action="store_true", help="Print time spent per search stage to stderr on exit")
+    args = parser.parse_args()
+    if args.profile:
+        tracing.profile()
+
+    match args.command:
+        case "build":
+            build_command(args.shards, args.workers, args.positional)
+        case "bm25search":
+            from lib.sharded_search import ShardPool, ShardedIndex
+
+            with ShardPool() as pool:
+                results = ShardedIndex(pool).bm25_search(args.query, args.limit)
+            for idx, result in enumerate(results):
+                print(f'{idx + 1}.) ({result['doc_id']}) {result['title']} - Score = {result['score']:.2f}')
+        case "search":
+            from lib.sharded_search import ShardPool, ShardedChunkSearch
+            from lib.semantic_search import print_chunk_results
+
+            with ShardPool(storage=args.storage, nprobe=args.nprobe) as pool:
+                print_chunk_results(ShardedChunkSearch(pool).search_chunks(args.query, args.limit))
+        case _:
+            parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
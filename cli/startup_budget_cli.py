@@ -0,0 +1,20 @@
+#!/usr/bin/env python3
+
+import argparse
+import sys
+
+from lib.startup_budget import STARTUP_BUDGET, check_startup
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Check that cheap CLI commands start within a time budget")
+    parser.add_argument("--budget", type=float, default=STARTUP_BUDGET, help="Seconds allowed per command")
+    parser.add_argument("--top", type=int, default=5, help="Slowest top-level imports to show per command")
+    args = parser.parse_args()
+
+    if not check_startup(args.budget, args.top):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()